@@ -0,0 +1,252 @@
+# Resumable bulk backfill: embeds and indexes every image blob of a container.
+#
+# Usage:
+#   python backfill.py https://<account>.blob.core.windows.net/<container> [--prefix photos/]
+#                      [--state-dir .backfill] [--concurrency 16] [--page-size 200]
+#
+# Blob listings are streamed page by page. Each page is vectorized with bounded concurrency
+# (vectorize_images) and written to the index in one batch, then the listing continuation token
+# is checkpointed. After a crash the run resumes from the last completed page, and blobs already
+# indexed with the same ETag are skipped using a local ledger. Blobs that failed to vectorize or index
+# are kept in the ledger too and retried once the listing is done, also by a later run of a
+# completed backfill; "failed" in the totals is the number still outstanding.
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+from urllib.parse import quote
+
+from azure.storage.blob import ContainerClient
+
+from function_app import vectorize_images
+from helpers import document_writer
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tif", ".tiff", ".ico", ".mpo")
+
+
+class Ledger:
+    # Blob URL -> ETag of the version currently in the index, plus the blobs whose last attempt failed
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS indexed (url TEXT PRIMARY KEY, etag TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS failed (url TEXT PRIMARY KEY, name TEXT NOT NULL, etag TEXT NOT NULL, "
+            "error TEXT, attempts INTEGER NOT NULL)"
+        )
+
+    def is_indexed(self, url, etag):
+        row = self._conn.execute("SELECT etag FROM indexed WHERE url = ?", (url,)).fetchone()
+        return row is not None and row[0] == etag
+
+    def mark_indexed(self, entries):
+        self._conn.execute("BEGIN")
+        self._conn.executemany("INSERT OR REPLACE INTO indexed (url, etag) VALUES (?, ?)", entries)
+        self._conn.executemany("DELETE FROM failed WHERE url = ?", [(url,) for url, _ in entries])
+        self._conn.execute("COMMIT")
+
+    def mark_failed(self, entries):
+        # entries: (url, blob name, etag, error)
+        self._conn.execute("BEGIN")
+        self._conn.executemany(
+            "INSERT INTO failed (url, name, etag, error, attempts) VALUES (?, ?, ?, ?, 1) "
+            "ON CONFLICT (url) DO UPDATE SET name = excluded.name, etag = excluded.etag, error = excluded.error, "
+            "attempts = attempts + 1",
+            entries,
+        )
+        self._conn.execute("COMMIT")
+
+    def failed(self):
+        # [(url, blob name, etag)] of the blobs to retry
+        return self._conn.execute("SELECT url, name, etag FROM failed ORDER BY url").fetchall()
+
+    def failed_count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM failed").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def load_checkpoint(path, container_url, prefix):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("container") != container_url or checkpoint.get("prefix") != prefix:
+        logging.warning(f"Ignoring checkpoint {path}: it belongs to another container or prefix")
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    # Write-then-rename so a crash never leaves a torn checkpoint behind
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def is_image(blob):
+    content_type = blob.content_settings.content_type if blob.content_settings else None
+    if content_type and content_type.startswith("image/"):
+        return True
+    return blob.name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def process_page(container_url, blobs, ledger, concurrency):
+    counts = {"listed": len(blobs), "skipped": 0, "indexed": 0, "failed": 0}
+    values = []
+    for blob in blobs:
+        if not is_image(blob):
+            counts["skipped"] += 1
+            continue
+        image_url = f"{container_url}/{quote(blob.name, safe='/')}"
+        etag = blob.etag
+        if ledger.is_indexed(image_url, etag):
+            counts["skipped"] += 1
+            continue
+        values.append({"recordId": blob.name, "data": {"imageUrl": image_url, "eTag": etag}})
+
+    if values:
+        index_values(values, ledger, concurrency, counts)
+    return counts
+
+
+def index_values(values, ledger, concurrency, counts):
+    # Vectorizes and indexes the records; the outcome of every blob is recorded in the ledger
+    blobs = {value["recordId"]: (value["data"]["imageUrl"], value["data"]["eTag"]) for value in values}
+    documents = []
+    duplicates = []
+    failures = []
+    for response_value in vectorize_images(values, max_workers=concurrency, dedupe_ingest=True):
+        name = response_value["recordId"]
+        image_url, etag = blobs[name]
+        if response_value["errors"]:
+            logging.error(f"Vectorize failed for {name}: {response_value['errors']}")
+            failures.append((image_url, name, etag, str(response_value["errors"])))
+            continue
+        data = response_value["data"]
+        if data.get("duplicateOf"):
+            # Linked to an indexed near-duplicate, recorded in the ledger so a resume does not retry it
+            duplicates.append((image_url, etag))
+            counts["skipped"] += 1
+            continue
+        try:
+            documents.append(document_writer.to_document(image_url, data["imageVector"]))
+        except ValueError as e:
+            logging.error(f"Skipping {image_url}: {e}")
+            failures.append((image_url, name, etag, str(e)))
+
+    names_by_id = {document_writer.document_id(image_url): name for name, (image_url, _) in blobs.items()}
+    succeeded, failed = document_writer.index_batch(documents) if documents else ([], [])
+    for document_id, message in failed:
+        name = names_by_id[document_id]
+        image_url, etag = blobs[name]
+        logging.error(f"Indexing failed for {image_url}: {message}")
+        failures.append((image_url, name, etag, str(message)))
+    ledger.mark_indexed([blobs[names_by_id[document_id]] for document_id in succeeded] + duplicates)
+    ledger.mark_failed(failures)
+
+    counts["indexed"] += len(succeeded)
+    counts["failed"] += len(failures)
+
+
+def run_backfill(container_url, prefix=None, state_dir=".backfill", concurrency=16, page_size=200):
+    container_url = container_url.rstrip("/")
+    os.makedirs(state_dir, exist_ok=True)
+    checkpoint_path = os.path.join(state_dir, "checkpoint.json")
+    ledger = Ledger(os.path.join(state_dir, "ledger.sqlite"))
+
+    checkpoint = load_checkpoint(checkpoint_path, container_url, prefix) or {
+        "container": container_url,
+        "prefix": prefix,
+        "continuation_token": None,
+        "done": False,
+        "totals": {"listed": 0, "skipped": 0, "indexed": 0, "failed": 0},
+        "elapsed_seconds": 0.0,
+    }
+    if checkpoint["done"]:
+        try:
+            if ledger.failed_count():
+                # Only the blobs that failed are attempted again
+                retry_failed(ledger, concurrency, page_size, checkpoint)
+                save_checkpoint(checkpoint_path, checkpoint)
+            else:
+                logging.info(f"Backfill of {container_url} already completed, remove {checkpoint_path} to run it again")
+        finally:
+            ledger.close()
+        return checkpoint["totals"]
+    if checkpoint["continuation_token"]:
+        logging.info(f"Resuming backfill of {container_url} after {checkpoint['totals']['listed']} blobs")
+
+    container_client = ContainerClient.from_container_url(container_url, credential=os.environ["ACCOUNT_KEY"])
+    pages = container_client.list_blobs(name_starts_with=prefix, results_per_page=page_size).by_page(
+        continuation_token=checkpoint["continuation_token"]
+    )
+
+    totals = checkpoint["totals"]
+    started = time.monotonic() - checkpoint["elapsed_seconds"]
+    try:
+        for page in pages:
+            page_started = time.monotonic()
+            counts = process_page(container_url, list(page), ledger, concurrency)
+            for name, count in counts.items():
+                totals[name] += count
+
+            # Only checkpoint once the page is in the index
+            checkpoint["continuation_token"] = pages.continuation_token
+            checkpoint["elapsed_seconds"] = time.monotonic() - started
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            page_rate = (counts["indexed"] + counts["failed"]) / max(time.monotonic() - page_started, 1e-6)
+            overall_rate = totals["indexed"] / max(checkpoint["elapsed_seconds"], 1e-6)
+            logging.info(
+                f"Backfill page: {counts}. Totals: {totals}. "
+                f"{page_rate:.1f} images/s this page, {overall_rate:.1f} images/s overall"
+            )
+
+        checkpoint["done"] = True
+        retry_failed(ledger, concurrency, page_size, checkpoint)
+        save_checkpoint(checkpoint_path, checkpoint)
+    finally:
+        ledger.close()
+    return totals
+
+
+def retry_failed(ledger, concurrency, page_size, checkpoint):
+    # One more attempt for every blob that failed, in page-sized batches
+    entries = ledger.failed()
+    totals = checkpoint["totals"]
+    if entries:
+        logging.info(f"Retrying {len(entries)} failed blobs")
+    counts = {"skipped": 0, "indexed": 0, "failed": 0}
+    for start in range(0, len(entries), page_size):
+        values = [{"recordId": name, "data": {"imageUrl": url, "eTag": etag}}
+                  for url, name, etag in entries[start:start + page_size]]
+        index_values(values, ledger, concurrency, counts)
+    totals["indexed"] += counts["indexed"]
+    totals["skipped"] += counts["skipped"]
+    totals["failed"] = ledger.failed_count()
+    if totals["failed"]:
+        logging.warning(f"{totals['failed']} blobs still failed, the next run retries them")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed and index every image in a blob container.")
+    parser.add_argument("container_url")
+    parser.add_argument("--prefix", default=None)
+    parser.add_argument("--state-dir", default=".backfill")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--page-size", type=int, default=200)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    totals = run_backfill(args.container_url, args.prefix, args.state_dir, args.concurrency, args.page_size)
+    print(json.dumps(totals))
+
+
+if __name__ == "__main__":
+    main()
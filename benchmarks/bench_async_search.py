@@ -0,0 +1,135 @@
+# Concurrent searches per worker: the sync /search handler on the worker's thread pool against the async
+# /search/async handler on one event loop, both against the local fakes (benchmarks/fake_services.py).
+# Usage: python -m benchmarks.bench_async_search [--concurrency 1,8,32,64] [--requests-per-client 4]
+#        [--sync-threads 8] [--latency-ms 100] [--jitter-ms 20] [--dimensions 1024] [--json async-search.json]
+#
+# Every request has its own query, so each one pays a rephrase, a text embedding and an index query.
+# --sync-threads is the worker's PYTHON_THREADPOOL_THREAD_COUNT; requests beyond it queue, as they do
+# in the Functions worker. The default is the worker's own default, min(32, CPU count + 4).
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_services import SERVICES, FakeAzureServices, FakeServiceConfig
+from benchmarks.load_test import percentile
+
+
+def search_request(query, max_images):
+    import azure.functions as func
+
+    body = json.dumps({"query": query, "max_images": max_images}).encode("utf-8")
+    return func.HttpRequest("POST", "/api/search", body=body, headers={"Authorization": "Bearer benchmark"})
+
+
+def summarize(handler, concurrency, elapsed, latencies, statuses):
+    latencies.sort()
+    return {
+        "handler": handler,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "statuses": {str(status): count for status, count in statuses.items()},
+    }
+
+
+def run_sync(concurrency, total, threads, args):
+    import function_app
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    # Each client waits for its previous response; the handler runs on the worker's thread pool, so
+    # latencies include the time a request queued for a free thread
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="worker") as worker:
+        def client(requests):
+            for i in requests:
+                started = time.perf_counter()
+                request = search_request(f"sync {concurrency} subject {i}", args.max_images)
+                status = worker.submit(function_app.search, request).result().status_code
+                with lock:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="client") as clients:
+            list(clients.map(client, (range(c, total, concurrency) for c in range(concurrency))))
+        elapsed = time.perf_counter() - started
+    return summarize("sync", concurrency, elapsed, latencies, statuses)
+
+
+def run_async(concurrency, total, args):
+    import function_app
+    from helpers import async_transport
+
+    latencies = []
+    statuses = {}
+
+    async def client(requests):
+        for i in requests:
+            started = time.perf_counter()
+            response = await function_app.search_async(search_request(f"async {concurrency} subject {i}",
+                                                                      args.max_images))
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async def drive():
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*(client(range(c, total, concurrency)) for c in range(concurrency)))
+            return time.perf_counter() - started
+        finally:
+            await async_transport.aclose()
+
+    elapsed = asyncio.run(drive())
+    return summarize("async", concurrency, elapsed, latencies, statuses)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,8,32,64", help="comma separated numbers of concurrent clients")
+    parser.add_argument("--requests-per-client", type=int, default=4)
+    parser.add_argument("--sync-threads", type=int, default=min(32, (os.cpu_count() or 1) + 4))
+    parser.add_argument("--max-images", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--json")
+    args = parser.parse_args()
+
+    configs = {service: FakeServiceConfig(args.latency_ms, args.jitter_ms) for service in SERVICES}
+    results = []
+    with FakeAzureServices(configs, dimensions=args.dimensions) as services:
+        os.environ.update(services.environment())
+        os.environ.setdefault("METRICS_LOG_REQUESTS", "false")
+        # The Vision limiter would cap both handlers at the same rate and hide the difference
+        os.environ.setdefault("VISION_RATE_LIMIT", "0")
+        from helpers import document_writer
+
+        # The first searches import the SDKs
+        run_sync(1, 2, 1, args)
+        run_async(1, 2, args)
+        print(f"search handlers, {args.latency_ms} ms per upstream call, sync handler on {args.sync_threads} threads")
+        print(f"{'handler':<10}{'clients':>8}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for concurrency in (int(value) for value in args.concurrency.split(",")):
+            total = concurrency * args.requests_per_client
+            for result in (run_sync(concurrency, total, args.sync_threads, args), run_async(concurrency, total, args)):
+                results.append(result)
+                print(f"{result['handler']:<10}{concurrency:>8}{result['requests']:>10}{result['throughput_rps']:>10.1f}"
+                      f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+                      + ("" if list(result["statuses"]) == ["200"] else f"  statuses {result['statuses']}"))
+        document_writer.close()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# Cold-start cost per route: import time of function_app, first request and a warm second request,
+# each measured in a fresh interpreter against the local fake services (benchmarks/fake_services.py).
+# Usage: python -m benchmarks.bench_cold_start [--routes url,vectorize,search] [--runs 3] [--json cold-start.json]
+#
+# azure.functions is imported before the clock starts, the Functions worker has always loaded it.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROUTES = ("url", "stats", "vectorize", "GetImageEmbeddings", "index", "search")
+# Modules whose import dominates a cold start, reported when a route has loaded them
+SDK_MODULES = ("openai", "requests", "azure.core", "azure.storage.blob", "azure.identity",
+               "azure.search.documents", "numpy")
+
+
+def loaded_sdks():
+    return [module for module in SDK_MODULES if module in sys.modules]
+
+
+def child(route, blob_base_url):
+    # Runs in the fresh interpreter; prints one JSON line with the timings
+    import logging
+
+    import azure.functions as func
+
+    logging.basicConfig(level=logging.ERROR)
+    started = time.perf_counter()
+    import function_app
+    import_ms = (time.perf_counter() - started) * 1000
+    after_import = loaded_sdks()
+
+    def call(i):
+        if route in ("url", "stats"):
+            handler = function_app.url if route == "url" else function_app.stats
+            return handler(func.HttpRequest("GET", f"/api/{route}", body=b""))
+        if route == "search":
+            body = {"query": f"cold start query {i}", "max_images": 5}
+            return function_app.search(func.HttpRequest("POST", "/api/search", body=json.dumps(body).encode(),
+                                                        headers={"Authorization": "Bearer cold-start"}))
+        image_url = f"{blob_base_url}/cold{i}.png"
+        if route == "index":
+            return function_app.index(func.EventGridEvent(
+                id=f"event-{i}", data={"clientRequestId": str(i), "url": image_url, "eTag": f"0x{i}"},
+                topic="/cold-start", subject=f"/blobs/cold{i}.png", event_type="Microsoft.Storage.BlobCreated",
+                event_time=None, data_version="1",
+            ))
+        body = json.dumps({"values": [{"recordId": str(i), "data": {"imageUrl": image_url}}]}).encode()
+        handler = function_app.vectorize if route == "vectorize" else function_app.GetImageEmbeddings
+        return handler(func.HttpRequest("POST", f"/api/{route}", body=body))
+
+    started = time.perf_counter()
+    call(0)
+    first_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    call(1)
+    warm_ms = (time.perf_counter() - started) * 1000
+
+    from helpers import document_writer
+    # Stops the buffered sender's timer thread so the interpreter can exit
+    document_writer.close()
+    print(json.dumps({
+        "import_ms": import_ms,
+        "first_request_ms": first_ms,
+        "warm_request_ms": warm_ms,
+        "sdks_after_import": after_import,
+        "sdks_after_request": loaded_sdks(),
+    }))
+
+
+def measure(route, services, runs):
+    env = dict(os.environ, **services.environment(), METRICS_LOG_REQUESTS="false", PYTHONDONTWRITEBYTECODE="1")
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_cold_start", "--child", route,
+             "--blob-base-url", services.blob_url("").rstrip("/")],
+            env=env, capture_output=True, text=True, check=True, timeout=300,
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    result = {
+        name: round(statistics.median(sample[name] for sample in samples), 1)
+        for name in ("import_ms", "first_request_ms", "warm_request_ms")
+    }
+    result["sdks_after_import"] = samples[-1]["sdks_after_import"]
+    result["sdks_after_request"] = samples[-1]["sdks_after_request"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--routes", default=",".join(ROUTES))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--json")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--blob-base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.blob_base_url)
+        return
+
+    from benchmarks.fake_services import FakeAzureServices
+
+    results = {}
+    with FakeAzureServices() as services:
+        print(f"median of {args.runs} fresh interpreters per route")
+        print(f"{'route':<20}{'import ms':>11}{'first ms':>11}{'warm ms':>11}  SDKs loaded by the first request")
+        for route in args.routes.split(","):
+            result = results[route] = measure(route, services, args.runs)
+            print(f"{route:<20}{result['import_ms']:>11.1f}{result['first_request_ms']:>11.1f}"
+                  f"{result['warm_request_ms']:>11.1f}  {', '.join(result['sdks_after_request']) or '-'}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
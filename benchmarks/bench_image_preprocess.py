@@ -0,0 +1,96 @@
+# vectorizeImage in URL mode (Vision downloads the original blob) against IMAGE_PREPROCESS mode
+# (the function downloads, downscales and sends the bytes), on synthetic camera-sized images served
+# by the local fakes (benchmarks/fake_services.py).
+# Usage: python -m benchmarks.bench_image_preprocess [--images 20] [--size 4000x3000] [--max-side 1024]
+#        [--blob-mbps 400] [--vision-mbps 100] [--json image-preprocess.json]
+#
+# --blob-mbps is the bandwidth of blob reads (by Vision in URL mode, by the function otherwise),
+# --vision-mbps the bandwidth of request bodies sent to Vision.
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import time
+
+from benchmarks.fake_services import FakeAzureServices, FakeServiceConfig
+
+
+def synthetic_image(width, height, format, seed):
+    # Upscaled noise: smooth areas and detail, so it compresses roughly like a photo
+    from PIL import Image
+
+    rng = random.Random(seed)
+    small = (max(1, width // 8), max(1, height // 8))
+    image = Image.frombytes("RGB", small, rng.randbytes(small[0] * small[1] * 3))
+    image = image.resize((width, height), Image.Resampling.BICUBIC)
+    output = io.BytesIO()
+    image.save(output, format=format, quality=90)
+    return output.getvalue()
+
+
+def run_mode(services, urls, preprocess):
+    from helpers import helper_functions, image_preprocess
+
+    image_preprocess.IMAGE_PREPROCESS = preprocess
+    services.reset_counters()
+    latencies = []
+    for url in urls:
+        started = time.perf_counter()
+        helper_functions.get_image_embeddings(url, "sv=2024-08-04&sig=benchmark")
+        latencies.append((time.perf_counter() - started) * 1000)
+    vision, blob = services.counters["vision"], services.counters["blob"]
+    return {
+        "mean_ms": round(statistics.mean(latencies), 1),
+        "p50_ms": round(statistics.median(latencies), 1),
+        "max_ms": round(max(latencies), 1),
+        "bytes_to_vision": vision["bytes_received"],
+        "bytes_fetched_by_vision": vision["bytes_fetched"],
+        "bytes_downloaded_by_function": blob["bytes_sent"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--size", default="4000x3000")
+    parser.add_argument("--formats", default="JPEG,PNG")
+    parser.add_argument("--max-side", type=int, default=1024)
+    parser.add_argument("--blob-mbps", type=float, default=400)
+    parser.add_argument("--vision-mbps", type=float, default=100)
+    parser.add_argument("--vision-latency-ms", type=float, default=40)
+    parser.add_argument("--json")
+    args = parser.parse_args()
+    width, height = (int(value) for value in args.size.split("x"))
+
+    configs = {
+        "vision": FakeServiceConfig(args.vision_latency_ms, bandwidth_mbps=args.vision_mbps),
+        "blob": FakeServiceConfig(bandwidth_mbps=args.blob_mbps),
+    }
+    results = {}
+    with FakeAzureServices(configs) as services:
+        os.environ.update(services.environment())
+        os.environ["IMAGE_MAX_SIDE"] = str(args.max_side)
+        print(f"{args.images} images of {width}x{height} per format, max side {args.max_side}, "
+              f"blob {args.blob_mbps} Mbps, vision {args.vision_mbps} Mbps")
+        print(f"{'format':<8}{'mode':<12}{'mean ms':>10}{'p50 ms':>10}{'max ms':>10}"
+              f"{'to vision':>14}{'vision fetch':>14}{'fn download':>14}")
+        for format in args.formats.split(","):
+            extension = "jpg" if format == "JPEG" else format.lower()
+            urls = [
+                services.put_blob(f"bench{i}.{extension}", synthetic_image(width, height, format, i))
+                for i in range(args.images)
+            ]
+            for mode, preprocess in (("url", False), ("preprocess", True)):
+                result = results[f"{format}/{mode}"] = run_mode(services, urls, preprocess)
+                print(f"{format:<8}{mode:<12}{result['mean_ms']:>10.1f}{result['p50_ms']:>10.1f}"
+                      f"{result['max_ms']:>10.1f}{result['bytes_to_vision']:>14,}"
+                      f"{result['bytes_fetched_by_vision']:>14,}{result['bytes_downloaded_by_function']:>14,}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Bytes and encode time of a /vectorize response body per vector format.
+# Usage: python -m benchmarks.bench_vector_encoding [--records 50] [--dimensions 1024] [--rounds 20]
+import argparse
+import json
+import random
+import time
+
+from helpers import vector_codec
+
+
+def build_response(vectors, vector_format=None):
+    return {
+        "values": [
+            {
+                "recordId": str(i),
+                "data": {
+                    "imageVector": vector_codec.encode(vector, vector_format) if vector_format else vector,
+                    "imageUrl": f"https://account.blob.core.windows.net/data/image{i}.png",
+                },
+                "errors": None,
+                "warnings": None,
+            }
+            for i, vector in enumerate(vectors)
+        ]
+    }
+
+
+def measure(encode_batch, rounds):
+    body = encode_batch()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        encode_batch()
+    return len(body.encode("utf-8")), (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=50)
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    float_lists = [[random.gauss(0, 0.05) for _ in range(args.dimensions)] for _ in range(args.records)]
+    float32_vectors = [vector_codec.to_float32(vector) for vector in float_lists]
+
+    cases = [
+        # Previous behaviour: lists of Python floats through json.dumps
+        ("json.dumps(list)", lambda: json.dumps(build_response(float_lists))),
+        ("json (float32)", lambda: vector_codec.dumps(build_response(float32_vectors, "json"))),
+        ("base64 float32", lambda: vector_codec.dumps(build_response(float32_vectors, "base64"))),
+        ("int8", lambda: vector_codec.dumps(build_response(float32_vectors, "int8"))),
+    ]
+
+    print(f"{args.records} records x {args.dimensions} dims, {args.rounds} rounds")
+    print(f"{'format':<20}{'bytes':>12}{'ms/batch':>12}")
+    for name, encode_batch in cases:
+        size, elapsed = measure(encode_batch, args.rounds)
+        print(f"{name:<20}{size:>12}{elapsed:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+# Local stand-ins for the services the function app calls, for load tests and offline tests.
+# One HTTP server answers for all of them, routed by path:
+#   vision  POST /computervision/retrieval:vectorizeImage and :vectorizeText
+#   openai  POST /openai/deployments/<model>/chat/completions
+#   search  POST /indexes('<name>')/docs/search.post.search and /docs/search.index, GET /indexes('<name>')
+#   blob    POST /<account>?restype=service&comp=userdelegationkey and HEAD/GET /<account>/<container>/<blob>
+# Every service has its own latency, jitter, 429 rate and optionally bandwidth and a requests/s quota
+# (FakeServiceConfig).
+# Blob contents put with put_blob() are served by GET and fetched by vectorizeImage in URL mode.
+#
+# The server speaks HTTPS with a throwaway self-signed certificate, because the Search SDK refuses
+# plain-http endpoints for some calls. environment() points REQUESTS_CA_BUNDLE and SSL_CERT_FILE at it.
+import base64
+import datetime
+import hashlib
+import ipaddress
+import json
+import os
+import random
+import re
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+SERVICES = ("vision", "openai", "search", "blob")
+# Path-style blob URLs, the same layout Azurite uses: http://127.0.0.1:<port>/<account>/<container>/<blob>
+ACCOUNT_NAME = "devaccount"
+ACCOUNT_KEY = base64.b64encode(b"fake-account-key-for-local-tests").decode("ascii")
+
+_search_path = re.compile(r"^/indexes(?:\('(?P<quoted>[^']+)'\)|/(?P<plain>[^/(]+))(?:/docs/(?P<operation>[^?]+))?$")
+
+
+class FakeServiceConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, throttle_rate=0.0, retry_after_ms=100, bandwidth_mbps=None,
+                 quota_rps=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+        # None is unlimited, otherwise request and response bodies take size / bandwidth to transfer
+        self.bandwidth_mbps = bandwidth_mbps
+        # None is unlimited, otherwise requests beyond this rate get a 429 like a service over its TPS quota
+        self.quota_rps = quota_rps
+
+    def delay(self, rng):
+        return max(0.0, self.latency_ms + rng.uniform(0, self.jitter_ms)) / 1000
+
+    def transfer_time(self, size):
+        return size * 8 / (self.bandwidth_mbps * 1_000_000) if self.bandwidth_mbps else 0.0
+
+
+def write_self_signed_certificate(directory, host="127.0.0.1"):
+    # Returns (certificate path, key path); cryptography comes with azure-identity
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(hours=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address(host)),
+                                                    x509.DNSName("localhost")]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    certificate_path = os.path.join(directory, "fake-azure.pem")
+    key_path = os.path.join(directory, "fake-azure.key")
+    with open(certificate_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return certificate_path, key_path
+
+
+def fake_vector(text, dimensions):
+    # Deterministic per input, so the same image or text always gets the same embedding
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    return [round(rng.gauss(0, 0.05), 6) for _ in range(dimensions)]
+
+
+class FakeAzureServices:
+    def __init__(self, configs=None, dimensions=1024, host="127.0.0.1", port=0):
+        self.configs = {service: FakeServiceConfig() for service in SERVICES}
+        self.configs.update(configs or {})
+        self.dimensions = dimensions
+        self.documents = {}
+        # Blob contents by path, /<account>/<container>/<blob>
+        self.blobs = {}
+        self.counters = {service: self._new_counters() for service in SERVICES}
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        # Per-service quota buckets: (tokens, last refill)
+        self._quota = {service: (None, time.monotonic()) for service in SERVICES}
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        # Keep-alive connections idle in their handler threads, stop() must not wait for them
+        self._server.block_on_close = False
+        self._thread = None
+
+        self._certificate_dir = tempfile.TemporaryDirectory(prefix="fake-azure-")
+        self.certificate_path, key_path = write_self_signed_certificate(self._certificate_dir.name, host)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certificate_path, key_path)
+        # The handshake runs on the handler thread, so one slow client does not stall accept()
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True,
+                                                  do_handshake_on_connect=False)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"https://{host}:{port}"
+
+    def blob_url(self, name, container="images"):
+        return f"{self.url}/{ACCOUNT_NAME}/{container}/{name}"
+
+    def environment(self, index_name="images"):
+        # Settings that point the function app at this server
+        return {
+            "AI_VISION_ENDPOINT": self.url,
+            "AI_VISION_API_KEY": "fake",
+            "AZURE_OPENAI_ENDPOINT": self.url,
+            "AZURE_OPENAI_API_KEY": "fake",
+            "OPEN_AI_MODEL": "gpt-35-turbo",
+            "API_VERSION": "2024-02-01",
+            "AI_SEARCH_SERVICE_ENDPOINT": self.url,
+            "AZURE_SEARCH_ADMIN_KEY": "fake",
+            "AI_SEARCH_INDEX_NAME": index_name,
+            "ACCOUNT_KEY": ACCOUNT_KEY,
+            # Trust the self-signed certificate (requests / azure-core and httpx / openai)
+            "REQUESTS_CA_BUNDLE": self.certificate_path,
+            "SSL_CERT_FILE": self.certificate_path,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-azure", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._certificate_dir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def put_blob(self, name, data, container="images"):
+        self.blobs[f"/{ACCOUNT_NAME}/{container}/{name}"] = data
+        return self.blob_url(name, container)
+
+    @staticmethod
+    def _new_counters():
+        # bytes_fetched: blob bytes Vision pulled itself for URL-mode vectorizeImage calls
+        return {"requests": 0, "throttled": 0, "bytes_received": 0, "bytes_sent": 0, "bytes_fetched": 0}
+
+    def reset_counters(self):
+        with self._lock:
+            for counters in self.counters.values():
+                counters.update(self._new_counters())
+
+    def count(self, service, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.counters[service][name] += amount
+
+    def transfer(self, service, size):
+        # Simulated time on the wire for size bytes
+        delay = self.configs[service].transfer_time(size)
+        if delay:
+            time.sleep(delay)
+
+    # ----- request handling -----
+
+    def admit(self, service):
+        # Returns the Retry-After in ms when this request is throttled, else None after the simulated latency
+        config = self.configs[service]
+        with self._lock:
+            self.counters[service]["requests"] += 1
+            retry_after_ms = config.retry_after_ms if self._rng.random() < config.throttle_rate else None
+            if config.quota_rps and retry_after_ms is None:
+                retry_after_ms = self._take_quota(service, config.quota_rps)
+            if retry_after_ms is not None:
+                self.counters[service]["throttled"] += 1
+            delay = config.delay(self._rng)
+        time.sleep(delay)
+        return retry_after_ms
+
+    def _take_quota(self, service, quota_rps):
+        # One second of burst; returns the ms until the next free slot when the quota is used up
+        tokens, updated = self._quota[service]
+        now = time.monotonic()
+        tokens = quota_rps if tokens is None else min(quota_rps, tokens + (now - updated) * quota_rps)
+        if tokens >= 1:
+            self._quota[service] = (tokens - 1, now)
+            return None
+        self._quota[service] = (tokens, now)
+        return max(1, round((1 - tokens) / quota_rps * 1000))
+
+    def vectorize(self, body, kind):
+        if kind == "vectorizeImage" and isinstance(body, bytes):
+            # Binary input, the embedding follows the image bytes
+            source = hashlib.sha256(body).hexdigest()
+        elif kind == "vectorizeImage":
+            source = body.get("url", "").split("?", 1)[0]
+            # Vision downloads the blob itself, at the blob service's bandwidth
+            data = self.blobs.get(unquote(urlparse(source).path))
+            if data:
+                self.transfer("blob", len(data))
+                self.count("vision", bytes_fetched=len(data))
+        else:
+            source = body.get("text", "")
+        return 200, {"modelVersion": "2023-04-15", "vector": fake_vector(source, self.dimensions)}
+
+    def chat(self, body):
+        question = body["messages"][-1]["content"].rsplit(":", 1)[-1].strip()
+        return 200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-35-turbo"),
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": f"photo of {question}"}, "finish_reason": "stop"}
+            ],
+            "usage": {"prompt_tokens": 50, "completion_tokens": 10, "total_tokens": 60},
+        }
+
+    def index_definition(self, name):
+        # The buffered sender reads the key field from here before its first batch
+        return 200, {
+            "name": name,
+            "fields": [
+                {"name": "id", "type": "Edm.String", "key": True},
+                {"name": "title", "type": "Edm.String"},
+                {"name": "imageUrl", "type": "Edm.String"},
+                {"name": "imageVector", "type": "Collection(Edm.Single)", "dimensions": self.dimensions,
+                 "vectorSearchProfile": "default"},
+            ],
+        }
+
+    def search_documents(self, operation, body):
+        if operation == "search.index":
+            results = []
+            with self._lock:
+                for action in body["value"]:
+                    document = {key: value for key, value in action.items() if not key.startswith("@search.")}
+                    self.documents.setdefault(document["id"], {}).update(document)
+                    results.append({"key": document["id"], "status": True, "errorMessage": None, "statusCode": 200})
+            return 200, {"value": results}
+
+        if operation == "search.post.search":
+            top = body.get("top") or 50
+            skip = body.get("skip") or 0
+            with self._lock:
+                documents = list(self.documents.values())
+            if not documents:
+                # An empty index still answers with plausible hits so /search can be load tested alone
+                documents = [
+                    {"id": f"doc{i}", "title": f"image{i}.png", "imageUrl": self.blob_url(f"image{i}.png")}
+                    for i in range(skip + top)
+                ]
+            select = (body.get("select") or "id,title,imageUrl").split(",")
+            hits = []
+            for rank, document in enumerate(documents[skip:skip + top]):
+                hit = {field: document.get(field) for field in select}
+                hit["@search.score"] = round(0.9 - 0.01 * (skip + rank), 4)
+                hits.append(hit)
+            return 200, {"value": hits}
+
+        return 404, {"error": {"code": "NotFound", "message": f"Unsupported operation {operation}"}}
+
+    def user_delegation_key(self):
+        now = time.gmtime()
+        start = time.strftime("%Y-%m-%dT%H:%M:%SZ", now)
+        expiry = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 86400))
+        value = base64.b64encode(hashlib.sha256(start.encode("ascii")).digest()).decode("ascii")
+        return (
+            "<?xml version=\"1.0\" encoding=\"utf-8\"?><UserDelegationKey>"
+            "<SignedOid>00000000-0000-0000-0000-000000000001</SignedOid>"
+            "<SignedTid>00000000-0000-0000-0000-000000000002</SignedTid>"
+            f"<SignedStart>{start}</SignedStart><SignedExpiry>{expiry}</SignedExpiry>"
+            "<SignedService>b</SignedService><SignedVersion>2024-08-04</SignedVersion>"
+            f"<Value>{value}</Value></UserDelegationKey>"
+        )
+
+
+def _handler(services):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, so the connection pooling of the clients is exercised
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _service(self, path):
+            if path.startswith("/computervision/"):
+                return "vision"
+            if path.startswith("/openai/"):
+                return "openai"
+            if path.startswith("/indexes"):
+                return "search"
+            return "blob"
+
+        def _read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _send(self, status, body=b"", content_type="application/json", headers=None):
+            if not isinstance(body, bytes):
+                body = (json.dumps(body) if content_type == "application/json" else body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                service = self._service(urlparse(self.path).path)
+                services.transfer(service, len(body))
+                services.count(service, bytes_sent=len(body))
+                self.wfile.write(body)
+
+        def _handle(self):
+            parsed = urlparse(self.path)
+            raw_body = self._read_body()
+            service = self._service(parsed.path)
+            services.transfer(service, len(raw_body))
+            services.count(service, bytes_received=len(raw_body))
+            retry_after_ms = services.admit(service)
+            if retry_after_ms is not None:
+                self._send(429, {"error": {"code": "429", "message": "Rate limit exceeded"}}, headers={
+                    "Retry-After": str(max(1, round(retry_after_ms / 1000))),
+                    "retry-after-ms": str(retry_after_ms),
+                })
+                return
+
+            if service == "vision":
+                binary = self.headers.get("Content-Type", "").startswith("application/octet-stream")
+                status, body = services.vectorize(raw_body if binary else json.loads(raw_body or b"{}"),
+                                                  parsed.path.rsplit(":", 1)[-1])
+            elif service == "openai":
+                status, body = services.chat(json.loads(raw_body))
+            elif service == "search":
+                match = _search_path.match(parsed.path)
+                if match is None:
+                    status, body = 404, {"error": {"code": "NotFound", "message": parsed.path}}
+                elif match.group("operation") is None:
+                    status, body = services.index_definition(match.group("quoted") or match.group("plain"))
+                else:
+                    status, body = services.search_documents(match.group("operation"), json.loads(raw_body or b"{}"))
+            else:
+                query = parse_qs(parsed.query)
+                if query.get("comp") == ["userdelegationkey"]:
+                    self._send(200, services.user_delegation_key(), content_type="application/xml")
+                    return
+                etag = '"0x' + hashlib.sha256(parsed.path.encode("utf-8")).hexdigest()[:15].upper() + '"'
+                data = services.blobs.get(unquote(parsed.path), b"")
+                content_type = "image/jpeg" if data[:2] == b"\xff\xd8" else "image/png"
+                self._send(200, data, content_type=content_type, headers={"ETag": etag})
+                return
+            self._send(status, body)
+
+        do_GET = _handle
+        do_POST = _handle
+        do_PUT = _handle
+        do_HEAD = _handle
+
+    return Handler
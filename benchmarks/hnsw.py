@@ -0,0 +1,115 @@
+# Small HNSW graph (Malkov & Yashunin) over L2-normalized vectors with cosine distance, used by
+# benchmarks/tune_vector_index.py when hnswlib is not installed. The parameters mean the same as in
+# Azure AI Search: m links per node on the upper layers (2 * m on layer 0), efConstruction and efSearch
+# candidate lists. Pure Python and numpy, so build a few thousand vectors, not millions.
+import heapq
+import math
+import random
+
+import numpy as np
+
+
+class HNSWIndex:
+    def __init__(self, vectors, m=4, ef_construction=400, seed=0):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.m = max(2, m)
+        self.max_links = {0: 2 * self.m}
+        self.ef_construction = ef_construction
+        self.level_multiplier = 1 / math.log(self.m)
+        self.graph = []
+        self.entry_point = None
+        self.entry_level = 0
+        self.distance_computations = 0
+        self._rng = random.Random(seed)
+        for node in range(len(self.vectors)):
+            self._insert(node)
+
+    def _distances(self, query, nodes):
+        self.distance_computations += len(nodes)
+        return (1.0 - self.vectors[nodes] @ query).tolist()
+
+    def _search_layer(self, query, entry_points, ef, level):
+        # Returns up to ef (distance, node) pairs sorted by distance
+        links = self.graph[level]
+        visited = set(entry_points)
+        distances = self._distances(query, entry_points)
+        candidates = list(zip(distances, entry_points))
+        heapq.heapify(candidates)
+        results = [(-distance, node) for distance, node in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            neighbors = [neighbor for neighbor in links[node] if neighbor not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for neighbor_distance, neighbor in zip(self._distances(query, neighbors), neighbors):
+                if len(results) < ef or neighbor_distance < -results[0][0]:
+                    heapq.heappush(candidates, (neighbor_distance, neighbor))
+                    heapq.heappush(results, (-neighbor_distance, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-distance, node) for distance, node in results)
+
+    def _select_neighbors(self, candidates, count):
+        # Heuristic selection: keep a candidate only if it is closer to the new node than to every
+        # neighbour already kept, which spreads the links over different directions
+        selected = []
+        for distance, node in candidates:
+            if len(selected) >= count:
+                break
+            if selected:
+                self.distance_computations += len(selected)
+                closest_kept = 1.0 - float(np.max(self.vectors[selected] @ self.vectors[node]))
+                if closest_kept < distance:
+                    continue
+            selected.append(node)
+        if len(selected) < count:
+            # Fill up with the nearest skipped candidates, as hnswlib does
+            kept = set(selected)
+            selected += [node for _, node in candidates if node not in kept][:count - len(selected)]
+        return selected
+
+    def _insert(self, node):
+        level = int(-math.log(1.0 - self._rng.random()) * self.level_multiplier)
+        while len(self.graph) <= level:
+            self.graph.append({})
+        for layer in range(level + 1):
+            self.graph[layer][node] = []
+        if self.entry_point is None:
+            self.entry_point, self.entry_level = node, level
+            return
+
+        query = self.vectors[node]
+        entry_points = [self.entry_point]
+        for layer in range(self.entry_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+        for layer in range(min(level, self.entry_level), -1, -1):
+            candidates = self._search_layer(query, entry_points, self.ef_construction, layer)
+            max_links = self.max_links.get(layer, self.m)
+            neighbors = self._select_neighbors(candidates, self.m)
+            self.graph[layer][node] = neighbors
+            for neighbor in neighbors:
+                links = self.graph[layer][neighbor]
+                links.append(node)
+                if len(links) > max_links:
+                    distances = self._distances(self.vectors[neighbor], links)
+                    self.graph[layer][neighbor] = self._select_neighbors(sorted(zip(distances, links)), max_links)
+            entry_points = [node for _, node in candidates]
+        if level > self.entry_level:
+            self.entry_point, self.entry_level = node, level
+
+    def search(self, query, k, ef_search):
+        # Returns the k nearest nodes, best first
+        query = np.asarray(query, dtype=np.float32)
+        entry_points = [self.entry_point]
+        for layer in range(self.entry_level, 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+        return [node for _, node in self._search_layer(query, entry_points, max(ef_search, k), 0)[:k]]
+
+    def link_count(self):
+        return sum(len(links) for layer in self.graph for links in layer.values())
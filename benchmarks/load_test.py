@@ -0,0 +1,250 @@
+# Load test of the real HTTP and Event Grid handlers against local fake services (benchmarks/fake_services.py).
+# Nothing leaves the machine: Vision, OpenAI, Search and Blob are all answered by the fake server.
+#
+# Usage:
+#   python -m benchmarks.load_test --scenario search [--concurrency 16] [--requests 400] [--distinct 50]
+#          [--latency-ms 40] [--jitter-ms 20] [--throttle-rate 0.02] [--service openai:400:200:0.05]
+#          [--quota vision:10]
+#          [--json results.json] [--compare baseline.json --tolerance 0.2]
+#
+# Scenarios: search, vectorize, GetImageEmbeddings, index. --distinct bounds the number of different
+# queries / images, so the caches see a realistic hit rate. --compare exits with 1 when throughput or
+# p95 latency is more than --tolerance worse than a previous --json run.
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_services import SERVICES, FakeAzureServices, FakeServiceConfig
+
+SCENARIOS = ("search", "vectorize", "GetImageEmbeddings", "index")
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def parse_service_override(text):
+    # NAME:LATENCY_MS[:JITTER_MS[:THROTTLE_RATE]]
+    name, *values = text.split(":")
+    if name not in SERVICES:
+        raise argparse.ArgumentTypeError(f"Unknown service '{name}', expected one of {', '.join(SERVICES)}")
+    values = [float(value) for value in values]
+    return name, values
+
+
+def parse_quota(text):
+    name, _, rps = text.partition(":")
+    if name not in SERVICES:
+        raise argparse.ArgumentTypeError(f"Unknown service '{name}', expected one of {', '.join(SERVICES)}")
+    return name, float(rps)
+
+
+def build_scenario(scenario, services, args):
+    # Returns a callable(i) that runs request i through the handler and returns an HTTP status
+    import azure.functions as func
+    import function_app
+
+    def image_values(i):
+        return [
+            {
+                "recordId": str(record),
+                "data": {"imageUrl": services.blob_url(f"image{(i * args.records + record) % args.distinct}.png")},
+            }
+            for record in range(args.records)
+        ]
+
+    def post(route, body, headers=None):
+        return func.HttpRequest("POST", f"/api/{route}", body=json.dumps(body).encode("utf-8"), headers=headers or {})
+
+    if scenario == "search":
+        def run(i):
+            body = {"query": f"pictures of subject {i % args.distinct}", "max_images": args.max_images}
+            if args.fast:
+                body["mode"] = "fast"
+            response = function_app.search(post("search", body, {"Authorization": "Bearer load-test"}))
+            return response.status_code
+    elif scenario == "vectorize":
+        def run(i):
+            return function_app.vectorize(post("vectorize", {"values": image_values(i)})).status_code
+    elif scenario == "GetImageEmbeddings":
+        def run(i):
+            return function_app.GetImageEmbeddings(post("GetImageEmbeddings", {"values": image_values(i)})).status_code
+    else:
+        def run(i):
+            url = services.blob_url(f"image{i % args.distinct}.png")
+            event = func.EventGridEvent(
+                id=f"event-{i}",
+                data={"clientRequestId": f"request-{i}", "url": url, "eTag": f"0x{i % args.distinct:X}"},
+                topic="/subscriptions/load-test/storageAccounts/devaccount",
+                subject=f"/blobServices/default/containers/images/blobs/image{i}.png",
+                event_type="Microsoft.Storage.BlobCreated",
+                event_time=None,
+                data_version="1",
+            )
+            function_app.index(event)
+            return 200
+    return run
+
+
+def drive(run, total, concurrency, offset=0):
+    latencies = []
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+
+    def one(i):
+        started = time.perf_counter()
+        try:
+            status = run(offset + i)
+        except Exception as e:
+            status = "exception"
+            with lock:
+                errors.append(repr(e))
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="load") as executor:
+        list(executor.map(one, range(total)))
+    return time.perf_counter() - started, sorted(latencies), statuses, errors
+
+
+def run_load_test(args):
+    configs = {service: FakeServiceConfig(args.latency_ms, args.jitter_ms, args.throttle_rate) for service in SERVICES}
+    for name, quota_rps in args.quota or []:
+        configs[name].quota_rps = quota_rps
+    for name, values in args.service or []:
+        config = configs[name]
+        config.latency_ms, config.jitter_ms, config.throttle_rate = (
+            values + [config.latency_ms, config.jitter_ms, config.throttle_rate][len(values):]
+        )
+
+    with FakeAzureServices(configs, dimensions=args.dimensions) as services:
+        # Settings are read when the modules are imported, so they are set before the first import
+        os.environ.update(services.environment())
+        os.environ.setdefault("METRICS_LOG_REQUESTS", "false")
+        from helpers import document_writer, metrics, rate_limiter, transport
+
+        run = build_scenario(args.scenario, services, args)
+        if args.warmup:
+            drive(run, args.warmup, args.concurrency, offset=args.requests)
+            if args.scenario == "index":
+                document_writer.flush()
+        metrics.reset()
+        services.reset_counters()
+
+        elapsed, latencies, statuses, errors = drive(run, args.requests, args.concurrency)
+        if args.scenario == "index":
+            # Buffered documents are part of the work being measured
+            flush_started = time.perf_counter()
+            document_writer.flush()
+            elapsed += time.perf_counter() - flush_started
+        # Also stops the sender's auto-flush timer, which would keep the process alive
+        document_writer.close()
+
+        return {
+            "scenario": args.scenario,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_rps": round(args.requests / elapsed, 2),
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50), 2),
+                "p95": round(percentile(latencies, 95), 2),
+                "p99": round(percentile(latencies, 99), 2),
+                "max": round(latencies[-1], 2),
+            },
+            "statuses": {str(status): count for status, count in statuses.items()},
+            "errors": errors[:10],
+            "upstream": services.counters,
+            "transport": transport.stats(),
+            "rate_limiter": rate_limiter.stats(),
+            "stages": metrics.snapshot(),
+        }
+
+
+def print_report(result):
+    latency = result["latency_ms"]
+    print(f"scenario {result['scenario']}: {result['requests']} requests, concurrency {result['concurrency']}, "
+          f"{result['elapsed_seconds']} s")
+    print(f"throughput   {result['throughput_rps']} req/s")
+    print(f"latency ms   p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    print(f"statuses     {result['statuses']}")
+    for error in result["errors"]:
+        print(f"  error: {error}")
+    print("upstream     " + ", ".join(
+        f"{service} {counters['requests']} ({counters['throttled']} throttled)"
+        for service, counters in result["upstream"].items()
+    ))
+    for name, limiter in result["rate_limiter"].items():
+        print(f"{name} limiter rate {limiter['rate']} req/s, {limiter['throttled']} throttled, "
+              f"{limiter['waited']}/{limiter['acquired']} calls waited, max queue {limiter['max_queue_depth']}")
+    print(f"{'stage':<24}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, summary in result["stages"].items():
+        print(f"{stage:<24}{summary['count']:>8}{summary['errors']:>8}"
+              f"{summary['p50_ms'] or 0:>10.1f}{summary['p95_ms'] or 0:>10.1f}{summary['p99_ms'] or 0:>10.1f}")
+
+
+def compare(result, baseline, tolerance):
+    # Returns the list of regressions against a previous run of the same scenario
+    regressions = []
+    if result["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput {result['throughput_rps']} req/s < baseline {baseline['throughput_rps']}")
+    if result["latency_ms"]["p95"] > baseline["latency_ms"]["p95"] * (1 + tolerance):
+        regressions.append(f"p95 {result['latency_ms']['p95']} ms > baseline {baseline['latency_ms']['p95']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the function handlers against local fake services.")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="search")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--distinct", type=int, default=50, help="number of different queries or images")
+    parser.add_argument("--records", type=int, default=4, help="records per vectorize request")
+    parser.add_argument("--max-images", type=int, default=5)
+    parser.add_argument("--fast", action="store_true", help="search with mode=fast")
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--service", type=parse_service_override, action="append",
+                        help="per-service override NAME:LATENCY_MS[:JITTER_MS[:THROTTLE_RATE]]")
+    parser.add_argument("--quota", type=parse_quota, action="append",
+                        help="per-service requests/s quota NAME:RPS, requests beyond it are answered with 429")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="fail on a regression against this --json file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--log-level", default="ERROR", help="log level of the handlers, e.g. WARNING to see retries")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+
+    result = run_load_test(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,343 @@
+# HNSW and vector compression tuning for the imageVector field of artifacts/vector-image-index-db.json.
+# Exact cosine kNN over a sample of the corpus is the ground truth; every combination of m,
+# efConstruction, efSearch and compression (none, int8 scalar or binary quantization, reranked with
+# the original vectors after oversampling, as Azure AI Search does) is then built and queried locally.
+# The report has recall@k, query latency, distance computations and index memory per configuration,
+# and the best configuration that reaches --target-recall is written as an updated index definition.
+#
+# Usage:
+#   python -m benchmarks.tune_vector_index [--local-index DIR | --from-search] [--sample 3000] [--queries 200]
+#          [--m 4,8] [--ef-construction 100,400] [--ef-search 100,400,1000] [--compression none,scalar,binary]
+#          [--k 10] [--target-recall 0.95] [--prefer memory] [--json tuning.json] [--output tuned-index.json]
+#
+# Vectors come from a local index directory (helpers/local_index.py), from the Azure AI Search index
+# (AI_SEARCH_* settings), or are synthetic clusters. Queries are held-out corpus vectors, or text
+# queries embedded with Vision (--query-texts file, one query per line).
+# hnswlib is used when it is installed; the built-in benchmarks/hnsw.py is slower, keep --sample small.
+import argparse
+import copy
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+INDEX_DEFINITION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "artifacts", "vector-image-index-db.json")
+VECTOR_FIELD = "imageVector"
+# Oversampling Azure AI Search applies by default before reranking with the original vectors
+DEFAULT_OVERSAMPLING = {"none": 1, "scalar": 4, "binary": 10}
+# Parameter ranges the service accepts
+AZURE_LIMITS = {"m": (4, 10), "ef_construction": (100, 1000), "ef_search": (100, 1000)}
+COMPRESSIONS = {
+    "scalar": {
+        "name": "myScalarQuantization",
+        "kind": "scalarQuantization",
+        "scalarQuantizationParameters": {"quantizedDataType": "int8"},
+    },
+    "binary": {
+        "name": "myBinaryQuantization",
+        "kind": "binaryQuantization",
+    },
+}
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+# ----- vectors -----
+
+def synthetic_vectors(count, dimensions, clusters=256, spread=2.0, seed=0):
+    # Overlapping Gaussian clusters; real image embeddings are similarly lumpy, and well separated
+    # clusters would flatter every configuration
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimensions))
+    return normalize(centers[rng.integers(0, clusters, count)] + rng.normal(size=(count, dimensions)) * spread)
+
+
+def load_local_index(path):
+    from helpers.local_index import LocalVectorIndex
+
+    return normalize(LocalVectorIndex(path).vectors)
+
+
+def load_from_search(count):
+    from helpers import document_writer
+
+    client = document_writer.get_search_client()
+    vectors = [result[VECTOR_FIELD] for result in client.search(search_text="*", select=[VECTOR_FIELD], top=count)]
+    return normalize(vectors)
+
+
+def embed_query_texts(path):
+    from function_app import generate_embeddings_text
+
+    with open(path, encoding="utf-8") as f:
+        texts = [line.strip() for line in f if line.strip()]
+    return normalize([generate_embeddings_text(text) for text in texts])
+
+
+def split_queries(vectors, query_count, seed=0):
+    # Held-out corpus vectors as queries: (corpus, queries)
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    return vectors[order[query_count:]], vectors[order[:query_count]]
+
+
+def exact_neighbors(corpus, queries, k):
+    scores = queries @ corpus.T
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+# ----- compression -----
+
+def quantize(corpus, compression):
+    # Returns (vectors the graph is built and searched on, bytes per vector in the index)
+    dimensions = corpus.shape[1]
+    if compression == "none":
+        return corpus, dimensions * 4
+    if compression == "scalar":
+        # int8 codes over each dimension's range; the dequantized values carry the quantization error
+        low, high = corpus.min(axis=0), corpus.max(axis=0)
+        scale = np.where(high > low, (high - low) / 255, 1)
+        codes = np.round((corpus - low) / scale)
+        return normalize(codes * scale + low), dimensions
+    if compression == "binary":
+        # One sign bit per dimension; cosine between +-1 vectors ranks exactly like Hamming distance
+        return normalize(np.where(corpus > 0, 1.0, -1.0)), (dimensions + 7) // 8
+    raise ValueError(f"Unknown compression '{compression}'")
+
+
+def quantize_query(query, compression):
+    if compression == "binary":
+        return normalize(np.where(query > 0, 1.0, -1.0))
+    return query
+
+
+# ----- ANN backends -----
+
+class HnswlibBackend:
+    name = "hnswlib"
+
+    def __init__(self, vectors, m, ef_construction):
+        import hnswlib
+
+        self.index = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+        self.index.init_index(max_elements=len(vectors), M=m, ef_construction=ef_construction, random_seed=0)
+        self.index.add_items(vectors, np.arange(len(vectors)), num_threads=1)
+        self.distance_computations = None
+
+    def search(self, query, k, ef_search):
+        self.index.set_ef(max(ef_search, k))
+        labels, _ = self.index.knn_query(query, k=k, num_threads=1)
+        return labels[0].tolist()
+
+
+class BuiltinBackend:
+    name = "builtin"
+
+    def __init__(self, vectors, m, ef_construction):
+        from benchmarks.hnsw import HNSWIndex
+
+        self.index = HNSWIndex(vectors, m=m, ef_construction=ef_construction)
+        self.distance_computations = 0
+
+    def search(self, query, k, ef_search):
+        before = self.index.distance_computations
+        result = self.index.search(query, k, ef_search)
+        self.distance_computations += self.index.distance_computations - before
+        return result
+
+
+def backend_class():
+    try:
+        import hnswlib  # noqa: F401
+    except ImportError:
+        return BuiltinBackend
+    return HnswlibBackend
+
+
+def graph_bytes(count, m):
+    # 4-byte links: 2 * m on layer 0, m on each upper layer, 1 / (m - 1) upper layers per node on average
+    return count * 4 * (2 * m + m / (m - 1))
+
+
+# ----- evaluation -----
+
+def evaluate(corpus, queries, truth, m, ef_construction, ef_searches, compression, k, oversampling, backend):
+    vectors, bytes_per_vector = quantize(corpus, compression)
+    started = time.perf_counter()
+    index = backend(vectors, m, ef_construction)
+    build_seconds = time.perf_counter() - started
+
+    results = []
+    for ef_search in ef_searches:
+        # Oversampled compressed searches return k * oversampling candidates, which needs efSearch >= that
+        candidates = min(len(corpus), max(k, k * oversampling))
+        latencies = []
+        recalls = []
+        computations = index.distance_computations
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            found = index.search(quantize_query(query, compression), candidates, max(ef_search, candidates))
+            if compression != "none":
+                # Rerank the oversampled candidates with the original vectors
+                found = np.asarray(found)[np.argsort(-(corpus[found] @ query))][:k]
+            latencies.append((time.perf_counter() - started) * 1000)
+            recalls.append(len(set(np.asarray(found[:k]).tolist()) & set(expected.tolist())) / k)
+        latencies.sort()
+        vector_bytes = len(corpus) * bytes_per_vector
+        index_bytes = vector_bytes + graph_bytes(len(corpus), m)
+        results.append({
+            "m": m,
+            "efConstruction": ef_construction,
+            "efSearch": ef_search,
+            "compression": compression,
+            "oversampling": oversampling if compression != "none" else None,
+            f"recall@{k}": round(statistics.mean(recalls), 4),
+            "latency_p50_ms": round(latencies[len(latencies) // 2], 3),
+            "latency_p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+            "distance_computations": (round((index.distance_computations - computations) / len(queries))
+                                      if index.distance_computations is not None else None),
+            "build_seconds": round(build_seconds, 2),
+            "vector_mb": round(vector_bytes / 2 ** 20, 3),
+            "index_mb": round(index_bytes / 2 ** 20, 3),
+            # Per million documents, the number that matters for the vector index size quota
+            "index_mb_per_million": round(index_bytes / len(corpus) * 1_000_000 / 2 ** 20, 1),
+        })
+    return results
+
+
+def recommend(results, k, target_recall, prefer):
+    recall_key = f"recall@{k}"
+    passing = [result for result in results if result[recall_key] >= target_recall]
+    if not passing:
+        return max(results, key=lambda result: result[recall_key])
+    if prefer == "memory":
+        return min(passing, key=lambda result: (result["index_mb"], result["latency_p50_ms"]))
+    return min(passing, key=lambda result: (result["latency_p50_ms"], result["index_mb"]))
+
+
+def tuned_index_definition(definition, result):
+    # The index definition with the chosen HNSW parameters and compression on the imageVector profile
+    definition = copy.deepcopy(definition)
+    for key in [key for key in definition if key.startswith("@odata.")]:
+        del definition[key]
+    vector_search = definition["vectorSearch"]
+    field = next(field for field in definition["fields"] if field["name"] == VECTOR_FIELD)
+    profile = next(profile for profile in vector_search["profiles"] if profile["name"] == field["vectorSearchProfile"])
+    algorithm = next(algorithm for algorithm in vector_search["algorithms"] if algorithm["name"] == profile["algorithm"])
+    algorithm["hnswParameters"].update(m=result["m"], efConstruction=result["efConstruction"],
+                                       efSearch=result["efSearch"])
+
+    compressions = [compression for compression in vector_search.get("compressions") or []
+                    if compression["name"] not in {option["name"] for option in COMPRESSIONS.values()}]
+    profile["compression"] = None
+    if result["compression"] != "none":
+        compression = dict(COMPRESSIONS[result["compression"]], rerankWithOriginalVectors=True,
+                           defaultOversampling=result["oversampling"])
+        compressions.append(compression)
+        profile["compression"] = compression["name"]
+    vector_search["compressions"] = compressions
+    return definition
+
+
+def print_report(results, k, recommended):
+    recall_key = f"recall@{k}"
+    print(f"{'m':>3}{'efC':>6}{'efS':>6}  {'compression':<12}{recall_key:>11}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'dist/query':>12}{'index MB':>10}{'MB/1M docs':>12}")
+    for result in results:
+        marker = "  <- recommended" if result is recommended else ""
+        computations = result["distance_computations"]
+        print(f"{result['m']:>3}{result['efConstruction']:>6}{result['efSearch']:>6}  {result['compression']:<12}"
+              f"{result[recall_key]:>11.4f}{result['latency_p50_ms']:>9.3f}{result['latency_p95_ms']:>9.3f}"
+              f"{computations if computations is not None else '-':>12}{result['index_mb']:>10.2f}"
+              f"{result['index_mb_per_million']:>12.0f}{marker}")
+
+
+def integers(text):
+    return [int(value) for value in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tune HNSW and compression settings of the image vector index.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--local-index", help="read the corpus from a local index directory")
+    source.add_argument("--from-search", action="store_true", help="read the corpus from the Azure AI Search index")
+    parser.add_argument("--sample", type=int, default=3000, help="corpus vectors to index")
+    parser.add_argument("--queries", type=int, default=200, help="held-out corpus vectors used as queries")
+    parser.add_argument("--query-texts", help="file of text queries to embed with Vision instead")
+    parser.add_argument("--dimensions", type=int, default=1024, help="dimensions of synthetic vectors")
+    parser.add_argument("--m", type=integers, default=[4, 8])
+    parser.add_argument("--ef-construction", type=integers, default=[100, 400])
+    parser.add_argument("--ef-search", type=integers, default=[100, 400, 1000])
+    parser.add_argument("--compression", default="none,scalar,binary")
+    parser.add_argument("--oversampling", type=int, help="override the default oversampling of compressed profiles")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--prefer", choices=("memory", "latency"), default="memory",
+                        help="what to minimize among configurations that reach the target recall")
+    parser.add_argument("--index-definition", default=INDEX_DEFINITION)
+    parser.add_argument("--json", help="write all results to this file")
+    parser.add_argument("--output", help="write the tuned index definition to this file")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    for name, (low, high) in AZURE_LIMITS.items():
+        outside = [value for value in getattr(args, name) if not low <= value <= high]
+        if outside:
+            parser.error(f"--{name.replace('_', '-')} {outside} outside the {low}-{high} Azure AI Search accepts")
+    unknown = set(args.compression.split(",")) - set(DEFAULT_OVERSAMPLING)
+    if unknown:
+        parser.error(f"Unknown --compression {sorted(unknown)}, expected none, scalar or binary")
+
+    query_vectors = None
+    if args.local_index:
+        vectors = load_local_index(args.local_index)
+    elif args.from_search:
+        vectors = load_from_search(args.sample + (0 if args.query_texts else args.queries))
+    else:
+        vectors = synthetic_vectors(args.sample + args.queries, args.dimensions)
+    if args.query_texts:
+        query_vectors = embed_query_texts(args.query_texts)
+        corpus = vectors[:args.sample]
+    else:
+        corpus, query_vectors = split_queries(vectors[:args.sample + args.queries], args.queries)
+    truth = exact_neighbors(corpus, query_vectors, args.k)
+
+    backend = backend_class()
+    print(f"{len(corpus)} vectors of {corpus.shape[1]} dimensions, {len(query_vectors)} queries, "
+          f"recall@{args.k} against exact cosine kNN, {backend.name} HNSW")
+    results = []
+    for compression in args.compression.split(","):
+        oversampling = args.oversampling or DEFAULT_OVERSAMPLING[compression]
+        for m in args.m:
+            for ef_construction in args.ef_construction:
+                results += evaluate(corpus, query_vectors, truth, m, ef_construction, args.ef_search, compression,
+                                    args.k, oversampling, backend)
+    recommended = recommend(results, args.k, args.target_recall, args.prefer)
+    print_report(results, args.k, recommended)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"k": args.k, "corpus": len(corpus), "queries": len(query_vectors), "backend": backend.name,
+                       "results": results, "recommended": recommended}, f, indent=2)
+    if args.output:
+        with open(args.index_definition, encoding="utf-8") as f:
+            definition = json.load(f)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(tuned_index_definition(definition, recommended), f, indent=2)
+        print(f"tuned index definition written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,22 @@
+import asyncio
 import base64
 import os
 import random
 import azure.functions as func
 import logging
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from openai import AzureOpenAI
-import requests
 import json
+import threading
 import time
-from azure.search.documents.models import VectorizedQuery
-from helpers import helper_functions
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from helpers import (async_transport, dedupe, document_writer, embedding_cache, helper_functions, image_input,
+                     image_preprocess, ingest_queue, metrics, payload_log, query_cache, rate_limiter, search_backends,
+                     search_paging, transport, vector_codec)
 
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
-search_client: SearchClient = None
-chat_client: AzureOpenAI = None
+# Created by the first search that needs it; importing openai alone costs about half a second of cold start
+chat_client = None
+_chat_client_lock = threading.Lock()
 
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -26,6 +27,25 @@ AI_VISION_API_KEY = os.getenv("AI_VISION_API_KEY")
 AI_SEARCH_SERVICE_ENDPOINT = os.getenv("AI_SEARCH_SERVICE_ENDPOINT")
 AZURE_SEARCH_ADMIN_KEY = os.getenv("AZURE_SEARCH_ADMIN_KEY")
 AI_SEARCH_INDEX_NAME = os.getenv("AI_SEARCH_INDEX_NAME")
+# Upper bound on records vectorized concurrently within one skillset batch
+VECTORIZE_MAX_WORKERS = int(os.getenv("VECTORIZE_MAX_WORKERS", "8"))
+# Default latency budget of the fast search mode for the OpenAI rephrase path
+SEARCH_LATENCY_BUDGET_MS = int(os.getenv("SEARCH_LATENCY_BUDGET_MS", "800"))
+# Upper bounds on the queries of one /search/batch request and on the queries resolved concurrently
+SEARCH_BATCH_MAX_QUERIES = int(os.getenv("SEARCH_BATCH_MAX_QUERIES", "20"))
+SEARCH_BATCH_MAX_WORKERS = int(os.getenv("SEARCH_BATCH_MAX_WORKERS", "8"))
+# NCRONTAB schedule of the local ingest queue drain, only registered with INGEST_QUEUE=memory or sqlite
+INGEST_DRAIN_SCHEDULE = os.getenv("INGEST_DRAIN_SCHEDULE", "*/10 * * * * *")
+
+# Shared by the concurrent stages of a search
+search_stage_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_STAGE_WORKERS", "16")),
+                                           thread_name_prefix="search-stage")
+# Background rephrases of fast searches have a pool of their own: one that misses its budget keeps
+# running and warms the query cache, but never delays another search. Each takes a slot, and with all
+# SEARCH_REPHRASE_WORKERS slots taken fast searches use the raw query rather than queue a rephrase.
+SEARCH_REPHRASE_WORKERS = int(os.getenv("SEARCH_REPHRASE_WORKERS", "8"))
+rephrase_executor = ThreadPoolExecutor(max_workers=SEARCH_REPHRASE_WORKERS, thread_name_prefix="search-rephrase")
+rephrase_slots = threading.BoundedSemaphore(SEARCH_REPHRASE_WORKERS)
 
 logging.info(f"AOAI endpoint ==> {AZURE_OPENAI_ENDPOINT}")
 logging.info(f"AI_VISION_ENDPOINT endpoint ==> {AI_VISION_ENDPOINT}")
@@ -46,7 +66,7 @@ def test(req: func.HttpRequest) -> func.HttpResponse:
     logging.info(f"test HttpRequest triggered: {vision_url}")
     headers = {"Ocp-Apim-Subscription-Key": AI_VISION_API_KEY}
 
-    response = requests.get(vision_url, headers=headers)
+    response = transport.get(vision_url, headers=headers)
     if response.status_code == 200:
         return response.json()
 
@@ -54,66 +74,274 @@ def test(req: func.HttpRequest) -> func.HttpResponse:
                              status_code=response.status_code, mimetype="text/plain")
 
 
-@app.function_name(name="index")
-@app.event_grid_trigger(arg_name="event")
-def index(event: func.EventGridEvent):
-    result = json.dumps({
-        'id': event.id,
-        'data': event.get_json(),
-        'topic': event.topic,
-        'subject': event.subject,
-        'event_type': event.event_type,
-    })
-    logging.info('index EventGrid trigger processed an event: %s', result)
+@app.function_name(name="stats")
+@app.route(route="stats", methods=["GET"])
+def stats(req: func.HttpRequest) -> func.HttpResponse:
+    # Cache effectiveness and transport counters for this worker
+    body = {
+        "query_cache": query_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "sas_cache": dict(helper_functions.sas_cache_stats),
+        "transport": transport.stats(),
+        "document_writer": dict(document_writer.writer_stats),
+        "image_preprocess": image_preprocess.stats(),
+        "image_input": image_input.stats(),
+        "dedupe": dedupe.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "async_transport": async_transport.stats(),
+        "ingest_queue": ingest_queue.stats(),
+    }
+    return func.HttpResponse(json.dumps(body), mimetype="application/json")
 
-    event_json = event.get_json()  # This gives you the event data as a dictionary.
-    
-    # Access 'clientRequestId' and 'url' directly from the event's JSON.
-    client_request_id = event_json["clientRequestId"]
-    image_url = event_json["url"]
-    
-    # Construct the desired JSON structure with the extracted values.
-    event_data = {
-        "recordId": client_request_id,
-        "data": {
-            "imageUrl": image_url
-        }
+
+@app.function_name(name="metrics")
+@app.route(route="metrics", methods=["GET"])
+def stage_metrics(req: func.HttpRequest) -> func.HttpResponse:
+    # Per-stage count, error rate and p50/p95/p99 latency of this worker; ?reset=true starts a new window
+    body = metrics.snapshot()
+    if req.params.get("reset", "").lower() == "true":
+        metrics.reset()
+    return func.HttpResponse(json.dumps(body), mimetype="application/json")
+
+
+if ingest_queue.INGEST_QUEUE == "storage":
+    @app.function_name(name="index")
+    @app.event_grid_trigger(arg_name="event")
+    @app.queue_output(arg_name="ingest", queue_name=ingest_queue.INGEST_QUEUE_NAME,
+                      connection=ingest_queue.INGEST_QUEUE_CONNECTION)
+    def index(event: func.EventGridEvent, ingest: func.Out[str]) -> None:
+        # Subscriptions still delivering to this function are forwarded to the ingest queue, so the
+        # ingest trigger is the only one that indexes
+        with metrics.track_request("index"):
+            ingest.set(json.dumps(event_message(event)))
+else:
+    @app.function_name(name="index")
+    @app.event_grid_trigger(arg_name="event")
+    def index(event: func.EventGridEvent):
+        # The Python Event Grid trigger is invoked once per event
+        events = [event]
+        with metrics.track_request("index"):
+            if ingest_queue.get_queue() is not None:
+                # Only queued here, ingest_drain vectorizes and indexes at a bounded concurrency
+                enqueue_events(events)
+            else:
+                index_events(events)
+
+
+def event_message(event):
+    # The event in the Event Grid schema, as Event Grid writes it to a storage queue
+    return {
+        "id": event.id,
+        "topic": event.topic,
+        "subject": event.subject,
+        "eventType": event.event_type,
+        "eventTime": event.event_time.isoformat() if event.event_time else None,
+        "dataVersion": event.data_version,
+        "data": event.get_json(),
     }
-    
-    logging.info(f"EventGrid trigger processed an event: {event_data}")    
 
-    values = [event_data]
-    response_values = vectorize_images(values)
 
-    # Create the response object
-    response_body = {"IndexRaw values": response_values}
-    logging.info(f"IndexRaw Response body: {response_body}")
-
-    global search_client
-    if search_client is None:
-        logging.info(f"Creating search client. AI_SEARCH_SERVICE_ENDPOINT: {AI_SEARCH_SERVICE_ENDPOINT}, AI_SEARCH_INDEX_NAME: {AI_SEARCH_INDEX_NAME}, AZURE_SEARCH_ADMIN_KEY: {AZURE_SEARCH_ADMIN_KEY}")
-        search_client = SearchClient(
-            AI_SEARCH_SERVICE_ENDPOINT,
-            AI_SEARCH_INDEX_NAME,
-            AzureKeyCredential(AZURE_SEARCH_ADMIN_KEY),
-        )
+def enqueue_events(events):
+    items = []
+    for event in events:
+        event_json = event.get_json()
+        items.append({
+            "url": event_json["url"],
+            "eTag": event_json.get("eTag"),
+            "sequencer": event_json.get("sequencer"),
+            "recordId": event_json.get("clientRequestId"),
+        })
+    try:
+        ingest_queue.get_queue().put(items)
+    except ingest_queue.QueueFull as e:
+        # Failing the invocation makes Event Grid redeliver the events later, with its own backoff
+        logging.warning(f"Rejecting {len(items)} events: {e}")
+        raise
+    logging.info(f"Queued {len(items)} blobs for ingestion")
+
+
+def drain_ingest_queue():
+    if ingest_queue.get_queue() is None:
+        return
+    with metrics.track_request("ingest_drain"):
+        result = ingest_queue.drain(process_ingest_batch)
+    if result["batches"]:
+        logging.info(f"Ingest drain: {result}, queue: {ingest_queue.stats()}")
+
+
+if ingest_queue.INGEST_QUEUE in ingest_queue.LOCAL_QUEUES:
+    @app.function_name(name="ingest_drain")
+    @app.timer_trigger(schedule=INGEST_DRAIN_SCHEDULE, arg_name="timer", run_on_startup=False, use_monitor=False)
+    def ingest_drain(timer: func.TimerRequest) -> None:
+        drain_ingest_queue()
+
+
+if ingest_queue.INGEST_QUEUE == "storage":
+    @app.function_name(name="ingest")
+    @app.queue_trigger(arg_name="message", queue_name=ingest_queue.INGEST_QUEUE_NAME,
+                       connection=ingest_queue.INGEST_QUEUE_CONNECTION)
+    def ingest(message: func.QueueMessage) -> None:
+        with metrics.track_request("ingest"):
+            process_ingest_message(message.get_json(), message.dequeue_count, message.id)
+
+
+def process_ingest_message(event, dequeue_count=1, message_id=None):
+    # One Event Grid event (Event Grid or CloudEvents schema) from the storage ingest queue. Raising
+    # leaves the message to the host, which retries it after the visibility timeout and moves it to the
+    # poison queue after maxDequeueCount attempts (host.json).
+    event_type = event.get("eventType") or event.get("type")
+    if event_type and event_type != "Microsoft.Storage.BlobCreated":
+        logging.info(f"Ingest: skipping {event_type} event {event.get('id')}")
+        return
+    data = event.get("data") or {}
+    item = {"url": data["url"], "eTag": data.get("eTag"), "sequencer": data.get("sequencer"),
+            "recordId": data.get("clientRequestId")}
+    message = ingest_queue.Message(message_id or event.get("id") or data["url"], item, dequeue_count - 1)
+    error = process_ingest_batch([message]).get(message.id, "not processed")
+    if error is not None:
+        raise RuntimeError(f"Ingesting {item['url']} failed (attempt {dequeue_count}): {error}")
+
+
+def process_ingest_batch(messages):
+    # Vectorizes and indexes one leased batch. Returns {message id: error or None}; a message only
+    # counts as done once its document is confirmed by the index.
+    values = [
+        {"recordId": message.id, "data": {"imageUrl": message.item["url"], "eTag": message.item.get("eTag")}}
+        for message in messages
+    ]
+    response_values = vectorize_images(values, max_workers=ingest_queue.INGEST_CONCURRENCY, dedupe_ingest=True)
+
+    errors = {}
+    documents = {}
+    for response_value in response_values:
+        message_id = response_value["recordId"]
+        if response_value["errors"]:
+            errors[message_id] = response_value["errors"]
+            continue
+        data = response_value["data"]
+        if data.get("duplicateOf"):
+            # Near-duplicate of an indexed document, which already answers searches for it
+            errors[message_id] = None
+            continue
+        try:
+            document = document_writer.to_document(data["imageUrl"], data["imageVector"])
+        except ValueError as e:
+            errors[message_id] = str(e)
+            continue
+        # An expired lease can put two messages of one blob into the same batch
+        documents.setdefault(document["id"], (document, []))[1].append(message_id)
+
+    if documents:
+        with metrics.stage("index_upload"):
+            succeeded, failed = document_writer.index_batch([document for document, _ in documents.values()])
+        for document_id in succeeded:
+            for message_id in documents[document_id][1]:
+                errors[message_id] = None
+        for document_id, error in failed:
+            for message_id in documents[document_id][1]:
+                errors[message_id] = error or "indexing failed"
+    return errors
+
+
+@app.function_name(name="ingest_poison")
+@app.route(route="ingest/poison", methods=["GET", "POST"])
+def ingest_poison(req: func.HttpRequest) -> func.HttpResponse:
+    # GET lists the poison queue, POST moves its messages (all, or {"ids": [...]}) back to the ingest queue
+    queue = ingest_queue.get_queue()
+    if queue is None:
+        if ingest_queue.INGEST_QUEUE == "storage":
+            error = f"Poison messages are in the storage queue {ingest_queue.INGEST_QUEUE_NAME}-poison"
+        else:
+            error = "INGEST_QUEUE is not enabled"
+        return func.HttpResponse(json.dumps({"error": error}), status_code=404, mimetype="application/json")
+    if req.method == "POST":
+        body = req.get_body()
+        ids = json.loads(body).get("ids") if body else None
+        return func.HttpResponse(json.dumps({"requeued": queue.requeue_poison(ids)}), mimetype="application/json")
+    limit = int(req.params.get("limit", "100"))
+    return func.HttpResponse(json.dumps({"poison": queue.poison(limit)}), mimetype="application/json")
+
+
+def index_events(events):
+    # Raising fails the invocation, and Event Grid redelivers the event with its retry policy and, once
+    # that is used up, dead-letters it if the subscription has a dead-letter destination
+    values = []
+    for event in events:
+        payload_log.log_payload('index EventGrid trigger processed an event', lambda: {
+            'id': event.id,
+            'data': event.get_json(),
+            'topic': event.topic,
+            'subject': event.subject,
+            'event_type': event.event_type,
+        })
+
+        event_json = event.get_json()  # This gives you the event data as a dictionary.
+        if not event_json.get("url"):
+            logging.error(f"Skipping event {event.id} without a blob url")
+            continue
+
+        # Construct the desired JSON structure with the extracted values.
+        # The eTag lets vectorize_image skip Vision when this exact content was embedded before.
+        event_data = {
+            "recordId": event_json.get("clientRequestId") or event.id,
+            "data": {
+                "imageUrl": event_json["url"],
+                "eTag": event_json.get("eTag")
+            }
+        }
+
+        values.append(event_data)
+
+    response_values = vectorize_images(values, dedupe_ingest=True)
 
     # [START upload_document]
-    doc = {
-        "id": image_url,
-        "imageUrl": image_url,
-        "imageVector": json.dumps(response_values),
-        "title": "Azure Inn",
-    }
+    failed = []
+    documents = []
+    for response_value in response_values:
+        if response_value["errors"]:
+            failed.append((response_value["recordId"], response_value["errors"]))
+            continue
+        data = response_value["data"]
+        if data.get("duplicateOf"):
+            # Near-duplicate of an indexed document, which already answers searches for it
+            continue
+        try:
+            documents.append(document_writer.to_document(data["imageUrl"], data["imageVector"]))
+        except ValueError as e:
+            logging.error(f"Skipping index upload for record {response_value['recordId']}: {e}")
 
-    result = search_client.upload_documents(documents=[doc])
-    logging.info(f"Upload documents result: {result}")
+    # Sent in the writer's batches, but only returns once the index has answered for these documents
+    if documents:
+        with metrics.stage("index_upload"):
+            failed += document_writer.upload(documents)
+    if failed:
+        raise RuntimeError(f"Indexing failed for {len(failed)} of {len(values)} records: {failed}")
+    logging.info(f"Indexed {len(documents)} documents: {document_writer.writer_stats}")
 
 
-@app.route(route="indexraw", methods=["GET"])
+@app.route(route="indexraw", methods=["GET", "POST"])
+@metrics.timed_request("indexraw")
 def index_raw(req: func.HttpRequest) -> func.HttpResponse:
     image_url = req.params.get('url')
     record_id = req.params.get('id') or random.randint(1, 1000)
+    if req.method == "POST":
+        # The image in the body, ?url= optionally names the blob it belongs to
+        try:
+            values = image_input.binary_values(req, record_id, image_url)
+        except image_input.PayloadTooLarge as e:
+            return func.HttpResponse(str(e), status_code=413, mimetype="text/plain")
+        except ValueError as e:
+            return func.HttpResponse(str(e), status_code=400, mimetype="text/plain")
+        if values is None:
+            return func.HttpResponse("POST an image/*, application/octet-stream or multipart/form-data body",
+                                     status_code=415, mimetype="text/plain")
+        payload_log.log_payload("HttpRequest trigger processed an event", values)
+        response_values = vectorize_images(values)
+
+        response_body = {"IndexRaw values": response_values}
+        payload_log.log_payload("IndexRaw Response body", response_body)
+        return func.HttpResponse(vector_codec.dumps(response_body), mimetype="application/json")
+
     event_data = {
         "recordId": record_id,
         "data": {
@@ -121,14 +349,15 @@ def index_raw(req: func.HttpRequest) -> func.HttpResponse:
         }
     }
     
-    logging.info(f"HttpRequest trigger processed an event: {event_data}")
+    payload_log.log_payload("HttpRequest trigger processed an event", event_data)
     values = [event_data]
+    # Nothing is uploaded here, so the image is not checked against (nor added to) the dedupe index
     response_values = vectorize_images(values)
 
     # Create the response object
     response_body = {"IndexRaw values": response_values}
-    logging.info(f"IndexRaw Response body: {response_body}")
-    return func.HttpResponse(json.dumps(response_body), mimetype="application/json")
+    payload_log.log_payload("IndexRaw Response body", response_body)
+    return func.HttpResponse(vector_codec.dumps(response_body), mimetype="application/json")
 
 
 def index_url(image_url: str, record_id: int = random.randint(1, 1000)):
@@ -139,224 +368,630 @@ def index_url(image_url: str, record_id: int = random.randint(1, 1000)):
         }
     }
     
-    logging.info(f"HttpRequest trigger processed an event: {event_data}")
+    payload_log.log_payload("HttpRequest trigger processed an event", event_data)
     values = [event_data]
     vector = vectorize_images(values)
 
-    logging.info('vector event: %s', vector)
+    payload_log.log_payload("vector event", vector)
     return vector
 
 
 @app.route(route="GetImageEmbeddings")
+@metrics.timed_request("getimageembeddings")
 def GetImageEmbeddings(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('> GetImageEmbeddings:Python HTTP trigger function processed a request.')  
  
     # Extract values from request payload  
     req_body = req.get_body().decode('utf-8')  
-    logging.info(f"Request body: {req_body}")  
     request = json.loads(req_body)  
+    payload_log.log_payload("Request body", request)
     values = request['values']  
  
-    # Process values and generate the response payload  
-    response_values = []  
-    for value in values:  
-        imageUrl = value['data']['imageUrl']  
-        recordId = value['recordId']  
-        logging.info(f"Input imageUrl: {imageUrl}")  
-        logging.info(f"Input recordId: {recordId}")  
- 
-        #TODO Add SaS token to imageUrl for non-public containers
-        # Get image embeddings  
-        sas_token = helper_functions.create_service_sas_blob(imageUrl)
+    vector_format = req.params.get("vectorFormat", "json")
+    if vector_format not in vector_codec.VECTOR_FORMATS:
+        return func.HttpResponse(f"Unknown vectorFormat '{vector_format}'", status_code=400, mimetype="text/plain")
 
-        vector = helper_functions.get_image_embeddings(imageUrl, sas_token)  
- 
-        # Add the processed value to the response payload  
-        response_values.append({  
-            "recordId": recordId,  
-            "data": {  
-                "vector": vector  
-            },  
-            "errors": None,  
-            "warnings": None  
-        })  
+    # Same execution path as /vectorize, only the output field is named differently
+    response_values = vectorize_images(values, vector_field="vector", include_url=False, vector_format=vector_format)
  
     # Create the response object  
     response_body = {  
         "values": response_values  
     }  
 
-    logging.info(f"Response body: {response_body}")  
+    payload_log.log_payload("Response body", response_body)
  
     # Return the response  
-    return func.HttpResponse(json.dumps(response_body), mimetype="application/json") 
+    return func.HttpResponse(vector_codec.dumps(response_body), mimetype="application/json") 
 
 @app.function_name(name="vectorize")
 @app.route(route="vectorize", methods=["POST"])
+@metrics.timed_request("vectorize")
 def vectorize(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("GetImageEmbeddings:Python HTTP trigger function processed a request.")
 
-    # Extract values from request payload
-    req_body = req.get_body().decode("utf-8")
-    logging.info(f"Request body: {req_body}")
-    request = json.loads(req_body)
-    values = request["values"]
-    response_values = vectorize_images(values)    
+    # Opt-in compact vectors for non-indexer callers: ?vectorFormat=base64 or int8
+    vector_format = req.params.get("vectorFormat", "json")
+    if vector_format not in vector_codec.VECTOR_FORMATS:
+        return func.HttpResponse(f"Unknown vectorFormat '{vector_format}'", status_code=400, mimetype="text/plain")
+
+    # Extract values from request payload: skill records, or images in a binary or multipart body
+    try:
+        values = read_image_values(req, req.params.get("id") or "1", req.params.get("url"))
+    except image_input.PayloadTooLarge as e:
+        return func.HttpResponse(str(e), status_code=413, mimetype="text/plain")
+    except ValueError as e:
+        return func.HttpResponse(str(e), status_code=400, mimetype="text/plain")
+    payload_log.log_payload("Request body", {"values": values})
+    response_values = vectorize_images(values, vector_format=vector_format)
 
     # Create the response object
     response_body = {  
         "values": response_values  
     }  
-    logging.info(f"Vectorize Response body: {response_body}")
+    payload_log.log_payload("Vectorize Response body", response_body)
 
     # Return the response
-    return func.HttpResponse(json.dumps(response_body), mimetype="application/json")
+    return func.HttpResponse(vector_codec.dumps(response_body), mimetype="application/json")
 
 
 @app.function_name(name="search")
 @app.route(route="search", methods=["POST"])
+@metrics.timed_request("search")
 def search(req: func.HttpRequest) -> func.HttpResponse:
     logging.info(f"Searching...")
-    data = req.get_json()
-    logging.info(f"Input data: {data}")
-
     try:
-        user_query = data["query"]
-    except KeyError:
-        return json.dumps({"error": "The 'query' parameter is required"}), 400
-    # query = data.get('query', "woman with computer")
-    max_images = data.get("max_images", 5)
+        search_request = read_search_request(req)
+    except ValueError as e:
+        return func.HttpResponse(json.dumps({"error": str(e)}), status_code=400, mimetype="application/json")
 
-    query = ask_openai(user_query)
-    logging.info(f"Rephrased query: {query}")
+    if search_request["vector"] is None:
+        # "mode": "fast" races the rephrase against a latency budget, "rephrase": false skips it
+        search_request["query"], search_request["vector"], search_request["query_path"] = resolve_query_vector(
+            search_request["user_query"], **search_request["resolve_options"]
+        )
+        logging.debug("Rephrased query: %s (path: %s)", search_request["query"], search_request["query_path"])
 
-    vector_query = VectorizedQuery(
-        vector=generate_embeddings_text(query),
-        k_nearest_neighbors=max_images,
-        fields="imageVector",
-    )
+    # Perform vector search on the configured backend (remote index, local index or hot set)
+    backend = search_backends.get_backend()
+    if search_request["paginated"]:
+        backend = backend.paged()
+    with metrics.stage("search_backend"):
+        results = backend.search(
+            search_request["vector"], search_request["page_size"], search_request["offset"]
+        )
 
-    ssrc = time.time()
-    # Perform vector search
-    global search_client
-    if search_client is None:
-        logging.info(f"Creating search client. AI_SEARCH_SERVICE_ENDPOINT: {AI_SEARCH_SERVICE_ENDPOINT}, AI_SEARCH_INDEX_NAME: {AI_SEARCH_INDEX_NAME}, AZURE_SEARCH_ADMIN_KEY: {AZURE_SEARCH_ADMIN_KEY}")
-        search_client = SearchClient(
-            AI_SEARCH_SERVICE_ENDPOINT,
-            AI_SEARCH_INDEX_NAME,
-            AzureKeyCredential(AZURE_SEARCH_ADMIN_KEY),
+    auth_header = req.headers.get('Authorization')
+    output = [sign_search_result(result, auth_header) for result in results]
+    return search_response(search_request, results, output)
+
+
+@app.function_name(name="search_async")
+@app.route(route="search/async", methods=["POST"])
+@metrics.timed_request("search_async")
+async def search_async(req: func.HttpRequest) -> func.HttpResponse:
+    # Same request and response as /search, on the worker's event loop: the OpenAI, Vision, Search and
+    # delegation key calls are awaited instead of holding a thread each, and results are signed concurrently
+    try:
+        search_request = read_search_request(req)
+    except ValueError as e:
+        return func.HttpResponse(json.dumps({"error": str(e)}), status_code=400, mimetype="application/json")
+
+    if search_request["vector"] is None:
+        search_request["query"], search_request["vector"], search_request["query_path"] = \
+            await resolve_query_vector_async(search_request["user_query"], **search_request["resolve_options"])
+
+    backend = search_backends.get_backend()
+    if search_request["paginated"]:
+        backend = backend.paged()
+    with metrics.stage("search_backend"):
+        results = await backend.search_async(
+            search_request["vector"], search_request["page_size"], search_request["offset"]
         )
 
-    results = search_client.search(
-        search_text=None, vector_queries=[vector_query], select=["title", "imageUrl"]
+    auth_header = req.headers.get('Authorization')
+    output = await asyncio.gather(*(sign_search_result_async(result, auth_header) for result in results))
+    return search_response(search_request, results, output)
+
+
+def read_search_request(req):
+    # The parsed /search body. "vector" is None until the query is resolved, unless a cursor carries it.
+    # Raises ValueError for a request that must be answered with 400.
+    data = req.get_json()
+    payload_log.log_payload("Input data", data)
+
+    # Optional paging: "page_size" starts a paginated search, "cursor" continues one and
+    # "stream" (or Accept: application/x-ndjson) returns one NDJSON line per signed result.
+    # The NDJSON body is built in full before it is sent, as every other response; the
+    # Functions Python worker has no streamed HTTP responses without the FastAPI extension.
+    cursor = data.get("cursor")
+    stream = data.get("stream", False) or "application/x-ndjson" in (req.headers.get("Accept") or "")
+    search_request = {
+        "stream": stream,
+        "paginated": stream or cursor is not None or "page_size" in data,
+        "vector": None,
+        "query": None,
+        "query_path": None,
+    }
+
+    if cursor:
+        # Later pages reuse the query vector carried by the cursor, no rephrase or embedding
+        vector, offset, page_size, query = search_paging.decode_cursor(cursor)
+        search_request.update(vector=vector, offset=offset, page_size=page_size, query=query, query_path="cursor")
+        return search_request
+
+    if "query" not in data:
+        raise ValueError("The 'query' parameter is required")
+    # query = data.get('query', "woman with computer")
+    page_size = read_count(data.get("page_size", data.get("max_images", 5)),
+                           "'page_size' and 'max_images' must be integers of at least 1")
+    search_request.update(
+        user_query=data["query"],
+        page_size=min(page_size, search_paging.SEARCH_MAX_RESULTS),
+        offset=0,
+        resolve_options=read_resolve_options(data),
     )
+    return search_request
+
+
+def read_count(value, message):
+    # A page size or image count of a request, ValueError(message) unless it is an integer of at least 1
+    try:
+        count = int(value) if not isinstance(value, bool) else 0
+    except (TypeError, ValueError):
+        count = 0
+    if count < 1:
+        raise ValueError(message)
+    return count
+
+
+def read_resolve_options(data):
+    # resolve_query_vector options of a /search body or batch query, ValueError for invalid ones
+    rephrase = data.get("rephrase", True)
+    if not isinstance(rephrase, bool):
+        raise ValueError("'rephrase' must be true or false")
+    budget_ms = data.get("latency_budget_ms", SEARCH_LATENCY_BUDGET_MS)
+    try:
+        budget_ms = int(budget_ms) if not isinstance(budget_ms, bool) else -1
+    except (TypeError, ValueError):
+        budget_ms = -1
+    if budget_ms < 0:
+        raise ValueError("'latency_budget_ms' must be an integer of at least 0")
+    return {"fast": data.get("mode") == "fast", "rephrase": rephrase, "budget_ms": budget_ms}
+
+
+def search_response(search_request, results, output):
+    # Which query vector was used: rephrased, raw (rephrase disabled), raw_fallback (budget missed) or cursor
+    headers = {"X-Search-Query-Path": search_request["query_path"]}
 
-    logging.info(f"Time taken for florence search: {time.time() - ssrc}")
-    # Print the search results
-    output = []
+    if not search_request["paginated"]:
+        return func.HttpResponse(json.dumps(output), headers=headers, mimetype="application/json")
+
+    next_cursor = search_paging.next_cursor(search_request["vector"], search_request["offset"],
+                                            search_request["page_size"], len(results), search_request["query"])
+    if search_request["stream"]:
+        # Buffered like every other response, see read_search_request
+        body = b"".join(search_paging.ndjson_line(result) for result in output)
+        body += search_paging.ndjson_line({"nextCursor": next_cursor})
+        return func.HttpResponse(body, headers=headers, mimetype="application/x-ndjson")
+
+    body = {"results": output, "nextCursor": next_cursor, "queryPath": search_request["query_path"]}
+    return func.HttpResponse(json.dumps(body), headers=headers, mimetype="application/json")
+
+
+@app.function_name(name="search_batch")
+@app.route(route="search/batch", methods=["POST"])
+@metrics.timed_request("search_batch")
+def search_batch(req: func.HttpRequest) -> func.HttpResponse:
+    # Several queries in one request, e.g. the panels of one page:
+    #   {"queries": ["red car", {"id": "p2", "query": "beach", "max_images": 3, "mode": "fast"}], "max_images": 5}
+    # Results come back grouped by query, each with its own error and timings.
+    try:
+        data = req.get_json()
+        queries = [query if isinstance(query, dict) else {"query": query} for query in data["queries"]]
+    except (ValueError, KeyError, TypeError):
+        return func.HttpResponse(json.dumps({"error": "The 'queries' list is required"}),
+                                 status_code=400, mimetype="application/json")
+    if not 0 < len(queries) <= SEARCH_BATCH_MAX_QUERIES:
+        return func.HttpResponse(json.dumps({"error": f"Send 1 to {SEARCH_BATCH_MAX_QUERIES} queries"}),
+                                 status_code=400, mimetype="application/json")
+    payload_log.log_payload("Batch input data", data)
+    started = time.perf_counter()
+
+    defaults = {name: data[name] for name in ("max_images", "mode", "rephrase", "latency_budget_ms") if name in data}
+    groups = search_many([dict(defaults, **query) for query in queries])
+
+    # Every distinct image is signed once for the whole batch, concurrently and with the one cached
+    # delegation key. A signing failure only fails the queries that need the image.
     auth_header = req.headers.get('Authorization')
-    for result in results:
-        logging.info(f"Result: {result}")
-        image_url = result["imageUrl"]
-        sas_token = helper_functions.create_user_delegated_sas_token(image_url, auth_header)
-        # sas_token = helper_functions.create_service_sas_blob(image_url)
-        
-        sas_url = f"{image_url}?{sas_token}"
-        # response = requests.get(sas_url, headers={"Authorization": auth_header})
-
-        # # Check if the request was successful
-        # if response.status_code == 200:
-        #     # Convert the image data to base64
-        #     base64_image = base64.b64encode(response.content).decode('utf-8')
-        #     logging.info(f"Base64 Image: {base64_image}")
-        # else:
-        #     base64_image = f"Failed to download image. Status code: {response.status_code}, Reason: {response.reason}"
-
-        output.append(
-            {
-                "Title": result["title"],
-                "Image URL": image_url,
-                # "Image": base64_image,
-                "Image": sas_url,
-                "Score": result["@search.score"],
-            }
-        )
-    return json.dumps(output)
+    sign_started = time.perf_counter()
+    image_urls = list(dict.fromkeys(hit["imageUrl"] for group in groups for hit in group["hits"]))
 
+    def sign(image_url):
+        try:
+            return helper_functions.create_user_delegated_sas_token(image_url, auth_header), None
+        except Exception as e:
+            logging.error("Signing %s failed: %s", image_url, payload_log.redact(str(e)))
+            return None, payload_log.redact(str(e))
 
-def vectorize_images(values):
-    # Process values and generate the response payload
-    response_values = []
-    for value in values:
-        response_value = vectorize_image(value)
-        logging.info(f"Response value: {response_value}")
-        response_values.append(response_value)
-    return response_values
+    signed = dict(zip(image_urls, search_stage_executor.map(metrics.bind(sign), image_urls)))
+    for group in groups:
+        hits = group.pop("hits")
+        errors = [signed[hit["imageUrl"]][1] for hit in hits if signed[hit["imageUrl"]][1] is not None]
+        if errors:
+            group["error"] = f"Signing the results failed: {errors[0]}"
+            group["results"] = []
+        else:
+            group["results"] = [format_search_result(hit, signed[hit["imageUrl"]][0]) for hit in hits]
+
+    body = {
+        "results": groups,
+        "timings": {
+            "sign_ms": round((time.perf_counter() - sign_started) * 1000, 2),
+            "total_ms": round((time.perf_counter() - started) * 1000, 2),
+            "signed_images": sum(1 for sas_token, _ in signed.values() if sas_token is not None),
+        },
+    }
+    return func.HttpResponse(json.dumps(body), mimetype="application/json")
 
-def vectorize_image(value):
+
+def search_many(queries):
+    # Rephrase, embedding and index query of every query run concurrently. Returns one group per query,
+    # in order, with the unsigned hits. Identical queries share their rephrase and embedding through
+    # the single-flight query caches.
+    backend = search_backends.get_backend()
+
+    def run(position, query):
+        group = {"id": query.get("id", position), "query": query.get("query"), "queryPath": None,
+                 "hits": [], "error": None, "timings": {}}
+        started = time.perf_counter()
+        try:
+            if not query.get("query"):
+                raise ValueError("The 'query' parameter is required")
+            max_images = min(read_count(query.get("max_images", 5), "'max_images' must be an integer of at least 1"),
+                             search_paging.SEARCH_MAX_RESULTS)
+            text, vector, group["queryPath"] = resolve_query_vector(query["query"], **read_resolve_options(query))
+            group["rephrased"] = text
+            group["timings"]["resolve_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            search_started = time.perf_counter()
+            with metrics.stage("search_backend"):
+                group["hits"] = backend.search(vector, max_images)
+            group["timings"]["search_ms"] = round((time.perf_counter() - search_started) * 1000, 2)
+        except Exception as e:
+            logging.error("Batch query %s failed: %s", group["id"], payload_log.redact(str(e)))
+            group["error"] = payload_log.redact(str(e))
+        group["timings"]["total_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return group
+
+    workers = max(1, min(SEARCH_BATCH_MAX_WORKERS, len(queries)))
+    # A pool per batch: the queries must not take the workers of the shared pools their stages run on
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search-batch") as executor:
+        return list(executor.map(metrics.bind(run), range(len(queries)), queries))
+
+
+async def sign_search_result_async(result, auth_header):
+    sas_token = await helper_functions.create_user_delegated_sas_token_async(result["imageUrl"], auth_header)
+    return format_search_result(result, sas_token)
+
+
+def sign_search_result(result, auth_header):
+    payload_log.log_payload("Result", result)
+    image_url = result["imageUrl"]
+    sas_token = helper_functions.create_user_delegated_sas_token(image_url, auth_header)
+    # sas_token = helper_functions.create_service_sas_blob(image_url)
+    return format_search_result(result, sas_token)
+
+
+def format_search_result(result, sas_token):
+    image_url = result["imageUrl"]
+    sas_url = f"{image_url}?{sas_token}"
+    # response = requests.get(sas_url, headers={"Authorization": auth_header})
+
+    # # Check if the request was successful
+    # if response.status_code == 200:
+    #     # Convert the image data to base64
+    #     base64_image = base64.b64encode(response.content).decode('utf-8')
+    #     logging.info(f"Base64 Image: {base64_image}")
+    # else:
+    #     base64_image = f"Failed to download image. Status code: {response.status_code}, Reason: {response.reason}"
+
+    return {
+        "Title": result["title"],
+        "Image URL": image_url,
+        # "Image": base64_image,
+        "Image": sas_url,
+        "Score": result["@search.score"],
+    }
+
+
+def read_image_values(req, record_id, image_url=None):
+    # Skill records of a /vectorize request. JSON records may carry their images inline as
+    # data.imageData; binary and multipart bodies become records of their own.
+    values = image_input.binary_values(req, record_id, image_url)
+    if values is not None:
+        return values
+    request = json.loads(image_input.read_body(req))
+    if not isinstance(request, dict) or not isinstance(request.get("values"), list):
+        raise ValueError("Request body must be a JSON object with a values list")
+    return request["values"]
+
+
+def vectorize_images(values, vector_field="imageVector", include_url=True, max_workers=None, vector_format="json",
+                     dedupe_ingest=False):
+    # Records are independent, so they are fanned out over a bounded thread pool.
+    # executor.map keeps the input order and vectorize_image turns failures into per-record errors.
+    # dedupe_ingest is for the paths that index the results: near-duplicates of indexed documents
+    # come back with data.duplicateOf and are not indexed again.
+    max_workers = max_workers or VECTORIZE_MAX_WORKERS
+    workers = max(1, min(max_workers, len(values)))
+
+    def process(value):
+        response_value = vectorize_image(value, vector_field, include_url, vector_format, dedupe_ingest)
+        payload_log.log_payload("Response value", response_value)
+        return response_value
+
+    if workers == 1:
+        return [process(value) for value in values]
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vectorize") as executor:
+        return list(executor.map(metrics.bind(process), values))
+
+def vectorize_image(value, vector_field="imageVector", include_url=True, vector_format="json", dedupe_ingest=False):
+    record_id = value.get("recordId")
     try:
-        image_url = value["data"]["imageUrl"]
-        record_id = value["recordId"]
-        logging.info(f"Input: recordId: {record_id}, imageUrl: {image_url}")
+        image_bytes = image_input.image_bytes(value["data"], record_id)
+        duplicate = None
+        if image_bytes is not None:
+            # Inline image: nothing to sign, Vision gets the bytes. The imageUrl is optional and only
+            # names the document for deduplication.
+            image_url = value["data"].get("imageUrl")
+            logging.debug("Input: recordId: %s, %s image bytes", record_id, len(image_bytes))
+            if dedupe_ingest and image_url:
+                vector, duplicate = dedupe.deduplicate(image_url, None, lambda _: (
+                    helper_functions.get_image_embeddings_inline_cached(image_bytes)), image_bytes)
+            else:
+                vector = helper_functions.get_image_embeddings_inline_cached(image_bytes)
+        else:
+            image_url = value["data"]["imageUrl"]
+            logging.debug("Input: recordId: %s, imageUrl: %s", record_id, image_url)
+
+            # Get image embeddings
+            sas_token = helper_functions.create_service_sas_blob(image_url)
+            # sas_token = helper_functions.create_user_delegated_sas_token(image_url)
 
-        # Get image embeddings
-        sas_token = helper_functions.create_service_sas_blob(image_url)
-        # sas_token = helper_functions.create_user_delegated_sas_token(image_url)
+            # Unchanged images (same URL and ETag) are served from the embedding cache
+            etag = value["data"].get("eTag")
+            if dedupe_ingest:
+                vector, duplicate = dedupe.deduplicate(image_url, sas_token, lambda image_bytes: (
+                    helper_functions.get_image_embeddings_cached(image_url, sas_token, etag, image_bytes)))
+            else:
+                vector = helper_functions.get_image_embeddings_cached(image_url, sas_token, etag)
 
-        vector = helper_functions.get_image_embeddings(image_url, sas_token)
+        data = {vector_field: vector_codec.encode(vector, vector_format)}
+        if include_url and image_url:
+            data["imageUrl"] = image_url
+        if duplicate is not None:
+            data["duplicateOf"] = {"id": duplicate.id, "imageUrl": duplicate.image_url}
 
         response_value = {
             "recordId": record_id,
-            "data": {
-                "imageVector": vector,
-                "imageUrl": image_url
-            },
+            "data": data,
             "errors": None,
             "warnings": None,
         }
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logging.error("Error: %s", payload_log.redact(str(e)))
         response_value = {
             "recordId": record_id,
             "data": None,
-            "errors": str(e),
+            "errors": payload_log.redact(str(e)),
             "warnings": None,
         }
     return response_value
 
 
+def resolve_query_vector(user_query, fast=False, rephrase=True, budget_ms=SEARCH_LATENCY_BUDGET_MS):
+    # Returns (query text, query vector, path taken)
+    if not rephrase:
+        return user_query, embed_query(user_query), "raw"
+    if not fast:
+        query = rephrase_query(user_query)
+        return query, embed_query(query), "rephrased"
+
+    # Fast mode: embed the raw query on this thread while the rephrase and its embedding run in the
+    # background, and only wait for the rephrased vector as long as the budget allows
+    deadline = time.monotonic() + budget_ms / 1000
+    if not rephrase_slots.acquire(blocking=False):
+        logging.info("All rephrase workers are busy, searching with the raw query")
+        return user_query, embed_query(user_query), "raw_fallback"
+
+    def rephrased_vector():
+        try:
+            query = rephrase_query(user_query)
+            if time.monotonic() > deadline:
+                # Too late for this search, the rephrase itself is cached for the next one
+                return query, None
+            return query, embed_query(query)
+        finally:
+            rephrase_slots.release()
+
+    rephrased = rephrase_executor.submit(metrics.bind(rephrased_vector))
+    raw_vector = raw_error = None
+    try:
+        raw_vector = embed_query(user_query)
+    except Exception as e:
+        raw_error = e
+    try:
+        query, vector = rephrased.result(timeout=max(0.0, deadline - time.monotonic()))
+        if vector is not None:
+            return query, vector, "rephrased"
+        logging.info(f"Rephrase missed the {budget_ms} ms budget, searching with the raw query")
+    except FuturesTimeoutError:
+        logging.info(f"Rephrase missed the {budget_ms} ms budget, searching with the raw query")
+    except Exception as e:
+        logging.warning(f"Rephrase failed ({e}), searching with the raw query")
+    if raw_error is not None:
+        raise raw_error
+    return user_query, raw_vector, "raw_fallback"
+
+
+async def resolve_query_vector_async(user_query, fast=False, rephrase=True, budget_ms=SEARCH_LATENCY_BUDGET_MS):
+    # resolve_query_vector on the event loop
+    if not rephrase:
+        return user_query, await embed_query_async(user_query), "raw"
+    if not fast:
+        query = await rephrase_query_async(user_query)
+        return query, await embed_query_async(query), "rephrased"
+
+    # The same bound as rephrase_slots, per event loop: with all slots taken by late rephrases, fast
+    # searches use the raw query rather than add another one
+    slots = async_transport.loop_local("rephrase_slots", lambda: asyncio.Semaphore(SEARCH_REPHRASE_WORKERS))
+    if slots.locked():
+        logging.info("All rephrase slots are busy, searching with the raw query")
+        return user_query, await embed_query_async(user_query), "raw_fallback"
+    await slots.acquire()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget_ms / 1000
+
+    async def rephrased_vector():
+        try:
+            query = await rephrase_query_async(user_query)
+            if loop.time() > deadline:
+                # Too late for this search, the rephrase itself is cached for the next one
+                return query, None
+            return query, await embed_query_async(query)
+        finally:
+            slots.release()
+
+    rephrased = asyncio.ensure_future(rephrased_vector())
+    rephrased.add_done_callback(_retrieve_outcome)
+    raw = asyncio.ensure_future(embed_query_async(user_query))
+    fallback = False
+    try:
+        # shield: a rephrase that misses the budget keeps running and warms the query cache
+        query, vector = await asyncio.wait_for(asyncio.shield(rephrased), max(0.0, deadline - loop.time()))
+        if vector is not None:
+            return query, vector, "rephrased"
+        logging.info(f"Rephrase missed the {budget_ms} ms budget, searching with the raw query")
+        fallback = True
+    except asyncio.TimeoutError:
+        logging.info(f"Rephrase missed the {budget_ms} ms budget, searching with the raw query")
+        fallback = True
+    except Exception as e:
+        logging.warning(f"Rephrase failed ({e}), searching with the raw query")
+        fallback = True
+    finally:
+        if not fallback:
+            # The rephrased vector is there (or this search was cancelled), the raw one is not needed
+            raw.cancel()
+    return user_query, await raw, "raw_fallback"
+
+
+def _retrieve_outcome(task):
+    # A background rephrase that fails after its search moved on is logged here, not by asyncio as
+    # "Task exception was never retrieved"
+    if not task.cancelled() and task.exception() is not None:
+        logging.info(f"Background rephrase failed: {task.exception()}")
+
+
+def rephrase_query(user_query):
+    # Popular queries repeat, so the rephrase is cached and identical concurrent queries share one call
+    return query_cache.rephrase_cache.get_or_compute(
+        query_cache.normalize_query(user_query), lambda: ask_openai(user_query)
+    )
+
+
+def embed_query(query):
+    return query_cache.text_embedding_cache.get_or_compute(
+        query_cache.normalize_query(query), lambda: generate_embeddings_text(query)
+    )
+
+
+async def rephrase_query_async(user_query):
+    return await query_cache.rephrase_cache.get_or_compute_async(
+        query_cache.normalize_query(user_query), lambda: ask_openai_async(user_query)
+    )
+
+
+async def embed_query_async(query):
+    return await query_cache.text_embedding_cache.get_or_compute_async(
+        query_cache.normalize_query(query), lambda: generate_embeddings_text_async(query)
+    )
+
+
+def rephrase_messages(query):
+    return [
+        {"role": "system", "content": "You are helpful assistant. "},
+        {
+            "role": "user",
+            "content": f"Convert a user query into a textual representation capturing central semantic meanings which is most suitable for finding best results in a search. Output only a final query not more tha 200 tokens size. Here is the original query: {query}",
+        },
+    ]
+
+
+@metrics.timed("openai")
 def ask_openai(query):
-    logging.info(f"Asking OpenAI...")
-    logging.info(f"Input query: {query}")
+    logging.debug("Asking OpenAI, input query: %s", query)
+
+    chat_completion = get_chat_client().chat.completions.create(
+        messages=rephrase_messages(query),
+        model=OPEN_AI_MODEL,
+        max_tokens=200,
+    )
+
+    return chat_completion.choices[0].message.content
+
+
+@metrics.timed("openai")
+async def ask_openai_async(query):
+    chat_completion = await get_async_chat_client().chat.completions.create(
+        messages=rephrase_messages(query),
+        model=OPEN_AI_MODEL,
+        max_tokens=200,
+    )
+
+    return chat_completion.choices[0].message.content
 
+
+def get_chat_client():
     global chat_client
     if chat_client is None:
-        chat_client = AzureOpenAI(
+        with _chat_client_lock:
+            if chat_client is None:
+                from openai import AzureOpenAI
+
+                # Same timeouts, retry count and pool size as the other outbound calls
+                chat_client = AzureOpenAI(
+                    azure_endpoint=AZURE_OPENAI_ENDPOINT,
+                    api_key=AZURE_OPENAI_API_KEY,
+                    api_version=API_VERSION,
+                    **transport.openai_client_options(),
+                )
+    return chat_client
+
+
+def get_async_chat_client():
+    # One AsyncAzureOpenAI per event loop, reused across invocations. It shares the pooled httpx client
+    # of the endpoint, which is looked up first: loop_local does not nest.
+    options = async_transport.openai_client_options(AZURE_OPENAI_ENDPOINT)
+
+    def create():
+        from openai import AsyncAzureOpenAI
+
+        return AsyncAzureOpenAI(
             azure_endpoint=AZURE_OPENAI_ENDPOINT,
             api_key=AZURE_OPENAI_API_KEY,
             api_version=API_VERSION,
+            **options,
         )
 
-    chat_completion = chat_client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": "You are helpful assistant. "},
-            {
-                "role": "user",
-                "content": f"Convert a user query into a textual representation capturing central semantic meanings which is most suitable for finding best results in a search. Output only a final query not more tha 200 tokens size. Here is the original query: {query}",
-            },
-        ],
-        model=OPEN_AI_MODEL,
-        max_tokens=200,
-    )
-
-    return chat_completion.choices[0].message.content
+    return async_transport.loop_local("openai", create)
 
 
+@metrics.timed("vision_text")
 def generate_embeddings_text(text):
 
-    logging.info(f"Generating embeddings...")
-    logging.info(f"Input text: {text}")
-    logging.info(f"Input AI_VISION_ENDPOINT: {AI_VISION_ENDPOINT}")
+    logging.debug("Generating embeddings for text: %s", text)
 
     url = f"{AI_VISION_ENDPOINT}/computervision/retrieval:vectorizeText?api-version=2023-02-01-preview"
 
@@ -367,16 +1002,34 @@ def generate_embeddings_text(text):
 
     data = {"text": text}
 
-    s = time.time()
-    response = requests.post(url, headers=headers, json=data)
-    logging.info(f"Time taken florence text embedding: {time.time() - s}")
+    # Search queries go ahead of queued image embeddings in the shared Vision rate limiter
+    response = transport.post(url, headers=headers, json=data, limiter=rate_limiter.vision(),
+                              priority=rate_limiter.INTERACTIVE)
 
-    if response.status_code == 200:
-        # logging.info(f"Embeddings: {response.json()}")
-        embeddings = response.json()["vector"]
-        return embeddings
-    else:
-        logging.info(f"Error: {response.status_code} - {response.text}")
-        return None
+    if response.status_code != 200:
+        # Fail loudly, a None vector would only surface later inside VectorizedQuery
+        logging.error("Error: %s - %s", response.status_code, payload_log.truncate(response.text))
+        response.raise_for_status()
+
+    # logging.info(f"Embeddings: {response.json()}")
+    embeddings = vector_codec.to_float32(response.json()["vector"])
+    return embeddings
+
+
+@metrics.timed("vision_text")
+async def generate_embeddings_text_async(text):
+    url = f"{AI_VISION_ENDPOINT}/computervision/retrieval:vectorizeText?api-version=2023-02-01-preview"
+    headers = {
+        "Content-Type": "application/json",
+        "Ocp-Apim-Subscription-Key": AI_VISION_API_KEY,
+    }
+
+    response = await async_transport.post(url, headers=headers, json={"text": text}, limiter=rate_limiter.vision(),
+                                          priority=rate_limiter.INTERACTIVE)
+
+    if response.status_code != 200:
+        logging.error("Error: %s - %s", response.status_code, payload_log.truncate(response.text))
+        response.raise_for_status()
 
+    return vector_codec.to_float32(response.json()["vector"])
 
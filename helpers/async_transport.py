@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import threading
+import weakref
+
+from helpers import rate_limiter, transport
+
+
+# Async counterpart of transport.py for the async search path.
+# One httpx.AsyncClient per endpoint with the same timeouts, retry policy, rate limiter and Retry-After
+# handling as the sync sessions. Async clients hold connections of the event loop that created them, so
+# clients (also the OpenAI and Search ones, see loop_local) are kept per running loop. The Functions
+# worker runs one loop for its lifetime; tests and benchmarks that start their own loops call aclose().
+
+_clients = weakref.WeakKeyDictionary()
+_counters = {}
+_lock = threading.Lock()
+
+
+def loop_local(name, factory):
+    # The client called name of the running loop, created by factory() on first use
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _clients.setdefault(loop, {})
+        client = clients.get(name)
+        if client is None:
+            client = clients[name] = factory()
+    return client
+
+
+def get_client(url):
+    endpoint = transport.endpoint_of(url)
+
+    def create():
+        import httpx
+
+        logging.info(f"Created pooled async HTTP client for {endpoint}")
+        _counters.setdefault(endpoint, {"requests": 0, "retries": 0, "throttled": 0, "failures": 0})
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(transport.HTTP_READ_TIMEOUT, connect=transport.HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=transport.HTTP_POOL_MAXSIZE,
+                                max_keepalive_connections=transport.HTTP_POOL_MAXSIZE),
+        )
+
+    return loop_local(("http", endpoint), create)
+
+
+def openai_client_options(url):
+    # Keyword arguments for AsyncAzureOpenAI: the pooled client of its endpoint and the shared timeouts
+    # and retry count. The SDK retries on its own, see transport.openai_client_options().
+    import httpx
+
+    return {
+        "timeout": httpx.Timeout(transport.HTTP_READ_TIMEOUT, connect=transport.HTTP_CONNECT_TIMEOUT),
+        "max_retries": transport.HTTP_MAX_RETRIES,
+        "http_client": get_client(url),
+    }
+
+
+def _count(endpoint, name, amount=1):
+    with _lock:
+        _counters[endpoint][name] += amount
+
+
+async def request(method, url, max_retries=None, limiter=None, priority=rate_limiter.BULK, **kwargs):
+    # kwargs are httpx ones: params, headers, json, content
+    import httpx
+
+    client = get_client(url)
+    endpoint = transport.endpoint_of(url)
+    max_retries = transport.HTTP_MAX_RETRIES if max_retries is None else max_retries
+
+    attempt = 0
+    while True:
+        if limiter is not None:
+            await limiter.acquire_async(priority)
+        _count(endpoint, "requests")
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt >= max_retries:
+                _count(endpoint, "failures")
+                raise
+            delay = transport.backoff_delay(attempt)
+            logging.warning(f"{method} {endpoint} failed ({e!r}), retry {attempt + 1}/{max_retries} in {delay:.2f}s")
+        else:
+            if response.status_code not in transport.RETRY_STATUS_CODES:
+                if limiter is not None:
+                    limiter.succeeded()
+                return response
+            if response.status_code == 429:
+                _count(endpoint, "throttled")
+                if limiter is not None:
+                    limiter.throttled(transport.parse_retry_after(response))
+            if attempt >= max_retries:
+                _count(endpoint, "failures")
+                return response
+            delay = transport.backoff_delay(attempt, response)
+            logging.warning(f"{method} {endpoint} returned {response.status_code}, retry {attempt + 1}/{max_retries} in {delay:.2f}s")
+
+        _count(endpoint, "retries")
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+async def post(url, **kwargs):
+    return await request("POST", url, **kwargs)
+
+
+async def aclose():
+    # Closes the clients of the running loop
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _clients.pop(loop, {})
+    for client in clients.values():
+        close = getattr(client, "aclose", None) or client.close
+        await close()
+
+
+def stats():
+    with _lock:
+        return {endpoint: dict(values) for endpoint, values in _counters.items()}
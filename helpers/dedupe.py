@@ -0,0 +1,324 @@
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+
+from helpers import document_writer, image_preprocess, metrics
+
+
+# Near-duplicate detection for the ingest paths (Event Grid index trigger, /indexraw, backfill).
+# Re-uploads and near-identical copies of an image under another name are linked to the document
+# already indexed for it instead of being embedded and uploaded again. Two signals are checked:
+#   - a 64-bit difference hash of the image (DEDUPE_PHASH=true, needs Pillow and one blob download):
+#     a match reuses the stored vector, so Vision is not called at all,
+#   - cosine similarity of the new embedding against the recently indexed vectors: a match skips
+#     the index upload.
+# The index of recent documents is bounded (DEDUPE_MAX_ENTRIES, least recently matched evicted first),
+# held in memory as one float32 matrix (4 KB per document at 1024 dimensions, so about 40 MB at the
+# default bound) that grows with the entries, and persisted to sqlite
+# so it survives worker restarts. A new image only enters it once the search index has confirmed its
+# document (document_writer's indexed listener): until then it is pending, and nothing is linked to a
+# document that may never be written.
+
+DEDUPE = os.getenv("DEDUPE", "false").lower() == "true"
+DEDUPE_PHASH = os.getenv("DEDUPE_PHASH", "false").lower() == "true"
+DEDUPE_SIMILARITY = float(os.getenv("DEDUPE_SIMILARITY", "0.97"))
+DEDUPE_PHASH_MAX_DISTANCE = int(os.getenv("DEDUPE_PHASH_MAX_DISTANCE", "4"))
+DEDUPE_MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", "10000"))
+# Rows allocated up front, the index grows from there
+DEDUPE_INITIAL_ENTRIES = int(os.getenv("DEDUPE_INITIAL_ENTRIES", "256"))
+# Empty keeps the index in memory only
+DEDUPE_INDEX_PATH = os.getenv("DEDUPE_INDEX_PATH", os.path.join(tempfile.gettempdir(), "dedupe-index.sqlite"))
+
+Match = namedtuple("Match", ["id", "image_url", "similarity", "distance", "vector"])
+
+dedupe_stats = {"checked": 0, "hash_matches": 0, "vector_matches": 0, "added": 0, "evictions": 0}
+_stats_lock = threading.Lock()
+# Document id -> (image url, vector, image hash) of new images not yet confirmed by the search index
+_pending = OrderedDict()
+_pending_lock = threading.Lock()
+
+
+def _count(**amounts):
+    with _stats_lock:
+        for name, amount in amounts.items():
+            dedupe_stats[name] += amount
+
+
+def image_hash(data):
+    # dHash: 9x8 grayscale thumbnail, one bit per horizontal neighbour comparison
+    from PIL import Image
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.draft("L", (64, 64))
+        pixels = image.convert("L").resize((9, 8), Image.Resampling.BILINEAR).tobytes()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise image_preprocess.PreprocessError(f"Cannot decode image: {e}") from e
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left, right = pixels[row * 9 + column], pixels[row * 9 + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+class DedupeIndex:
+    def __init__(self, path=DEDUPE_INDEX_PATH, max_entries=DEDUPE_MAX_ENTRIES,
+                 dimensions=document_writer.VECTOR_DIMENSIONS):
+        import numpy as np
+
+        self.path = path
+        self.max_entries = max_entries
+        self.dimensions = dimensions
+        # Slots filled in order and, once max_entries are used, reused for the least recently matched
+        # document. The arrays start small and double as they fill up, up to max_entries rows.
+        capacity = min(max_entries, DEDUPE_INITIAL_ENTRIES)
+        self._vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self._norms = np.zeros(capacity, dtype=np.float32)
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._has_hash = np.zeros(capacity, dtype=bool)
+        self._last_used = np.full(capacity, -np.inf)
+        self._ids = [None] * capacity
+        self._urls = [None] * capacity
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, image_url TEXT NOT NULL, "
+                "hash BLOB, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._load()
+
+    def _load(self):
+        rows = self._conn.execute(
+            "SELECT id, image_url, hash, vector, last_used FROM documents ORDER BY last_used DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for document_id, image_url, hash_bytes, vector_bytes, last_used in reversed(rows):
+            vector = array("f")
+            vector.frombytes(vector_bytes)
+            if len(vector) != self.dimensions:
+                continue
+            image_hash = int.from_bytes(hash_bytes, "big") if hash_bytes else None
+            self._store(self._free_slot(), document_id, image_url, vector, image_hash, last_used)
+        # Rows beyond max_entries were left over by a larger DEDUPE_MAX_ENTRIES
+        self._conn.execute(
+            "DELETE FROM documents WHERE id NOT IN (SELECT id FROM documents ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _grow(self):
+        import numpy as np
+
+        capacity = min(self.max_entries, max(1, 2 * len(self._ids)))
+        added = capacity - len(self._ids)
+        self._vectors = np.concatenate([self._vectors, np.zeros((added, self.dimensions), dtype=np.float32)])
+        self._norms = np.concatenate([self._norms, np.zeros(added, dtype=np.float32)])
+        self._hashes = np.concatenate([self._hashes, np.zeros(added, dtype=np.uint64)])
+        self._has_hash = np.concatenate([self._has_hash, np.zeros(added, dtype=bool)])
+        self._last_used = np.concatenate([self._last_used, np.full(added, -np.inf)])
+        self._ids += [None] * added
+        self._urls += [None] * added
+
+    def _free_slot(self):
+        if len(self._slots) < self.max_entries:
+            if len(self._slots) == len(self._ids):
+                self._grow()
+            return len(self._slots)
+        slot = int(self._last_used.argmin())
+        del self._slots[self._ids[slot]]
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM documents WHERE id = ?", (self._ids[slot],))
+        _count(evictions=1)
+        return slot
+
+    def _store(self, slot, document_id, image_url, vector, image_hash, last_used):
+        import numpy as np
+
+        self._vectors[slot] = np.asarray(vector, dtype=np.float32)
+        self._norms[slot] = np.linalg.norm(self._vectors[slot])
+        self._hashes[slot] = image_hash or 0
+        self._has_hash[slot] = image_hash is not None
+        self._last_used[slot] = last_used
+        self._ids[slot] = document_id
+        self._urls[slot] = image_url
+        self._slots[document_id] = slot
+
+    def _match(self, slot, similarity=None, distance=None):
+        self._last_used[slot] = time.time()
+        if self._conn is not None:
+            self._conn.execute("UPDATE documents SET last_used = ? WHERE id = ?",
+                               (self._last_used[slot], self._ids[slot]))
+        vector = array("f", self._vectors[slot].tobytes())
+        return Match(self._ids[slot], self._urls[slot], similarity, distance, vector)
+
+    def find_hash(self, image_hash, exclude_id=None):
+        # Closest stored image hash within DEDUPE_PHASH_MAX_DISTANCE bits, or None
+        import numpy as np
+
+        with self._lock:
+            count = len(self._slots)
+            if not count:
+                return None
+            differences = (self._hashes[:count] ^ np.uint64(image_hash)).view(np.uint8)
+            distances = np.unpackbits(differences).reshape(count, 64).sum(axis=1)
+            distances[~self._has_hash[:count]] = 65
+            if exclude_id in self._slots:
+                distances[self._slots[exclude_id]] = 65
+            slot = int(distances.argmin())
+            if distances[slot] > DEDUPE_PHASH_MAX_DISTANCE:
+                return None
+            return self._match(slot, distance=int(distances[slot]))
+
+    def find_vector(self, vector, exclude_id=None):
+        # Most similar stored vector with cosine similarity >= DEDUPE_SIMILARITY, or None
+        import numpy as np
+
+        query = np.asarray(vector, dtype=np.float32)
+        query_norm = float(np.linalg.norm(query))
+        with self._lock:
+            count = len(self._slots)
+            if not count or not query_norm:
+                return None
+            similarities = self._vectors[:count] @ query
+            norms = self._norms[:count]
+            similarities /= np.where(norms > 0, norms, np.inf) * query_norm
+            if exclude_id in self._slots:
+                similarities[self._slots[exclude_id]] = -1
+            slot = int(similarities.argmax())
+            if similarities[slot] < DEDUPE_SIMILARITY:
+                return None
+            return self._match(slot, similarity=round(float(similarities[slot]), 6))
+
+    def add(self, document_id, image_url, vector, image_hash=None):
+        now = time.time()
+        with self._lock:
+            slot = self._slots[document_id] if document_id in self._slots else self._free_slot()
+            self._store(slot, document_id, image_url, vector, image_hash, now)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO documents (id, image_url, hash, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (document_id, image_url, image_hash.to_bytes(8, "big") if image_hash is not None else None,
+                     array("f", vector).tobytes(), now),
+                )
+        _count(added=1)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def create_index():
+    try:
+        return DedupeIndex()
+    except sqlite3.Error as e:
+        logging.warning("Dedupe index: sqlite unavailable (%s), using memory only", e)
+        return DedupeIndex(path=None)
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = create_index()
+    return _index
+
+
+def set_index(index):
+    global _index
+    with _index_lock:
+        _index = index
+
+
+def _fingerprint(image_url, sas_token, data=None):
+    # (image bytes, image hash); (None, None) when the image cannot be hashed here.
+    # The blob is downloaded unless the caller has its bytes already.
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return data, None
+    try:
+        data = image_preprocess.download(f"{image_url}?{sas_token}") if data is None else data
+        return data, image_hash(data)
+    except image_preprocess.PreprocessError as e:
+        logging.debug("No image hash for %s: %s", image_url, e)
+        return data, None
+
+
+def deduplicate(image_url, sas_token, embed, image_bytes=None):
+    # Returns (vector, Match of the existing document or None).
+    # embed(image_bytes) computes the embedding; image_bytes is the blob when it was downloaded for hashing.
+    # Callers that received the image inline pass image_bytes and no sas_token, nothing is downloaded.
+    if not DEDUPE:
+        return embed(image_bytes), None
+    index = get_index()
+    document_id = document_writer.document_id(image_url)
+    _count(checked=1)
+
+    hash_value = None
+    if DEDUPE_PHASH:
+        with metrics.stage("dedupe_hash"):
+            image_bytes, hash_value = _fingerprint(image_url, sas_token, image_bytes)
+            match = index.find_hash(hash_value, exclude_id=document_id) if hash_value is not None else None
+        if match is not None:
+            _count(hash_matches=1)
+            logging.info("%s duplicates %s (hash distance %s), not embedded", image_url, match.image_url, match.distance)
+            return match.vector, match
+
+    vector = embed(image_bytes)
+    with metrics.stage("dedupe_vector"):
+        match = index.find_vector(vector, exclude_id=document_id)
+    if match is not None:
+        _count(vector_matches=1)
+        logging.info("%s duplicates %s (similarity %s)", image_url, match.image_url, match.similarity)
+        return vector, match
+    with _pending_lock:
+        _pending[document_id] = (image_url, vector, hash_value)
+        _pending.move_to_end(document_id)
+        # Documents that never make it into the search index are forgotten eventually
+        while len(_pending) > DEDUPE_MAX_ENTRIES:
+            _pending.popitem(last=False)
+    return vector, None
+
+
+def confirm(document_ids):
+    # The search index has these documents now, pending ones become matchable
+    with _pending_lock:
+        confirmed = [(document_id, _pending.pop(document_id))
+                     for document_id in document_ids if document_id in _pending]
+    if confirmed:
+        index = get_index()
+        for document_id, (image_url, vector, hash_value) in confirmed:
+            index.add(document_id, image_url, vector, hash_value)
+
+
+document_writer.add_indexed_listener(confirm)
+
+
+def stats():
+    with _stats_lock:
+        result = dict(dedupe_stats)
+    result["enabled"] = DEDUPE
+    result["entries"] = len(_index) if _index is not None else 0
+    result["pending"] = len(_pending)
+    return result
@@ -0,0 +1,239 @@
+import atexit
+import base64
+import logging
+import os
+import threading
+import time
+from array import array
+from urllib.parse import unquote, urlparse
+
+from helpers import metrics
+
+
+# Buffered writer for the ingest path.
+# Documents from many events are merged into size- and time-bounded batches by the SDK's
+# SearchIndexingBufferedSender, which also retries the individual documents that fail.
+# upload() is for handlers whose caller redelivers on failure (Event Grid): it flushes and waits for
+# the index's answer on its own documents, so nothing is acknowledged while still buffered.
+
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "100"))
+INDEX_FLUSH_INTERVAL_SECONDS = int(os.getenv("INDEX_FLUSH_INTERVAL_SECONDS", "5"))
+INDEX_MAX_RETRIES_PER_DOCUMENT = int(os.getenv("INDEX_MAX_RETRIES_PER_DOCUMENT", "3"))
+VECTOR_DIMENSIONS = int(os.getenv("VECTOR_DIMENSIONS", "1024"))
+# How long upload() waits for the index to answer for its documents
+INDEX_UPLOAD_TIMEOUT_SECONDS = float(os.getenv("INDEX_UPLOAD_TIMEOUT_SECONDS", "120"))
+
+# Per-document statuses worth another attempt (conflicts, throttling, temporary unavailability)
+RETRYABLE_INDEXING_STATUS = {409, 422, 429, 503}
+
+writer_stats = {"queued": 0, "succeeded": 0, "failed": 0}
+
+# Called with the ids of documents the search index has confirmed, see add_indexed_listener
+_indexed_listeners = []
+# Document id -> [_Upload] waiting for the sender's answer on it, in the order they were queued
+_uploads = {}
+_sender = None
+_search_client = None
+_lock = threading.Lock()
+_stats_lock = threading.Lock()
+
+
+def document_id(image_url):
+    # The key the blob indexer gives the same blob (artifacts/vector-image-indexer.json maps
+    # metadata_storage_path to id with base64Encode), so both paths write one document per image:
+    # URL-safe base64 with the '=' padding replaced by its count, as .NET HttpServerUtility.UrlTokenEncode does
+    encoded = base64.urlsafe_b64encode(image_url.split("?", 1)[0].encode("utf-8")).decode("ascii")
+    unpadded = encoded.rstrip("=")
+    return f"{unpadded}{len(encoded) - len(unpadded)}"
+
+
+def to_document(image_url, vector, title=None):
+    # imageVector is Collection(Edm.Single): send a float32 array, not a JSON string
+    vector = array("f", vector)
+    if len(vector) != VECTOR_DIMENSIONS:
+        raise ValueError(f"Expected a {VECTOR_DIMENSIONS}-dimensional vector for {image_url}, got {len(vector)}")
+
+    if title is None:
+        title = unquote(os.path.basename(urlparse(image_url).path))
+    return {
+        "id": document_id(image_url),
+        "imageUrl": image_url,
+        "imageVector": vector.tolist(),
+        "title": title,
+    }
+
+
+def add_indexed_listener(listener):
+    # listener(document ids) runs once the index has confirmed the documents, for both writers
+    _indexed_listeners.append(listener)
+
+
+def _indexed(document_ids):
+    for listener in _indexed_listeners:
+        try:
+            listener(document_ids)
+        except Exception:
+            logging.exception("Indexed listener failed")
+
+
+class _Upload:
+    def __init__(self, document_ids):
+        self.remaining = set(document_ids)
+        self.failed = []
+        self.done = threading.Event()
+        if not self.remaining:
+            self.done.set()
+
+
+def _answered(document_id, error=None):
+    with _stats_lock:
+        waiting = _uploads.get(document_id)
+        upload = waiting.pop(0) if waiting else None
+        if waiting == []:
+            del _uploads[document_id]
+    if upload is not None:
+        if error is not None:
+            upload.failed.append((document_id, error))
+        upload.remaining.discard(document_id)
+        if not upload.remaining:
+            upload.done.set()
+
+
+def _on_progress(action):
+    with _stats_lock:
+        writer_stats["succeeded"] += 1
+    document = action.additional_properties or {}
+    if document.get("id"):
+        _indexed([document["id"]])
+        _answered(document["id"])
+
+
+def _on_error(action):
+    # Called once a document has used up its retries (or for non-retryable statuses)
+    document = action.additional_properties or {}
+    with _stats_lock:
+        writer_stats["failed"] += 1
+    logging.error(f"Indexing failed for document {document.get('id')} ({document.get('imageUrl')})")
+    if document.get("id"):
+        _answered(document["id"], "indexing failed")
+
+
+def get_sender():
+    global _sender
+    if _sender is None:
+        with _lock:
+            if _sender is None:
+                # The Search SDK is imported on first use to keep it out of the cold start of other routes
+                from azure.core.credentials import AzureKeyCredential
+                from azure.search.documents import SearchIndexingBufferedSender
+
+                _sender = SearchIndexingBufferedSender(
+                    os.environ["AI_SEARCH_SERVICE_ENDPOINT"],
+                    os.environ["AI_SEARCH_INDEX_NAME"],
+                    AzureKeyCredential(os.environ["AZURE_SEARCH_ADMIN_KEY"]),
+                    initial_batch_action_count=INDEX_BATCH_SIZE,
+                    auto_flush_interval=INDEX_FLUSH_INTERVAL_SECONDS,
+                    max_retries_per_action=INDEX_MAX_RETRIES_PER_DOCUMENT,
+                    on_progress=_on_progress,
+                    on_error=_on_error,
+                )
+                # Do not lose a partially filled batch when the worker shuts down
+                atexit.register(close)
+    return _sender
+
+
+def get_search_client():
+    global _search_client
+    if _search_client is None:
+        with _lock:
+            if _search_client is None:
+                from azure.core.credentials import AzureKeyCredential
+                from azure.search.documents import SearchClient
+
+                _search_client = SearchClient(
+                    os.environ["AI_SEARCH_SERVICE_ENDPOINT"],
+                    os.environ["AI_SEARCH_INDEX_NAME"],
+                    AzureKeyCredential(os.environ["AZURE_SEARCH_ADMIN_KEY"]),
+                )
+    return _search_client
+
+
+@metrics.timed("index_batch")
+def index_batch(documents, max_retries=INDEX_MAX_RETRIES_PER_DOCUMENT):
+    # Synchronous merge_or_upload for callers that need to know which documents made it (backfill).
+    # Returns (succeeded ids, [(failed id, message)]); retryable per-document failures are resent alone.
+    client = get_search_client()
+    succeeded, failed = [], []
+    pending = documents
+    attempt = 0
+    while pending:
+        results = {result.key: result for result in client.merge_or_upload_documents(documents=pending)}
+        retry = []
+        for document in pending:
+            result = results.get(document["id"])
+            if result is not None and result.succeeded:
+                succeeded.append(document["id"])
+            elif result is not None and result.status_code in RETRYABLE_INDEXING_STATUS and attempt < max_retries:
+                retry.append(document)
+            else:
+                failed.append((document["id"], result.error_message if result is not None else "no indexing result"))
+        pending = retry
+        attempt += 1
+        if pending:
+            time.sleep(min(10, 0.5 * 2 ** attempt))
+
+    with _stats_lock:
+        writer_stats["succeeded"] += len(succeeded)
+        writer_stats["failed"] += len(failed)
+    if succeeded:
+        _indexed(succeeded)
+    return succeeded, failed
+
+
+def merge_or_upload(documents):
+    if not documents:
+        return
+    sender = get_sender()
+    # The sender is not thread-safe and handlers run on a thread pool
+    with _stats_lock:
+        writer_stats["queued"] += len(documents)
+    with _lock:
+        sender.merge_or_upload_documents(documents=documents)
+
+
+def upload(documents, timeout=None):
+    # merge_or_upload, flushed and confirmed: returns [(document id, error)] of the documents the index
+    # did not take, also of those it has not answered for within INDEX_UPLOAD_TIMEOUT_SECONDS
+    upload = _Upload(document["id"] for document in documents)
+    with _stats_lock:
+        for document in documents:
+            _uploads.setdefault(document["id"], []).append(upload)
+    try:
+        merge_or_upload(documents)
+        # Also sends what other invocations queued; any of them may have sent these documents already
+        flush()
+        upload.done.wait(INDEX_UPLOAD_TIMEOUT_SECONDS if timeout is None else timeout)
+    finally:
+        with _stats_lock:
+            for document_id in upload.remaining:
+                waiting = _uploads.get(document_id, [])
+                if upload in waiting:
+                    waiting.remove(upload)
+                if not waiting:
+                    _uploads.pop(document_id, None)
+    return upload.failed + [(document_id, "no answer from the index") for document_id in upload.remaining]
+
+
+def flush():
+    if _sender is None:
+        return False
+    with _lock:
+        return _sender.flush()
+
+
+def close():
+    global _sender
+    with _lock:
+        sender, _sender = _sender, None
+    if sender is not None:
+        sender.close()
@@ -0,0 +1,232 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+# Content-addressed cache for image embeddings.
+# Keys are derived from the blob URL plus its ETag (or a hash of the image bytes), so an unchanged
+# image maps to the same key across indexer reruns and a re-upload naturally misses.
+
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "memory").lower()
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "10000"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(tempfile.gettempdir(), "embedding-cache.sqlite"))
+EMBEDDING_CACHE_DISK_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_DISK_MAX_ENTRIES", "200000"))
+
+
+def cache_key(image_url, etag=None, content_hash=None, model="2023-02-01-preview"):
+    # Without an ETag or content hash the URL alone says nothing about the content, so it is not cacheable
+    if content_hash:
+        identity = f"sha256:{content_hash}"
+    elif etag:
+        identity = image_url.split("?", 1)[0] + "|" + etag.strip('"')
+    else:
+        return None
+    return hashlib.sha256(f"{model}|{identity}".encode("utf-8")).hexdigest()
+
+
+def content_hash(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _pack(vector):
+    return array("f", vector).tobytes()
+
+
+def _unpack(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector
+
+
+class EmbeddingCache:
+    # Interface for a cache tier: get returns a vector or None, put stores one.
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, vector):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "tier": self.name,
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class LRUEmbeddingCache(EmbeddingCache):
+    def __init__(self, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        super().__init__("memory")
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteEmbeddingCache(EmbeddingCache):
+    # Persistent tier, vectors are stored as packed float32 blobs (4 KB for 1024 dims)
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_DISK_MAX_ENTRIES):
+        super().__init__("sqlite")
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return _unpack(row[0])
+
+    def put(self, key, vector):
+        blob = _pack(vector)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", (key, blob, time.time())
+            )
+            if cursor.rowcount:
+                self._count += 1
+            else:
+                self._conn.execute(
+                    "UPDATE embeddings SET vector = ?, last_used = ? WHERE key = ?", (blob, time.time(), key)
+                )
+            if self._count > self.max_entries:
+                # Evict in chunks so a full cache does not pay a DELETE on every insert
+                excess = self._count - self.max_entries + max(1, self.max_entries // 100)
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                self.evictions += excess
+                self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TieredEmbeddingCache(EmbeddingCache):
+    # Looks tiers up in order and promotes hits into the faster tiers in front of them
+
+    def __init__(self, tiers):
+        super().__init__("+".join(tier.name for tier in tiers))
+        self.tiers = tiers
+
+    def get(self, key):
+        for position, tier in enumerate(self.tiers):
+            vector = tier.get(key)
+            if vector is not None:
+                for upper in self.tiers[:position]:
+                    upper.put(key, vector)
+                self.hits += 1
+                return vector
+        self.misses += 1
+        return None
+
+    def put(self, key, vector):
+        for tier in self.tiers:
+            tier.put(key, vector)
+
+    def __len__(self):
+        return len(self.tiers[-1])
+
+    def stats(self):
+        result = super().stats()
+        result["tiers"] = [tier.stats() for tier in self.tiers]
+        return result
+
+
+_UNSET = object()
+_cache = _UNSET
+_cache_lock = threading.Lock()
+
+
+def create_cache(kind=EMBEDDING_CACHE):
+    if kind in ("none", "off", "false", ""):
+        return None
+    memory = LRUEmbeddingCache()
+    if kind == "memory":
+        return memory
+    if kind == "sqlite":
+        try:
+            return TieredEmbeddingCache([memory, SqliteEmbeddingCache()])
+        except sqlite3.Error as e:
+            logging.warning(f"Embedding cache: sqlite tier unavailable ({e}), using memory only")
+            return memory
+    raise ValueError(f"Unknown EMBEDDING_CACHE '{kind}', expected none, memory or sqlite")
+
+
+def get_cache():
+    global _cache
+    if _cache is _UNSET:
+        with _cache_lock:
+            if _cache is _UNSET:
+                _cache = create_cache()
+    return _cache
+
+
+def set_cache(cache):
+    # Plug in another implementation (or None to disable caching)
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+
+def stats():
+    cache = get_cache()
+    return cache.stats() if cache is not None else {"tier": "disabled"}
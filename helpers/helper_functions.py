@@ -1,23 +1,54 @@
+from __future__ import annotations
+
+import asyncio
 import datetime
+import functools
+import hashlib
 import os
+import threading
+from collections import OrderedDict, namedtuple
+from typing import TYPE_CHECKING
 from urllib.parse import urlparse
 import xml.etree.ElementTree as ET
-import requests
 import logging
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import (
-    BlobServiceClient,
-    # ContainerClient,
-    BlobClient,
-    BlobSasPermissions,
-    # ContainerSasPermissions,
-    UserDelegationKey,
-    # generate_container_sas,
-    generate_blob_sas
-)
-
-
-def get_image_embeddings(imageUrl, sas_token):  
+from helpers import (async_transport, embedding_cache, image_input, image_preprocess, metrics, payload_log, rate_limiter,
+                     transport, vector_codec)
+
+# azure.storage.blob is imported where it is used: it is one of the slowest imports of a cold start
+# and routes such as /url or cached searches never need it
+if TYPE_CHECKING:
+    from azure.storage.blob import BlobClient, BlobServiceClient, UserDelegationKey
+
+
+def get_image_embeddings(imageUrl, sas_token, image_bytes=None):  
+    # With IMAGE_PREPROCESS=true the blob is downscaled here and sent as bytes, Vision then never
+    # downloads the full-resolution original. Anything that cannot be preprocessed uses the URL mode.
+    # image_bytes saves the download when the caller already has the blob.
+    if image_preprocess.available():
+        try:
+            body = image_preprocess.prepare(f"{imageUrl}?{sas_token}", image_bytes)
+        except image_preprocess.PreprocessError as e:
+            logging.warning("Preprocessing %s failed (%s), sending Vision the URL", imageUrl, e)
+        else:
+            return get_image_embeddings_from_bytes(body)
+
+    if image_bytes is not None and len(image_bytes) <= image_input.IMAGE_INPUT_MAX_IMAGE_BYTES:
+        # Downloaded already (for the dedupe hash), so Vision does not fetch the blob a second time
+        return get_image_embeddings_from_bytes(image_bytes)
+
+    data = {  
+        "url": f"{imageUrl}?{sas_token}"
+    }  
+    return _vectorize_image("application/json", json=data)
+
+
+def get_image_embeddings_from_bytes(image_bytes):
+    # vectorizeImage binary input
+    return _vectorize_image("application/octet-stream", data=image_bytes)
+
+
+@metrics.timed("vision_image")
+def _vectorize_image(content_type, **body):
     cogSvcsEndpoint = os.environ["AI_VISION_ENDPOINT"]  
     cogSvcsApiKey = os.environ["AI_VISION_API_KEY"]  
  
@@ -28,25 +59,86 @@ def get_image_embeddings(imageUrl, sas_token):
     }  
  
     headers = {  
-        "Content-Type": "application/json",  
+        "Content-Type": content_type,  
         "Ocp-Apim-Subscription-Key": cogSvcsApiKey  
     }  
  
-    data = {  
-        "url": f"{imageUrl}?{sas_token}"
-    }  
-    
- 
-    response = requests.post(url, params=params, headers=headers, json=data)  
+    # Image embeddings are bulk work, they wait behind interactive search queries
+    response = transport.post(url, params=params, headers=headers, limiter=rate_limiter.vision(), **body)  
  
     if response.status_code != 200:  
-        logging.error(f"Error: {response.status_code}, {response.text}")  
+        logging.error("Error: %s, %s", response.status_code, payload_log.truncate(response.text))
         response.raise_for_status()  
  
-    embeddings = response.json()["vector"]  
+    # Held as a contiguous float32 array from here on
+    embeddings = vector_codec.to_float32(response.json()["vector"])  
     return embeddings  
 
 
+def get_image_embeddings_inline(image_bytes):
+    # Image content sent with the request: there is no blob to sign and Vision fetches nothing.
+    # IMAGE_PREPROCESS downscales it like a downloaded blob.
+    if image_preprocess.available():
+        try:
+            image_bytes = image_preprocess.prepare(None, image_bytes)
+        except image_preprocess.PreprocessError as e:
+            logging.warning("Preprocessing an inline image failed (%s), sending it as it is", e)
+    return get_image_embeddings_from_bytes(image_bytes)
+
+
+EMBEDDING_CACHE_LOOKUP_ETAG = os.getenv("EMBEDDING_CACHE_LOOKUP_ETAG", "true").lower() == "true"
+
+
+@metrics.timed("blob_etag")
+def get_blob_etag(imageUrl, sas_token):
+    # A HEAD on the blob is far cheaper than a Vision call and tells us whether the content changed
+    response = transport.request("HEAD", f"{imageUrl}?{sas_token}")
+    if response.status_code != 200:
+        logging.warning(f"Could not read ETag for {imageUrl}: {response.status_code}")
+        return None
+    return response.headers.get("ETag")
+
+
+@metrics.timed("image_embedding")
+def get_image_embeddings_cached(imageUrl, sas_token, etag=None, image_bytes=None):
+    cache = embedding_cache.get_cache()
+    if cache is None:
+        return get_image_embeddings(imageUrl, sas_token, image_bytes)
+
+    if etag is None and EMBEDDING_CACHE_LOOKUP_ETAG:
+        etag = get_blob_etag(imageUrl, sas_token)
+    key = embedding_cache.cache_key(imageUrl, etag)
+    if key is None:
+        return get_image_embeddings(imageUrl, sas_token, image_bytes)
+
+    vector = cache.get(key)
+    if vector is not None:
+        logging.debug("Embedding cache hit for %s", imageUrl)
+        return vector
+
+    vector = get_image_embeddings(imageUrl, sas_token, image_bytes)
+    cache.put(key, vector)
+    return vector
+
+
+@metrics.timed("image_embedding")
+def get_image_embeddings_inline_cached(image_bytes):
+    # Inline images have no URL and ETag, they are cached by a hash of their content
+    cache = embedding_cache.get_cache()
+    if cache is None:
+        return get_image_embeddings_inline(image_bytes)
+
+    key = embedding_cache.cache_key(None, content_hash=embedding_cache.content_hash(image_bytes))
+    vector = cache.get(key)
+    if vector is not None:
+        logging.debug("Embedding cache hit for an inline image of %s bytes", len(image_bytes))
+        return vector
+
+    vector = get_image_embeddings_inline(image_bytes)
+    cache.put(key, vector)
+    return vector
+
+
 # =========   BEGIN: USER DELEGATED SAS TOKEN =========
 
 # https://learn.microsoft.com/en-us/python/api/overview/azure/identity-readme?view=azure-python#service-principal-with-secret
@@ -57,63 +149,252 @@ def get_image_embeddings(imageUrl, sas_token):
 # AZURE_TENANT_ID	    ID of the application's Microsoft Entra tenant
 # AZURE_CLIENT_SECRET	one of the application's client secrets
 
+# Delegation keys are valid for a day and cover every blob in the account, so they are cached per
+# (account, caller) and renewed shortly before expiry. SAS tokens are cached per (caller, blob).
+# Both caches are LRUs: every bearer token is a caller of its own.
+DELEGATION_KEY_RENEW_BEFORE = datetime.timedelta(minutes=int(os.getenv("DELEGATION_KEY_RENEW_MINUTES", "15")))
+DELEGATION_KEY_CACHE_MAX_ENTRIES = int(os.getenv("DELEGATION_KEY_CACHE_MAX_ENTRIES", "1024"))
+SAS_CACHE_MAX_ENTRIES = int(os.getenv("SAS_CACHE_MAX_ENTRIES", "4096"))
+
+_delegation_keys = OrderedDict()
+# [lock, number of threads holding or waiting for it] per cache key, removed when the last one leaves
+_delegation_key_locks = {}
+# In-flight fetches of the async path, one per (account, caller)
+_delegation_key_fetches = {}
+_sas_tokens = OrderedDict()
+_sas_lock = threading.Lock()
+sas_cache_stats = {"key_fetches": 0, "key_hits": 0, "sas_hits": 0, "sas_misses": 0}
+
+
+BlobNames = namedtuple("BlobNames", ["account_name", "container_name", "blob_name"])
+
+
+@functools.lru_cache(maxsize=SAS_CACHE_MAX_ENTRIES)
+def blob_names(imageUrl):
+    # Account, container and blob name as the storage SDK parses them. A BlobClient builds a whole
+    # HTTP pipeline, so it is constructed once per URL rather than for every signature.
+    from azure.storage.blob import BlobClient
+
+    blob_client = BlobClient.from_blob_url(imageUrl)
+    return BlobNames(blob_client.account_name, blob_client.container_name, blob_client.blob_name)
+
+
+def _caller_identity(auth_header):
+    # Never keep the bearer token itself as a cache key
+    if not auth_header:
+        return "anonymous"
+    return hashlib.sha256(auth_header.encode("utf-8")).hexdigest()
+
+
+def _cached_delegation_key(cache_key, now):
+    with _sas_lock:
+        cached = _delegation_keys.get(cache_key)
+        if cached is None:
+            return None
+        if cached[1] - DELEGATION_KEY_RENEW_BEFORE <= now:
+            # Due for renewal, the next fetch replaces it
+            del _delegation_keys[cache_key]
+            return None
+        _delegation_keys.move_to_end(cache_key)
+        sas_cache_stats["key_hits"] += 1
+        return cached
+
+
+def _store_delegation_key(cache_key, user_delegation_key, now):
+    expiry = _parse_signed_time(user_delegation_key.signed_expiry) or now + datetime.timedelta(days=1)
+    cached = (user_delegation_key, expiry)
+    with _sas_lock:
+        _delegation_keys[cache_key] = cached
+        _delegation_keys.move_to_end(cache_key)
+        # Fetches are rare, so expired keys of callers that never came back are swept here
+        for key in [key for key, (_, key_expiry) in _delegation_keys.items() if key_expiry <= now]:
+            del _delegation_keys[key]
+        while len(_delegation_keys) > DELEGATION_KEY_CACHE_MAX_ENTRIES:
+            _delegation_keys.popitem(last=False)
+        sas_cache_stats["key_fetches"] += 1
+    return cached
+
+
+def get_cached_user_delegated_key(account_url, auth_header):
+    cache_key = (account_url, _caller_identity(auth_header))
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    cached = _cached_delegation_key(cache_key, now)
+    if cached is not None:
+        return cached
+
+    # Single flight per cache key: concurrent signers of the same account wait for one fetch
+    with _sas_lock:
+        entry = _delegation_key_locks.setdefault(cache_key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            cached = _cached_delegation_key(cache_key, now)
+            if cached is not None:
+                return cached
+            return _store_delegation_key(cache_key, get_user_delegated_key(account_url, auth_header), now)
+    finally:
+        with _sas_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _delegation_key_locks[cache_key]
+
+
+async def get_cached_user_delegated_key_async(account_url, auth_header):
+    # Same cache as get_cached_user_delegated_key; concurrent coroutines share one in-flight fetch
+    cache_key = (account_url, _caller_identity(auth_header))
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    cached = _cached_delegation_key(cache_key, now)
+    if cached is not None:
+        return cached
+
+    fetch = _delegation_key_fetches.get(cache_key)
+    if fetch is None:
+        async def fetch_and_store():
+            try:
+                user_delegation_key = await get_user_delegated_key_async(account_url, auth_header)
+                return _store_delegation_key(cache_key, user_delegation_key, now)
+            finally:
+                _delegation_key_fetches.pop(cache_key, None)
+
+        fetch = _delegation_key_fetches[cache_key] = asyncio.ensure_future(fetch_and_store())
+    # shield: a cancelled caller must not cancel the fetch the other signers are waiting for
+    return await asyncio.shield(fetch)
+
+
+def _signing_keys(imageUrl, auth_header):
+    # (account url, SAS cache key)
+    parsed_url = urlparse(imageUrl)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}", (_caller_identity(auth_header), imageUrl)
+
+
+def _cached_sas_token(sas_key, now):
+    with _sas_lock:
+        cached = _sas_tokens.get(sas_key)
+        if cached is not None and cached[1] - DELEGATION_KEY_RENEW_BEFORE > now:
+            _sas_tokens.move_to_end(sas_key)
+            sas_cache_stats["sas_hits"] += 1
+            return cached[0]
+        sas_cache_stats["sas_misses"] += 1
+    return None
+
+
+def _sign_and_store(imageUrl, sas_key, user_delegation_key, key_expiry, now):
+    expiry_time = min(now + datetime.timedelta(days=1), key_expiry)
+    sas_token = create_user_delegation_sas_token(blob_names(imageUrl), user_delegation_key, expiry_time)
+
+    with _sas_lock:
+        _sas_tokens[sas_key] = (sas_token, expiry_time)
+        _sas_tokens.move_to_end(sas_key)
+        while len(_sas_tokens) > SAS_CACHE_MAX_ENTRIES:
+            _sas_tokens.popitem(last=False)
+    return sas_token
+
+
+@metrics.timed("sas")
 def create_user_delegated_sas_token(imageUrl, auth_header):
     # Construct the blob endpoint from the account name
     # account_url = "https://<storage-account-name>.blob.core.windows.net"
-    parsed_url = urlparse(imageUrl)
-    account_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-
-    #Create a BlobServiceClient object using DefaultAzureCredential
-    # TODO: optimize service client to fetch all images in one go
-    # blob_service_client = BlobServiceClient(account_url, credential=DefaultAzureCredential())
-    user_delegation_key = get_user_delegated_key(account_url, auth_header)
-    # user_delegation_key = request_user_delegation_key(blob_service_client)
-    blob_client = BlobClient.from_blob_url(imageUrl, credential=user_delegation_key)
-    sas_token = create_user_delegation_sas_token(blob_client, user_delegation_key)
-    return sas_token
+    account_url, sas_key = _signing_keys(imageUrl, auth_header)
+    now = datetime.datetime.now(datetime.timezone.utc)
 
+    sas_token = _cached_sas_token(sas_key, now)
+    if sas_token is not None:
+        return sas_token
 
-# https://learn.microsoft.com/en-us/rest/api/storageservices/get-user-delegation-key
-def get_user_delegated_key(account_url, auth_header):
+    # One delegation key serves every result in the account
+    user_delegation_key, key_expiry = get_cached_user_delegated_key(account_url, auth_header)
+    return _sign_and_store(imageUrl, sas_key, user_delegation_key, key_expiry, now)
+
+
+@metrics.timed("sas")
+async def create_user_delegated_sas_token_async(imageUrl, auth_header):
+    account_url, sas_key = _signing_keys(imageUrl, auth_header)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    sas_token = _cached_sas_token(sas_key, now)
+    if sas_token is not None:
+        return sas_token
+
+    user_delegation_key, key_expiry = await get_cached_user_delegated_key_async(account_url, auth_header)
+    return _sign_and_store(imageUrl, sas_key, user_delegation_key, key_expiry, now)
+
+
+def _parse_signed_time(value):
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+
+
+def _user_delegation_key_request(account_url, auth_header):
+    # (url, headers, XML body) of the Get User Delegation Key call
     postfix = "?restype=service&comp=userdelegationkey"
     url = account_url + postfix
     delegation_key_start_time = datetime.datetime.now(datetime.timezone.utc)
     delegation_key_expiry_time = delegation_key_start_time + datetime.timedelta(days=1)
 
-    start_time_str = delegation_key_start_time.isoformat() + "Z"
-    expiry_time_str = delegation_key_expiry_time.isoformat() + "Z"
+    start_time_str = delegation_key_start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    expiry_time_str = delegation_key_expiry_time.strftime("%Y-%m-%dT%H:%M:%SZ")
 
     # XML body
     xml_body = f"""
-    <key-info>
-      <start>{start_time_str}</start>
-      <expiry>{expiry_time_str}</expiry>
-    </key-info>
+    <KeyInfo>
+      <Start>{start_time_str}</Start>
+      <Expiry>{expiry_time_str}</Expiry>
+    </KeyInfo>
     """
-    logging.info(f"XML body: {xml_body}")
+    logging.debug("XML body: %s", xml_body)
     headers = {
         "Authorization": auth_header,
         "x-ms-version": "2024-08-04",
         "Content-Type": "application/xml"
     }
+    return url, headers, xml_body
+
 
-    response = requests.post(url, headers=headers, data=xml_body)
+def _parse_user_delegation_key(content):
+    from azure.storage.blob import UserDelegationKey
+
+    # Parse the XML response into the SDK type generate_blob_sas expects
+    root = ET.fromstring(content)
+    user_delegation_key = UserDelegationKey()
+    user_delegation_key.signed_oid = root.findtext("SignedOid")
+    user_delegation_key.signed_tid = root.findtext("SignedTid")
+    user_delegation_key.signed_start = root.findtext("SignedStart")
+    user_delegation_key.signed_expiry = root.findtext("SignedExpiry")
+    user_delegation_key.signed_service = root.findtext("SignedService")
+    user_delegation_key.signed_version = root.findtext("SignedVersion")
+    user_delegation_key.value = root.findtext("Value")
+    return user_delegation_key
+
+
+# https://learn.microsoft.com/en-us/rest/api/storageservices/get-user-delegation-key
+@metrics.timed("delegation_key")
+def get_user_delegated_key(account_url, auth_header):
+    url, headers, xml_body = _user_delegation_key_request(account_url, auth_header)
+    response = transport.post(url, headers=headers, data=xml_body)
 
     if response.status_code == 200:
-        # Parse the XML response
-        root = ET.fromstring(response.content)
-        user_delegation_key = {
-            "SignedOid": root.findtext("SignedOid"),
-            "SignedTid": root.findtext("SignedTid"),
-            "SignedStart": root.findtext("SignedStart"),
-            "SignedExpiry": root.findtext("SignedExpiry"),
-            "SignedService": root.findtext("SignedService"),
-            "SignedVersion": root.findtext("SignedVersion"),
-            "Value": root.findtext("Value")
-        }
-        return user_delegation_key
+        return _parse_user_delegation_key(response.content)
     else:
         response.raise_for_status()
+
+
+@metrics.timed("delegation_key")
+async def get_user_delegated_key_async(account_url, auth_header):
+    url, headers, xml_body = _user_delegation_key_request(account_url, auth_header)
+    response = await async_transport.post(url, headers=headers, content=xml_body)
+
+    if response.status_code == 200:
+        return _parse_user_delegation_key(response.content)
+    else:
+        response.raise_for_status()
+
+
 def request_user_delegation_key(blob_service_client: BlobServiceClient) -> UserDelegationKey:
     # Get a user delegation key that's valid for 1 day
     delegation_key_start_time = datetime.datetime.now(datetime.timezone.utc)
@@ -127,10 +408,13 @@ def request_user_delegation_key(blob_service_client: BlobServiceClient) -> UserD
     return user_delegation_key
 
 
-def create_user_delegation_sas_token(blob_client: BlobClient, user_delegation_key: UserDelegationKey):
-    # Create a SAS token that's valid for one day, as an example
+def create_user_delegation_sas_token(blob_client: BlobClient | BlobNames, user_delegation_key: UserDelegationKey,
+                                     expiry_time=None):
+    from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+
+    # Create a SAS token that's valid for one day unless a shorter expiry is given
     start_time = datetime.datetime.now(datetime.timezone.utc)
-    expiry_time = start_time + datetime.timedelta(days=1)
+    expiry_time = expiry_time or start_time + datetime.timedelta(days=1)
 
     sas_token = generate_blob_sas(
         account_name=blob_client.account_name,
@@ -147,14 +431,14 @@ def create_user_delegation_sas_token(blob_client: BlobClient, user_delegation_ke
 # =========   END: USER DELEGATED SAS TOKEN =========
 
 
+@metrics.timed("service_sas")
 def create_service_sas_blob(imageUrl):
+    from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+
     #Env variables:
     account_key = os.environ["ACCOUNT_KEY"]
     
-    blob_client = BlobClient.from_blob_url(
-        blob_url=imageUrl,
-        credential=account_key
-    )
+    blob_client = blob_names(imageUrl)
     
     # Create a SAS token that's valid for one hour, as an example
     start_time = datetime.datetime.now(datetime.timezone.utc)
@@ -0,0 +1,163 @@
+import base64
+import binascii
+import os
+import threading
+
+
+# Inline image content for /vectorize and /indexraw.
+# Besides an imageUrl, a record can carry the image itself, which is sent to vectorizeImage as the
+# binary body: no SAS token is created and Vision does not fetch the blob. Three request shapes:
+#   - JSON records with data.imageData, a base64 string or a skillset file reference
+#     ({"$type": "file", "data": "<base64>"}, e.g. /document/normalized_images/* or /document/file_data),
+#   - an image/* or application/octet-stream body holding one image,
+#   - a multipart/form-data body with one image per part, the part name is its recordId.
+#
+# The Functions host hands the body over in one piece. Oversized requests are rejected from their
+# Content-Length before the body is touched; binary bodies are passed on as they are and multipart
+# parts are sliced out of the body once, so an image is never held in more than one extra copy.
+
+# Whole request body, JSON included
+IMAGE_INPUT_MAX_BODY_BYTES = int(os.getenv("IMAGE_INPUT_MAX_BODY_BYTES", str(64 * 1024 * 1024)))
+# One image; Vision rejects images larger than 20 MB
+IMAGE_INPUT_MAX_IMAGE_BYTES = int(os.getenv("IMAGE_INPUT_MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+
+input_stats = {"images": 0, "bytes": 0, "rejected": 0}
+_stats_lock = threading.Lock()
+
+
+class PayloadTooLarge(ValueError):
+    # Answered with 413
+    pass
+
+
+def _count(**amounts):
+    with _stats_lock:
+        for name, amount in amounts.items():
+            input_stats[name] += amount
+
+
+def parse_content_type(value):
+    # "multipart/form-data; boundary=x" -> ("multipart/form-data", {"boundary": "x"})
+    media_type, _, parameters = (value or "").partition(";")
+    return media_type.strip().lower(), _parameters(parameters)
+
+
+def _parameters(value):
+    parameters = {}
+    for parameter in value.split(";"):
+        name, _, parameter_value = parameter.strip().partition("=")
+        if name:
+            parameters[name.lower()] = parameter_value.strip().strip('"')
+    return parameters
+
+
+def is_binary(media_type):
+    return media_type == "application/octet-stream" or media_type.startswith("image/")
+
+
+def read_body(req, max_bytes=None):
+    # The request body, refused before it is read when its declared length is over max_bytes
+    max_bytes = max_bytes or IMAGE_INPUT_MAX_BODY_BYTES
+    length = req.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        _count(rejected=1)
+        raise PayloadTooLarge(f"Request body of {length} bytes is larger than {max_bytes}")
+    body = req.get_body()
+    if len(body) > max_bytes:
+        _count(rejected=1)
+        raise PayloadTooLarge(f"Request body of {len(body)} bytes is larger than {max_bytes}")
+    return body
+
+
+def _checked(image_bytes, record_id):
+    if not image_bytes:
+        raise ValueError(f"Record {record_id} has an empty image")
+    if len(image_bytes) > IMAGE_INPUT_MAX_IMAGE_BYTES:
+        _count(rejected=1)
+        raise PayloadTooLarge(f"Image of record {record_id} is {len(image_bytes)} bytes, "
+                              f"more than {IMAGE_INPUT_MAX_IMAGE_BYTES}")
+    return image_bytes
+
+
+def binary_values(req, record_id="1", image_url=None):
+    # Skill records for a binary or multipart request, None when the body is something else (JSON).
+    # Raises PayloadTooLarge or ValueError for bodies that cannot be used.
+    media_type, parameters = parse_content_type(req.headers.get("Content-Type"))
+    if media_type == "multipart/form-data":
+        if not parameters.get("boundary"):
+            raise ValueError("multipart/form-data body without a boundary")
+        body = read_body(req)
+        values = [_value(name, _checked(content, name), image_url)
+                  for name, content in multipart_parts(body, parameters["boundary"])]
+        if not values:
+            raise ValueError("multipart/form-data body without images")
+        return values
+    if is_binary(media_type):
+        return [_value(record_id, _checked(read_body(req), record_id), image_url)]
+    return None
+
+
+def _value(record_id, image_bytes, image_url):
+    # imageData holds decoded bytes here, image_bytes() passes them through
+    data = {"imageData": image_bytes}
+    if image_url:
+        data["imageUrl"] = image_url
+    return {"recordId": record_id, "data": data}
+
+
+def multipart_parts(body, boundary):
+    # Yields (name, content) of the parts that carry a file or a binary content type
+    delimiter = b"--" + boundary.encode("latin-1")
+    position = body.find(delimiter)
+    if position < 0:
+        raise ValueError("multipart/form-data body without its boundary")
+    position += len(delimiter)
+    index = 0
+    while not body.startswith(b"--", position):
+        headers_end = body.find(b"\r\n\r\n", position)
+        end = body.find(b"\r\n" + delimiter, headers_end)
+        if headers_end < 0 or end < 0:
+            raise ValueError("Malformed multipart/form-data body")
+        headers = {}
+        for line in body[position:headers_end].decode("latin-1").split("\r\n"):
+            name, _, value = line.partition(":")
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        disposition = _parameters(headers.get("content-disposition", "").partition(";")[2])
+        media_type = parse_content_type(headers.get("content-type", "text/plain"))[0]
+        index += 1
+        if "filename" in disposition or is_binary(media_type):
+            yield disposition.get("name") or str(index), body[headers_end + 4:end]
+        position = end + 2 + len(delimiter)
+
+
+def image_bytes(data, record_id=None):
+    # The inline image of a record's data as bytes, None for records that only have an imageUrl
+    value = data.get("imageData")
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        # Skillset file reference
+        value = value.get("data")
+    if isinstance(value, (bytes, bytearray)):
+        image = value
+    elif isinstance(value, str):
+        if value.startswith("data:"):
+            value = value.partition(",")[2]
+        if len(value) // 4 * 3 > IMAGE_INPUT_MAX_IMAGE_BYTES + 2:
+            _count(rejected=1)
+            raise PayloadTooLarge(f"Image of record {record_id} is more than {IMAGE_INPUT_MAX_IMAGE_BYTES} bytes")
+        try:
+            image = base64.b64decode(value, validate=True)
+        except (binascii.Error, ValueError) as e:
+            raise ValueError(f"imageData is not valid base64: {e}") from e
+    else:
+        raise ValueError("imageData must be a base64 string or a file reference")
+    _checked(image, record_id)
+    _count(images=1, bytes=len(image))
+    return image
+
+
+def stats():
+    with _stats_lock:
+        return dict(input_stats)
@@ -0,0 +1,130 @@
+import io
+import logging
+import os
+import threading
+
+from helpers import metrics, transport
+
+
+# Optional client-side preprocessing for vectorizeImage.
+# Instead of handing Vision a SAS URL to the full-resolution blob, the blob is downloaded, decoded at
+# reduced size, re-encoded as a JPEG no larger than IMAGE_MAX_SIDE and sent as the binary request body.
+# Requires Pillow; without it (or IMAGE_PREPROCESS=false) the URL mode is used.
+#
+# Memory stays bounded for very large images: downloads stop at IMAGE_MAX_DOWNLOAD_BYTES, JPEGs are
+# decoded directly at 1/2 .. 1/8 scale (draft mode), and other formats above IMAGE_MAX_DECODE_PIXELS
+# are left to Vision rather than decoded here.
+
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "false").lower() == "true"
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_MAX_DOWNLOAD_BYTES = int(os.getenv("IMAGE_MAX_DOWNLOAD_BYTES", str(64 * 1024 * 1024)))
+IMAGE_MAX_DECODE_PIXELS = int(os.getenv("IMAGE_MAX_DECODE_PIXELS", str(40_000_000)))
+# Images already this small are sent as downloaded, re-encoding would only cost time
+IMAGE_PASSTHROUGH_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_BYTES", str(256 * 1024)))
+
+# Formats Vision accepts as they are
+PASSTHROUGH_FORMATS = {"JPEG", "PNG", "GIF", "BMP", "WEBP"}
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+preprocess_stats = {"preprocessed": 0, "passthrough": 0, "fallbacks": 0, "bytes_downloaded": 0, "bytes_sent": 0}
+_stats_lock = threading.Lock()
+
+
+class PreprocessError(Exception):
+    # The image cannot be preprocessed here; the caller falls back to the URL mode
+    pass
+
+
+def available():
+    if not IMAGE_PREPROCESS:
+        return False
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _count(**amounts):
+    with _stats_lock:
+        for name, amount in amounts.items():
+            preprocess_stats[name] += amount
+
+
+def download(url, max_bytes=None):
+    # Streams the blob and gives up as soon as it is larger than max_bytes
+    max_bytes = max_bytes or IMAGE_MAX_DOWNLOAD_BYTES
+    response = transport.get(url, stream=True)
+    try:
+        if response.status_code != 200:
+            raise PreprocessError(f"Blob download returned {response.status_code}")
+        length = int(response.headers.get("Content-Length") or 0)
+        if length > max_bytes:
+            raise PreprocessError(f"Blob is {length} bytes, more than {max_bytes}")
+        buffer = bytearray()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+            buffer += chunk
+            if len(buffer) > max_bytes:
+                raise PreprocessError(f"Blob is more than {max_bytes} bytes")
+        return bytes(buffer)
+    finally:
+        response.close()
+
+
+def downscale(data, max_side=None, quality=None):
+    # Returns (image bytes, resized) for the vectorizeImage binary input
+    from PIL import Image, ImageOps
+
+    max_side = max_side or IMAGE_MAX_SIDE
+    quality = quality or IMAGE_JPEG_QUALITY
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        if max(width, height) <= max_side and len(data) <= IMAGE_PASSTHROUGH_BYTES \
+                and image.format in PASSTHROUGH_FORMATS:
+            return data, False
+
+        if image.format == "JPEG":
+            # libjpeg decodes straight to the smallest 1/2^n scale that is still >= max_side
+            image.draft("RGB", (max_side, max_side))
+        elif width * height > IMAGE_MAX_DECODE_PIXELS:
+            raise PreprocessError(f"{image.format} image of {width}x{height} is too large to decode here")
+
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        if image.mode != "RGB":
+            # JPEG has no alpha, transparent areas become white
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            rgba = image.convert("RGBA")
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            image = background
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=False)
+        return output.getvalue(), True
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise PreprocessError(f"Cannot decode image: {e}") from e
+
+
+@metrics.timed("image_preprocess")
+def prepare(image_url, data=None):
+    # image_url carries its SAS token; data is the blob when the caller has downloaded it already.
+    # Returns the bytes to send to vectorizeImage.
+    try:
+        data = download(image_url) if data is None else data
+        body, resized = downscale(data)
+    except PreprocessError:
+        _count(fallbacks=1, bytes_downloaded=len(data or b""))
+        raise
+    if resized:
+        _count(preprocessed=1, bytes_downloaded=len(data), bytes_sent=len(body))
+        logging.debug("Downscaled %s bytes to %s bytes", len(data), len(body))
+    else:
+        _count(passthrough=1, bytes_downloaded=len(data), bytes_sent=len(body))
+    return body
+
+
+def stats():
+    with _stats_lock:
+        return dict(preprocess_stats)
@@ -0,0 +1,419 @@
+import itertools
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from helpers import metrics
+
+
+# Work queue between the Event Grid trigger and vectorization.
+# INGEST_QUEUE=storage is the one to deploy: the Event Grid subscription delivers the BlobCreated events
+# into the Azure Storage queue INGEST_QUEUE_NAME and the ingest queue trigger works them off at the
+# concurrency set in host.json (extensions.queues). The queue is shared by all instances and outlives
+# them; the host retries a failed message after its visibility timeout and moves it to the
+# <INGEST_QUEUE_NAME>-poison queue after maxDequeueCount attempts. Nothing of it lives here.
+#
+# INGEST_QUEUE=memory or sqlite are the local queues below, for local runs and tests. The trigger
+# enqueues a small work item per blob (URL, ETag, sequencer); the ingest_drain timer leases batches of
+# INGEST_BATCH_SIZE, vectorizes them with INGEST_CONCURRENCY workers and indexes them. Items are deleted
+# once indexed; failed items are retried with backoff and moved to the poison queue after
+# INGEST_MAX_ATTEMPTS. Leases expire, so the items of a crashed drain become visible again
+# (at-least-once; indexing is an idempotent merge_or_upload). Events for a blob that is still waiting in
+# the queue update that item instead of adding another one. Both are local to one worker instance and
+# the events they hold are already acknowledged to Event Grid, so they are lost with the instance.
+
+INGEST_QUEUE = os.getenv("INGEST_QUEUE", "none").lower()
+# Storage queue of INGEST_QUEUE=storage and the app setting holding its connection
+INGEST_QUEUE_NAME = os.getenv("INGEST_QUEUE_NAME", "ingest")
+INGEST_QUEUE_CONNECTION = os.getenv("INGEST_QUEUE_CONNECTION", "AzureWebJobsStorage")
+LOCAL_QUEUES = ("memory", "sqlite")
+INGEST_QUEUE_PATH = os.getenv("INGEST_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "ingest-queue.sqlite"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "32"))
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "8"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))
+INGEST_RETRY_BASE_SECONDS = float(os.getenv("INGEST_RETRY_BASE_SECONDS", "5"))
+INGEST_RETRY_MAX_SECONDS = float(os.getenv("INGEST_RETRY_MAX_SECONDS", "600"))
+INGEST_LEASE_SECONDS = float(os.getenv("INGEST_LEASE_SECONDS", "300"))
+# Enqueueing fails beyond this depth, so Event Grid backs off and redelivers later
+INGEST_MAX_DEPTH = int(os.getenv("INGEST_MAX_DEPTH", "100000"))
+# Run time of one drain, below the function timeout
+INGEST_DRAIN_MAX_SECONDS = float(os.getenv("INGEST_DRAIN_MAX_SECONDS", "240"))
+
+Message = namedtuple("Message", ["id", "item", "attempts"])
+
+
+class QueueFull(Exception):
+    pass
+
+
+def retry_delay(attempts):
+    # Full jitter over an exponential backoff
+    return random.uniform(0.5, 1.0) * min(INGEST_RETRY_MAX_SECONDS, INGEST_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+
+
+class IngestQueue:
+    # Items are dicts {"url", "eTag", "sequencer", "recordId"}
+
+    def __init__(self, name, max_depth=INGEST_MAX_DEPTH):
+        self.name = name
+        self.max_depth = max_depth
+        self.counters = {"enqueued": 0, "coalesced": 0, "leased": 0, "acked": 0, "retried": 0, "poisoned": 0,
+                         "rejected": 0}
+
+    def put(self, items):
+        # Raises QueueFull without enqueueing anything when the items do not fit
+        raise NotImplementedError
+
+    def lease(self, max_items, lease_seconds=INGEST_LEASE_SECONDS):
+        # Up to max_items available messages, invisible to other leases for lease_seconds
+        raise NotImplementedError
+
+    def ack(self, message_ids):
+        raise NotImplementedError
+
+    def retry(self, message, error, delay):
+        # Makes the message available again after delay seconds, with one more attempt counted
+        raise NotImplementedError
+
+    def dead_letter(self, message, error):
+        raise NotImplementedError
+
+    def poison(self, limit=100):
+        # [{"id", "item", "attempts", "error", "failed_at"}] of the poison queue
+        raise NotImplementedError
+
+    def requeue_poison(self, message_ids=None):
+        # Moves poison messages (all when message_ids is None) back to the queue; returns how many
+        raise NotImplementedError
+
+    def depth(self):
+        raise NotImplementedError
+
+    def poison_depth(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"queue": self.name, "depth": self.depth(), "poison": self.poison_depth(), **self.counters}
+
+
+class MemoryIngestQueue(IngestQueue):
+    def __init__(self, max_depth=INGEST_MAX_DEPTH):
+        super().__init__("memory", max_depth)
+        self._messages = {}
+        self._poison = {}
+        # url -> id of its message that has not been leased yet, for coalescing
+        self._waiting = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _add(self, message_id, item, now):
+        self._messages[message_id] = {"item": dict(item), "attempts": 0, "available_at": now, "leased_until": 0.0}
+        self._waiting[item["url"]] = message_id
+
+    def put(self, items):
+        now = time.time()
+        with self._lock:
+            if len(self._messages) + len(items) > self.max_depth:
+                self.counters["rejected"] += len(items)
+                raise QueueFull(f"{self.name} ingest queue holds {len(self._messages)} items")
+            for item in items:
+                waiting = self._messages.get(self._waiting.get(item["url"]))
+                if waiting is not None:
+                    if (item.get("sequencer") or "") >= (waiting["item"].get("sequencer") or ""):
+                        waiting["item"] = dict(item)
+                    self.counters["coalesced"] += 1
+                    continue
+                self._add(next(self._ids), item, now)
+                self.counters["enqueued"] += 1
+
+    def lease(self, max_items, lease_seconds=INGEST_LEASE_SECONDS):
+        now = time.time()
+        leased = []
+        with self._lock:
+            for message_id, message in self._messages.items():
+                if len(leased) >= max_items:
+                    break
+                if message["available_at"] <= now and message["leased_until"] <= now:
+                    message["leased_until"] = now + lease_seconds
+                    if self._waiting.get(message["item"]["url"]) == message_id:
+                        del self._waiting[message["item"]["url"]]
+                    leased.append(Message(message_id, dict(message["item"]), message["attempts"]))
+            self.counters["leased"] += len(leased)
+        return leased
+
+    def ack(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                if self._messages.pop(message_id, None) is not None:
+                    self.counters["acked"] += 1
+
+    def retry(self, message, error, delay):
+        with self._lock:
+            stored = self._messages.get(message.id)
+            if stored is not None:
+                stored.update(attempts=message.attempts + 1, available_at=time.time() + delay, leased_until=0.0,
+                              error=error)
+                self.counters["retried"] += 1
+
+    def dead_letter(self, message, error):
+        with self._lock:
+            if self._messages.pop(message.id, None) is not None:
+                self._poison[message.id] = {"id": message.id, "item": message.item, "attempts": message.attempts + 1,
+                                            "error": error, "failed_at": time.time()}
+                self.counters["poisoned"] += 1
+
+    def poison(self, limit=100):
+        with self._lock:
+            return [dict(message) for message in list(self._poison.values())[:limit]]
+
+    def requeue_poison(self, message_ids=None):
+        now = time.time()
+        with self._lock:
+            ids = list(self._poison) if message_ids is None else [i for i in message_ids if i in self._poison]
+            for message_id in ids:
+                self._add(message_id, self._poison.pop(message_id)["item"], now)
+            return len(ids)
+
+    def depth(self):
+        return len(self._messages)
+
+    def poison_depth(self):
+        return len(self._poison)
+
+
+class SqliteIngestQueue(IngestQueue):
+    def __init__(self, path=INGEST_QUEUE_PATH, max_depth=INGEST_MAX_DEPTH):
+        super().__init__("sqlite", max_depth)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, "
+            "etag TEXT, sequencer TEXT, record_id TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "available_at REAL NOT NULL, leased_until REAL NOT NULL DEFAULT 0, error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_available ON messages (available_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_url ON messages (url)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS poison (id INTEGER PRIMARY KEY, url TEXT NOT NULL, etag TEXT, "
+            "sequencer TEXT, record_id TEXT, attempts INTEGER NOT NULL, error TEXT, failed_at REAL NOT NULL)"
+        )
+
+    def put(self, items):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                depth = self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+                if depth + len(items) > self.max_depth:
+                    self.counters["rejected"] += len(items)
+                    raise QueueFull(f"{self.name} ingest queue holds {depth} items")
+                for item in items:
+                    # A blob still waiting for its first attempt takes the newest event's ETag
+                    cursor = self._conn.execute(
+                        "UPDATE messages SET etag = ?, sequencer = ?, record_id = ? WHERE id = (SELECT id FROM "
+                        "messages WHERE url = ? AND attempts = 0 AND leased_until <= ? LIMIT 1) "
+                        "AND COALESCE(sequencer, '') <= ?",
+                        (item.get("eTag"), item.get("sequencer"), item.get("recordId"), item["url"], now,
+                         item.get("sequencer") or ""),
+                    )
+                    waiting = cursor.rowcount or self._conn.execute(
+                        "SELECT 1 FROM messages WHERE url = ? AND attempts = 0 AND leased_until <= ?",
+                        (item["url"], now),
+                    ).fetchone()
+                    if waiting:
+                        self.counters["coalesced"] += 1
+                        continue
+                    self._conn.execute(
+                        "INSERT INTO messages (url, etag, sequencer, record_id, available_at) VALUES (?, ?, ?, ?, ?)",
+                        (item["url"], item.get("eTag"), item.get("sequencer"), item.get("recordId"), now),
+                    )
+                    self.counters["enqueued"] += 1
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def lease(self, max_items, lease_seconds=INGEST_LEASE_SECONDS):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            rows = self._conn.execute(
+                "SELECT id, url, etag, sequencer, record_id, attempts FROM messages "
+                "WHERE available_at <= ? AND leased_until <= ? ORDER BY id LIMIT ?",
+                (now, now, max_items),
+            ).fetchall()
+            self._conn.executemany("UPDATE messages SET leased_until = ? WHERE id = ?",
+                                   [(now + lease_seconds, row[0]) for row in rows])
+            self._conn.execute("COMMIT")
+            self.counters["leased"] += len(rows)
+        return [
+            Message(message_id, {"url": url, "eTag": etag, "sequencer": sequencer, "recordId": record_id}, attempts)
+            for message_id, url, etag, sequencer, record_id, attempts in rows
+        ]
+
+    def ack(self, message_ids):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            cursor = self._conn.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in message_ids])
+            self._conn.execute("COMMIT")
+            self.counters["acked"] += max(0, cursor.rowcount)
+
+    def retry(self, message, error, delay):
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE messages SET attempts = ?, available_at = ?, leased_until = 0, error = ? WHERE id = ?",
+                (message.attempts + 1, time.time() + delay, error, message.id),
+            )
+            self.counters["retried"] += cursor.rowcount
+
+    def dead_letter(self, message, error):
+        item = message.item
+        with self._lock:
+            self._conn.execute("BEGIN")
+            cursor = self._conn.execute("DELETE FROM messages WHERE id = ?", (message.id,))
+            if cursor.rowcount:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO poison (id, url, etag, sequencer, record_id, attempts, error, failed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (message.id, item["url"], item.get("eTag"), item.get("sequencer"), item.get("recordId"),
+                     message.attempts + 1, error, time.time()),
+                )
+                self.counters["poisoned"] += 1
+            self._conn.execute("COMMIT")
+
+    def poison(self, limit=100):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, url, etag, sequencer, record_id, attempts, error, failed_at FROM poison ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            {"id": message_id, "item": {"url": url, "eTag": etag, "sequencer": sequencer, "recordId": record_id},
+             "attempts": attempts, "error": error, "failed_at": failed_at}
+            for message_id, url, etag, sequencer, record_id, attempts, error, failed_at in rows
+        ]
+
+    def requeue_poison(self, message_ids=None):
+        where, params = ("", ()) if message_ids is None else (
+            f"WHERE id IN ({','.join('?' * len(message_ids))})", tuple(message_ids))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            cursor = self._conn.execute(
+                "INSERT INTO messages (id, url, etag, sequencer, record_id, available_at) "
+                f"SELECT id, url, etag, sequencer, record_id, ? FROM poison {where}",
+                (time.time(), *params),
+            )
+            self._conn.execute(f"DELETE FROM poison {where}", params)
+            self._conn.execute("COMMIT")
+            return cursor.rowcount
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def poison_depth(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM poison").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_UNSET = object()
+_queue = _UNSET
+_queue_lock = threading.Lock()
+_drain_lock = threading.Lock()
+
+
+def create_queue(kind=INGEST_QUEUE):
+    # The local queue of kind; None when there is none (storage queues belong to the Functions host)
+    if kind in ("none", "off", "false", "", "storage"):
+        return None
+    if os.getenv("WEBSITE_INSTANCE_ID"):
+        logging.warning(f"Ingest queue: INGEST_QUEUE={kind} is local to this instance and loses its items "
+                        f"on recycle or scale-in, use INGEST_QUEUE=storage")
+    if kind == "memory":
+        return MemoryIngestQueue()
+    if kind == "sqlite":
+        try:
+            return SqliteIngestQueue()
+        except sqlite3.Error as e:
+            logging.warning(f"Ingest queue: sqlite unavailable ({e}), using memory")
+            return MemoryIngestQueue()
+    raise ValueError(f"Unknown INGEST_QUEUE '{kind}', expected none, storage, memory or sqlite")
+
+
+def get_queue():
+    global _queue
+    if _queue is _UNSET:
+        with _queue_lock:
+            if _queue is _UNSET:
+                _queue = create_queue()
+    return _queue
+
+
+def set_queue(queue):
+    # Plug in another implementation (or None to index inline in the trigger)
+    global _queue
+    with _queue_lock:
+        _queue = queue
+
+
+def drain(process, queue=None, batch_size=None, max_seconds=None):
+    # Leases and processes batches until the queue has nothing available or max_seconds have passed.
+    # process(messages) returns {message id: error message or None}; ids it leaves out are retried.
+    # Returns the drain's counters; a drain already running on this worker makes this one return at once.
+    queue = queue or get_queue()
+    batch_size = batch_size or INGEST_BATCH_SIZE
+    deadline = time.monotonic() + (INGEST_DRAIN_MAX_SECONDS if max_seconds is None else max_seconds)
+    result = {"batches": 0, "succeeded": 0, "retried": 0, "poisoned": 0}
+    if queue is None or not _drain_lock.acquire(blocking=False):
+        return result
+    try:
+        while time.monotonic() < deadline:
+            messages = queue.lease(batch_size)
+            if not messages:
+                break
+            with metrics.stage("ingest_batch"):
+                try:
+                    errors = process(messages)
+                except Exception as e:
+                    logging.error(f"Ingest batch of {len(messages)} failed: {e}")
+                    errors = {message.id: str(e) for message in messages}
+            succeeded = []
+            for message in messages:
+                error = errors.get(message.id, "not processed")
+                if error is None:
+                    succeeded.append(message.id)
+                elif message.attempts + 1 >= INGEST_MAX_ATTEMPTS:
+                    logging.error(f"Ingest of {message.item['url']} failed {message.attempts + 1} times, "
+                                  f"moved to the poison queue: {error}")
+                    queue.dead_letter(message, error)
+                    result["poisoned"] += 1
+                else:
+                    queue.retry(message, error, retry_delay(message.attempts + 1))
+                    result["retried"] += 1
+            queue.ack(succeeded)
+            result["succeeded"] += len(succeeded)
+            result["batches"] += 1
+    finally:
+        _drain_lock.release()
+    return result
+
+
+def stats():
+    queue = get_queue()
+    if queue is not None:
+        return queue.stats()
+    if INGEST_QUEUE == "storage":
+        return {"queue": "storage", "name": INGEST_QUEUE_NAME}
+    return {"queue": "disabled"}
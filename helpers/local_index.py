@@ -0,0 +1,154 @@
+import json
+import os
+
+import numpy as np
+
+
+# In-process vector index for the /search path.
+# Layout of an index directory:
+#   vectors.f32    N x D float32 matrix, rows L2-normalized, opened as a read-only memmap
+#   metadata.json  dimensions, count and one {"id", "imageUrl", "title"} entry per row
+#   ivf.npz        optional approximate index (IVF centroids + row assignments)
+
+VECTORS_FILE = "vectors.f32"
+METADATA_FILE = "metadata.json"
+IVF_FILE = "ivf.npz"
+
+LOCAL_INDEX_CHUNK_ROWS = int(os.getenv("LOCAL_INDEX_CHUNK_ROWS", "65536"))
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def cosine_to_score(similarity):
+    # Azure AI Search reports cosine matches as 1 / (1 + distance), distance = 1 - cosine
+    return 1.0 / (2.0 - similarity)
+
+
+def _top_k(scores, k):
+    # Unsorted top-k per row, followed by a sort of just those k
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def write_index(path, documents, vectors, dimensions=1024):
+    # documents: list of {"id", "imageUrl", "title"}; vectors: matching N x D array
+    os.makedirs(path, exist_ok=True)
+    matrix = normalize(vectors) if len(documents) else np.empty((0, dimensions), dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[0] != len(documents):
+        raise ValueError(f"Expected {len(documents)} vectors, got shape {matrix.shape}")
+    matrix.tofile(os.path.join(path, VECTORS_FILE))
+    metadata = {"dimensions": int(matrix.shape[1]), "count": len(documents), "documents": documents}
+    with open(os.path.join(path, METADATA_FILE), "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+    ivf_path = os.path.join(path, IVF_FILE)
+    if os.path.exists(ivf_path):
+        # Assignments no longer match the rows
+        os.remove(ivf_path)
+
+
+class LocalVectorIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, METADATA_FILE), encoding="utf-8") as f:
+            metadata = json.load(f)
+        self.dimensions = metadata["dimensions"]
+        self.documents = metadata["documents"]
+        count = metadata["count"]
+        if count:
+            self.vectors = np.memmap(
+                os.path.join(path, VECTORS_FILE), dtype=np.float32, mode="r", shape=(count, self.dimensions)
+            )
+        else:
+            self.vectors = np.empty((0, self.dimensions), dtype=np.float32)
+        self.centroids = None
+        self.lists = None
+        ivf_path = os.path.join(path, IVF_FILE)
+        if os.path.exists(ivf_path):
+            self._load_ivf(ivf_path)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def search(self, vector, k=5, nprobe=None):
+        return self.search_many([vector], k, nprobe)[0]
+
+    def search_many(self, queries, k=5, nprobe=None):
+        # Returns, per query, a list of (row, cosine similarity) sorted best first
+        queries = normalize(np.atleast_2d(queries))
+        if queries.shape[1] != self.dimensions:
+            raise ValueError(f"Query has {queries.shape[1]} dimensions, index has {self.dimensions}")
+        if nprobe and self.centroids is not None:
+            return [self._search_ivf(query, k, nprobe) for query in queries]
+        return self._search_exact(queries, k)
+
+    def _search_exact(self, queries, k):
+        # Exact top-k over the memmap in row chunks, merging each chunk into the running best
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.documents), LOCAL_INDEX_CHUNK_ROWS):
+            block = self.vectors[start:start + LOCAL_INDEX_CHUNK_ROWS]
+            scores = queries @ block.T
+            rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+            keep = _top_k(scores, k)
+            best_scores = np.take_along_axis(scores, keep, axis=1)
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+        return [
+            [(int(row), float(score)) for row, score in zip(query_rows, query_scores)]
+            for query_rows, query_scores in zip(best_rows, best_scores)
+        ]
+
+    # ----- approximate search (IVF) -----
+
+    def build_ivf(self, nlist=None, iterations=10, sample_size=50000, seed=0):
+        # Coarse k-means quantizer; a query only scans the rows of its nprobe closest centroids
+        count = len(self.documents)
+        if count == 0:
+            return
+        nlist = nlist or max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(seed)
+        sample = self.vectors[np.sort(rng.choice(count, size=min(count, sample_size), replace=False))]
+        centroids = np.array(sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)])
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(len(centroids)):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize(centroids)
+
+        assignments = np.empty(count, dtype=np.int32)
+        for start in range(0, count, LOCAL_INDEX_CHUNK_ROWS):
+            block = self.vectors[start:start + LOCAL_INDEX_CHUNK_ROWS]
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        np.savez(os.path.join(self.path, IVF_FILE), centroids=centroids, assignments=assignments)
+        self._set_ivf(centroids, assignments)
+
+    def _load_ivf(self, ivf_path):
+        with np.load(ivf_path) as ivf:
+            self._set_ivf(ivf["centroids"], ivf["assignments"])
+
+    def _set_ivf(self, centroids, assignments):
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        self.centroids = centroids
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(centroids))]
+
+    def _search_ivf(self, query, k, nprobe):
+        probes = np.argsort(-(self.centroids @ query))[:nprobe]
+        rows = np.sort(np.concatenate([self.lists[c] for c in probes]))
+        if len(rows) == 0:
+            return []
+        scores = self.vectors[rows] @ query
+        keep = _top_k(scores[np.newaxis, :], k)[0]
+        return [(int(rows[i]), float(scores[i])) for i in keep]
@@ -0,0 +1,237 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Per-stage latency instrumentation.
+# Every stage (OpenAI rephrase, Vision calls, SAS signing, search, index uploads) records its duration
+# into an in-process histogram of this worker. Stages that run inside an HTTP request are also collected
+# per request and returned as a Server-Timing header and one structured "request_metrics" log line.
+
+# Histogram buckets grow geometrically from 0.1 ms to about 2 minutes, ~5% relative error on percentiles
+HISTOGRAM_MIN_MS = 0.1
+HISTOGRAM_GROWTH = 1.1
+HISTOGRAM_BUCKETS = 150
+METRICS_LOG_REQUESTS = os.getenv("METRICS_LOG_REQUESTS", "true").lower() == "true"
+
+_log_growth = math.log(HISTOGRAM_GROWTH)
+
+
+def _bucket(duration_ms):
+    if duration_ms <= HISTOGRAM_MIN_MS:
+        return 0
+    return min(HISTOGRAM_BUCKETS - 1, 1 + int(math.log(duration_ms / HISTOGRAM_MIN_MS) / _log_growth))
+
+
+def _bucket_bounds(index):
+    if index == 0:
+        return 0.0, HISTOGRAM_MIN_MS
+    return HISTOGRAM_MIN_MS * HISTOGRAM_GROWTH ** (index - 1), HISTOGRAM_MIN_MS * HISTOGRAM_GROWTH ** index
+
+
+class Histogram:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, duration_ms, error=False):
+        index = _bucket(duration_ms)
+        with self._lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total_ms += duration_ms
+            self.max_ms = max(self.max_ms, duration_ms)
+            if error:
+                self.errors += 1
+
+    def percentile(self, p):
+        # Linear interpolation inside the bucket holding the p-th sample, capped at the observed maximum
+        with self._lock:
+            if not self.count:
+                return None
+            rank = p / 100 * self.count
+            seen = 0
+            for index, bucket_count in enumerate(self.buckets):
+                if bucket_count and seen + bucket_count >= rank:
+                    low, high = _bucket_bounds(index)
+                    return min(self.max_ms, low + (high - low) * (rank - seen) / bucket_count)
+                seen += bucket_count
+            return self.max_ms
+
+    def summary(self):
+        with self._lock:
+            count, errors, total_ms, max_ms = self.count, self.errors, self.total_ms, self.max_ms
+        return {
+            "count": count,
+            "errors": errors,
+            "error_rate": errors / count if count else 0.0,
+            "mean_ms": round(total_ms / count, 3) if count else None,
+            "p50_ms": _round(self.percentile(50)),
+            "p95_ms": _round(self.percentile(95)),
+            "p99_ms": _round(self.percentile(99)),
+            "max_ms": round(max_ms, 3) if count else None,
+        }
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+class RequestTimings:
+    # Stage durations of a single request, in the order the stages finished
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, duration_ms, error=False):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"count": 0, "errors": 0, "duration_ms": 0.0})
+            entry["count"] += 1
+            entry["duration_ms"] += duration_ms
+            if error:
+                entry["errors"] += 1
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self):
+        # Stages that ran several times (e.g. one SAS per result) are summed into one entry
+        with self._lock:
+            stages = list(self.stages.items())
+        parts = []
+        for stage, entry in stages:
+            part = f"{stage};dur={entry['duration_ms']:.1f}"
+            if entry["count"] > 1:
+                part += f';desc="{entry["count"]} calls"'
+            parts.append(part)
+        parts.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(parts)
+
+    def to_dict(self):
+        with self._lock:
+            stages = {stage: dict(entry, duration_ms=round(entry["duration_ms"], 3))
+                      for stage, entry in self.stages.items()}
+        return {"route": self.route, "total_ms": round(self.elapsed_ms(), 3), "stages": stages}
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def histogram(stage):
+    entry = _histograms.get(stage)
+    if entry is None:
+        with _histograms_lock:
+            entry = _histograms.setdefault(stage, Histogram())
+    return entry
+
+
+def record(stage, duration_ms, error=False):
+    histogram(stage).record(duration_ms, error)
+    timings = _current_request.get()
+    if timings is not None:
+        timings.add(stage, duration_ms, error)
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record(name, (time.perf_counter() - started) * 1000, error)
+
+
+def timed(name):
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def track_request(route):
+    # Collects the stages of the current request, including those run on pool threads through bind()
+    timings = RequestTimings(route)
+    token = _current_request.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_request.reset(token)
+        record(f"request.{route}", timings.elapsed_ms())
+        if METRICS_LOG_REQUESTS:
+            logging.info(f"request_metrics {json.dumps(timings.to_dict())}")
+
+
+def timed_request(route):
+    # Wraps an HTTP handler: its stages are collected and returned in a Server-Timing header.
+    # Async handlers stay coroutine functions, so the Functions host still runs them on its event loop.
+    def decorator(func):
+        def finish(response, timings):
+            headers = getattr(response, "headers", None)
+            if headers is not None:
+                headers["Server-Timing"] = timings.server_timing()
+            return response
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with track_request(route) as timings:
+                    return finish(await func(*args, **kwargs), timings)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_request(route) as timings:
+                return finish(func(*args, **kwargs), timings)
+        return wrapper
+    return decorator
+
+
+def bind(func):
+    # Thread pools do not inherit context variables, so func runs in a copy of the caller's context.
+    # Each call gets its own copy because one context cannot be entered by two threads at once.
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+def snapshot():
+    with _histograms_lock:
+        stages = dict(_histograms)
+    return {name: stages[name].summary() for name in sorted(stages)}
+
+
+def reset():
+    with _histograms_lock:
+        _histograms.clear()
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import random
+import re
+import zlib
+from array import array
+
+
+# Payload logging for the hot paths.
+# Request and response bodies are logged through log_payload(), which
+#   - returns before any formatting when the level is disabled or the record is not sampled,
+#   - summarizes vectors as their length and a CRC32 of the float32 bytes instead of 1024 numbers,
+#   - truncates long strings and lists,
+#   - redacts secrets: SAS signatures, keys, tokens and Authorization headers.
+
+PAYLOAD_LOG_LEVEL = logging.getLevelName(os.getenv("PAYLOAD_LOG_LEVEL", "DEBUG").upper())
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv("PAYLOAD_LOG_SAMPLE_RATE", "1.0"))
+PAYLOAD_LOG_MAX_CHARS = int(os.getenv("PAYLOAD_LOG_MAX_CHARS", "256"))
+PAYLOAD_LOG_MAX_ITEMS = int(os.getenv("PAYLOAD_LOG_MAX_ITEMS", "20"))
+
+REDACTED = "***"
+# Dictionary keys whose values are never logged
+_secret_keys = re.compile(r"(key|secret|token|password|authorization|credential|signature|^sig$)", re.IGNORECASE)
+# SAS signatures and similar credentials carried in URLs and free text
+_secret_params = re.compile(r"(?i)\b(sig|signature|api[-_]?key|access[-_]?token|code)=([^&\s\"']+)")
+_bearer = re.compile(r"(?i)\b(bearer|sharedkey)\s+[A-Za-z0-9._~+/:=-]+")
+
+
+def redact(text):
+    text = _secret_params.sub(lambda match: f"{match.group(1)}={REDACTED}", text)
+    return _bearer.sub(lambda match: f"{match.group(1)} {REDACTED}", text)
+
+
+def truncate(text, max_chars=None):
+    max_chars = max_chars or PAYLOAD_LOG_MAX_CHARS
+    text = redact(str(text))
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}...(+{len(text) - max_chars} chars)"
+
+
+def vector_summary(vector):
+    vector = vector if isinstance(vector, array) and vector.typecode == "f" else array("f", vector)
+    return f"<vector dims={len(vector)} crc32={zlib.crc32(vector.tobytes()):08x}>"
+
+
+def _is_vector(value):
+    if isinstance(value, array):
+        return value.typecode in "fd"
+    return (isinstance(value, (list, tuple)) and len(value) > PAYLOAD_LOG_MAX_ITEMS
+            and all(isinstance(item, float) for item in value[:PAYLOAD_LOG_MAX_ITEMS]))
+
+
+def summarize(value):
+    # A log-safe copy of value: vectors summarized, secrets redacted, strings and lists truncated
+    if _is_vector(value):
+        return vector_summary(value)
+    if isinstance(value, dict):
+        if str(value.get("encoding")).startswith("base64-") and isinstance(value.get("data"), str):
+            # A compact vector from vector_codec.encode
+            return f"<{value['encoding']} dims={value.get('dimensions')} crc32={zlib.crc32(value['data'].encode()):08x}>"
+        return {
+            str(key): REDACTED if _secret_keys.search(str(key)) and item else summarize(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        items = [summarize(item) for item in value[:PAYLOAD_LOG_MAX_ITEMS]]
+        if len(value) > PAYLOAD_LOG_MAX_ITEMS:
+            items.append(f"...(+{len(value) - PAYLOAD_LOG_MAX_ITEMS} items)")
+        return items
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, str):
+        return truncate(value)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return truncate(value)
+
+
+class Payload:
+    # Formats on str(), so it costs nothing when the logging call drops the record
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(summarize(self.value), default=str)
+
+
+def log_payload(message, value, level=None, sample_rate=None, logger=None):
+    # value may be a callable, so building the payload itself is skipped for dropped records
+    logger = logger or logging.getLogger()
+    level = level or PAYLOAD_LOG_LEVEL
+    if not logger.isEnabledFor(level):
+        return
+    sample_rate = PAYLOAD_LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    if callable(value):
+        value = value()
+    logger.log(level, "%s: %s", message, Payload(value))
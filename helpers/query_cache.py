@@ -0,0 +1,190 @@
+import asyncio
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+# TTL + LRU caches for the /search query stages (OpenAI rephrase and Vision text embedding).
+# Concurrent lookups of the same key are coalesced so only one upstream call is in flight.
+
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "3600"))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "1000"))
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_query(text):
+    # Case, width and whitespace variants of the same query share one cache entry
+    text = unicodedata.normalize("NFKC", text or "")
+    return _whitespace.sub(" ", text).strip().casefold()
+
+
+class _Flight:
+    # One upstream call and its waiters: threads wait on the event, coroutines on a future of their
+    # own loop, so an async waiter never holds a thread while the call is in flight
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._futures = []
+
+    def finish(self):
+        with self._lock:
+            self.done.set()
+            futures, self._futures = self._futures, []
+        for loop, future in futures:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                # The waiter's loop is closed, nobody is waiting any more
+                pass
+
+    async def wait_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if not self.done.is_set():
+                self._futures.append((loop, future))
+            else:
+                future.set_result(None)
+        await future
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SingleFlightCache:
+    def __init__(self, name, ttl=QUERY_CACHE_TTL_SECONDS, max_entries=QUERY_CACHE_MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def _start(self, key):
+        # (hit, value) on a cached entry, otherwise (False, (flight, leader))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+                del self._entries[key]
+                self.expired += 1
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        return False, (flight, leader)
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _finish(self, key, flight):
+        with self._lock:
+            self._inflight.pop(key, None)
+        flight.finish()
+
+    def get_or_compute(self, key, compute):
+        hit, value = self._start(key)
+        if hit:
+            return value
+        flight, leader = value
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            # Failures are handed to the waiters but never cached
+            flight.error = e
+            raise
+        else:
+            self._store(key, flight.value)
+            return flight.value
+        finally:
+            self._finish(key, flight)
+
+    async def get_or_compute_async(self, key, compute):
+        # compute is a coroutine function. Entries and in-flight calls are shared with get_or_compute,
+        # so a sync and an async search of the same query still make one upstream call.
+        hit, value = self._start(key)
+        if hit:
+            return value
+        flight, leader = value
+
+        if leader:
+            # The call runs as a task of its own: a leader that is cancelled only stops waiting, the
+            # call still completes for the other waiters and the cache
+            task = asyncio.ensure_future(compute())
+            task.add_done_callback(lambda task: self._complete(key, flight, task))
+        return await flight.wait_async()
+
+    def _complete(self, key, flight, task):
+        if task.cancelled():
+            # Only when the loop shuts down; failures are handed to the waiters but never cached
+            flight.error = asyncio.CancelledError()
+        elif task.exception() is not None:
+            flight.error = task.exception()
+        else:
+            flight.value = task.result()
+            self._store(key, flight.value)
+        self._finish(key, flight)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "cache": self.name,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                # Coalesced lookups did not pay for an upstream call either
+                "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            }
+
+
+rephrase_cache = SingleFlightCache("rephrase")
+text_embedding_cache = SingleFlightCache("text_embedding")
+
+
+def stats():
+    return [rephrase_cache.stats(), text_embedding_cache.stats()]
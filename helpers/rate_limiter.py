@@ -0,0 +1,221 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from helpers import metrics
+
+
+# Adaptive token bucket shared by every Vision call of this worker.
+# Calls take a token before each attempt (retries included). The rate follows AIMD: it grows by
+# VISION_RATE_INCREASE requests/s for every second of successful calls and is multiplied by
+# VISION_RATE_DECREASE on a 429, at most once per second, while Retry-After pauses the bucket.
+# Waiting calls are served by priority, so interactive /search text embeddings go ahead of bulk
+# image ingestion; within one priority they are served in arrival order.
+# Each worker instance adapts on its own; scaled-out instances converge on their share of the quota.
+# Off by default: set VISION_RATE_LIMIT to the Vision resource's TPS quota divided by the instance count.
+
+VISION_RATE_LIMIT = float(os.getenv("VISION_RATE_LIMIT", "0"))
+VISION_RATE_MIN = float(os.getenv("VISION_RATE_MIN", "1"))
+VISION_RATE_MAX = float(os.getenv("VISION_RATE_MAX", "100"))
+VISION_RATE_INCREASE = float(os.getenv("VISION_RATE_INCREASE", "1"))
+VISION_RATE_DECREASE = float(os.getenv("VISION_RATE_DECREASE", "0.5"))
+VISION_RATE_MAX_WAIT_SECONDS = float(os.getenv("VISION_RATE_MAX_WAIT_SECONDS", "30"))
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, name, rate, min_rate=1.0, max_rate=None, increase=1.0, decrease=0.5,
+                 max_wait=30.0):
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.increase = increase
+        self.decrease = decrease
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        # One second of burst at the current rate
+        self._tokens = max(1.0, rate)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = float("-inf")
+        self._waiters = []
+        self._wakeups = {}
+        self._sequence = itertools.count()
+        self.counters = {"acquired": 0, "waited": 0, "timeouts": 0, "throttled": 0, "decreases": 0,
+                         "max_queue_depth": 0}
+
+    def _refill(self, now):
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=BULK, timeout=None):
+        # Blocks until this call may go ahead; returns the seconds waited
+        started = time.monotonic()
+        deadline = started + (self.max_wait if timeout is None else timeout)
+        entry = self._enqueue(priority)
+        with self._cond:
+            try:
+                while True:
+                    wait = self._take(entry, started, deadline)
+                    if wait is None:
+                        break
+                    self._cond.wait(wait)
+            finally:
+                self._dequeue(entry)
+        return self._acquired(priority, started)
+
+    async def acquire_async(self, priority=BULK, timeout=None):
+        # acquire() for coroutines: the wait is a future of the running loop, woken like the waiting
+        # threads, so a queued async call holds no thread
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        deadline = started + (self.max_wait if timeout is None else timeout)
+        entry = self._enqueue(priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._take(entry, started, deadline)
+                    if wait is None:
+                        break
+                    wakeup = loop.create_future()
+                    self._wakeups[entry] = (loop, wakeup)
+                timer = loop.call_later(wait, _wake, wakeup)
+                try:
+                    await wakeup
+                finally:
+                    timer.cancel()
+                    with self._cond:
+                        self._wakeups.pop(entry, None)
+        finally:
+            with self._cond:
+                self._dequeue(entry)
+        return self._acquired(priority, started)
+
+    def _enqueue(self, priority):
+        entry = (priority, next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            self.counters["max_queue_depth"] = max(self.counters["max_queue_depth"], len(self._waiters))
+        return entry
+
+    def _take(self, entry, started, deadline):
+        # Under self._cond: None once entry has its token, otherwise the seconds to wait before looking again
+        now = time.monotonic()
+        self._refill(now)
+        first = self._waiters[0] == entry
+        if first and now >= self._paused_until and self._tokens >= 1:
+            self._tokens -= 1
+            return None
+        if now >= deadline:
+            self.counters["timeouts"] += 1
+            raise RateLimitTimeout(
+                f"{self.name}: no capacity within {deadline - started:.1f}s at {self.rate:.1f} requests/s"
+            )
+        # Only the first waiter sleeps on the bucket, the others until it is their turn
+        wait = deadline - now
+        if first:
+            wait = min(wait, max(self._paused_until - now, (1 - self._tokens) / self.rate))
+        return wait
+
+    def _dequeue(self, entry):
+        # Under self._cond
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+        self._notify()
+
+    def _notify(self):
+        # Under self._cond: wakes the waiting threads and coroutines
+        self._cond.notify_all()
+        for loop, wakeup in self._wakeups.values():
+            try:
+                loop.call_soon_threadsafe(_wake, wakeup)
+            except RuntimeError:
+                # Closed loop
+                pass
+
+    def _acquired(self, priority, started):
+        waited = time.monotonic() - started
+        with self._cond:
+            self.counters["acquired"] += 1
+            if waited > 0.001:
+                self.counters["waited"] += 1
+        metrics.record(f"{self.name}_wait_{PRIORITY_NAMES.get(priority, priority)}", waited * 1000)
+        return waited
+
+    def succeeded(self):
+        # Additive increase: about `increase` requests/s more per second of successful calls
+        with self._cond:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def throttled(self, retry_after=None):
+        now = time.monotonic()
+        with self._cond:
+            self.counters["throttled"] += 1
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            # Calls sent before the last decrease report their 429s too, they must not compound it
+            if now - self._last_decrease >= 1.0:
+                self._last_decrease = now
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._tokens = min(self._tokens, max(1.0, self.rate))
+                self.counters["decreases"] += 1
+                logging.warning("%s throttled, rate lowered to %.2f requests/s", self.name, self.rate)
+            self._notify()
+
+    def stats(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            queued = {}
+            for priority, _ in self._waiters:
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                queued[name] = queued.get(name, 0) + 1
+            return {
+                "rate": round(self.rate, 3),
+                "tokens": round(self._tokens, 3),
+                "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 3),
+                "queue_depth": len(self._waiters),
+                "queued": queued,
+                **self.counters,
+            }
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def vision():
+    # None when VISION_RATE_LIMIT=0
+    limiter = _limiters.get("vision")
+    if limiter is None and VISION_RATE_LIMIT > 0:
+        with _lock:
+            limiter = _limiters.get("vision")
+            if limiter is None:
+                limiter = _limiters["vision"] = AdaptiveRateLimiter(
+                    "vision", VISION_RATE_LIMIT, min_rate=VISION_RATE_MIN,
+                    max_rate=max(VISION_RATE_MAX, VISION_RATE_LIMIT), increase=VISION_RATE_INCREASE,
+                    decrease=VISION_RATE_DECREASE, max_wait=VISION_RATE_MAX_WAIT_SECONDS,
+                )
+    return limiter
+
+
+def stats():
+    with _lock:
+        limiters = dict(_limiters)
+    return {name: limiter.stats() for name, limiter in limiters.items()}
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers import async_transport
+
+
+# Pluggable vector search for /search.
+# Every backend returns hits shaped like Azure AI Search results: {"id", "title", "imageUrl", "@search.score"}.
+#   azure  - the remote Azure AI Search index
+#   local  - an in-process LocalVectorIndex (see helpers/local_index.py)
+#   hot    - a local index exported from the remote one, answering before it when it is confident
+
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "azure").lower()
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "local-index")
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "0"))
+HOT_SET_MIN_SCORE = float(os.getenv("HOT_SET_MIN_SCORE", "0.8"))
+LOCAL_SEARCH_WORKERS = int(os.getenv("LOCAL_SEARCH_WORKERS", str(os.cpu_count() or 4)))
+
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+
+
+def _scan_executor():
+    global _scan_pool
+    if _scan_pool is None:
+        with _scan_pool_lock:
+            if _scan_pool is None:
+                _scan_pool = ThreadPoolExecutor(max_workers=LOCAL_SEARCH_WORKERS, thread_name_prefix="local-search")
+    return _scan_pool
+
+
+class SearchBackend:
+    name = "base"
+
+    def search(self, vector, k, offset=0):
+        # Hits offset .. offset + k of the k-nearest-neighbour ranking
+        raise NotImplementedError
+
+    async def search_async(self, vector, k, offset=0):
+        # In-process backends scan on a thread, a scan of a large index would stall the event loop. The scan
+        # is CPU work, so the pool has a thread per core and async searches never take more than that.
+        return await asyncio.get_running_loop().run_in_executor(_scan_executor(), self.search, vector, k, offset)
+
+    def paged(self):
+        # The backend for every page of a paginated search, so that all pages come from one ranking
+        return self
+
+
+class AzureSearchBackend(SearchBackend):
+    name = "azure"
+
+    def __init__(self, search_client=None):
+        self._search_client = search_client
+        self._lock = threading.Lock()
+
+    @property
+    def search_client(self):
+        if self._search_client is None:
+            with self._lock:
+                if self._search_client is None:
+                    # Imported here so the Search SDK is only loaded when the remote index is actually used
+                    from azure.core.credentials import AzureKeyCredential
+                    from azure.search.documents import SearchClient
+
+                    logging.info(f"Creating search client for index {os.environ['AI_SEARCH_INDEX_NAME']}")
+                    self._search_client = SearchClient(
+                        os.environ["AI_SEARCH_SERVICE_ENDPOINT"],
+                        os.environ["AI_SEARCH_INDEX_NAME"],
+                        AzureKeyCredential(os.environ["AZURE_SEARCH_ADMIN_KEY"]),
+                    )
+        return self._search_client
+
+    @staticmethod
+    def _create_async_client():
+        from azure.core.credentials import AzureKeyCredential
+        from azure.search.documents.aio import SearchClient
+
+        options = {}
+        ca_bundle = os.getenv("REQUESTS_CA_BUNDLE")
+        if ca_bundle:
+            # aiohttp does not read REQUESTS_CA_BUNDLE like the sync client's requests session does. Passed as
+            # connection_verify, azure-core would build a new SSL context, and so a new connection, per request.
+            import ssl
+
+            import aiohttp
+            from azure.core.pipeline.transport import AioHttpTransport
+
+            connector = aiohttp.TCPConnector(ssl=ssl.create_default_context(cafile=ca_bundle))
+            options["transport"] = AioHttpTransport(session=aiohttp.ClientSession(connector=connector),
+                                                    session_owner=True)
+        return SearchClient(
+            os.environ["AI_SEARCH_SERVICE_ENDPOINT"],
+            os.environ["AI_SEARCH_INDEX_NAME"],
+            AzureKeyCredential(os.environ["AZURE_SEARCH_ADMIN_KEY"]),
+            **options,
+        )
+
+    @staticmethod
+    def _query(vector, k, offset):
+        from azure.search.documents.models import VectorizedQuery
+
+        vector_query = VectorizedQuery(
+            vector=list(vector),
+            k_nearest_neighbors=offset + k,
+            fields="imageVector",
+        )
+        return {"search_text": None, "vector_queries": [vector_query], "select": ["id", "title", "imageUrl"],
+                "top": k, "skip": offset}
+
+    def search(self, vector, k, offset=0):
+        results = self.search_client.search(**self._query(vector, k, offset))
+        return [dict(result) for result in results]
+
+    async def search_async(self, vector, k, offset=0):
+        # azure.search.documents.aio client of the running event loop, reused across invocations
+        search_client = async_transport.loop_local("search", self._create_async_client)
+        results = await search_client.search(**self._query(vector, k, offset))
+        return [dict(result) async for result in results]
+
+
+class LocalSearchBackend(SearchBackend):
+    name = "local"
+
+    def __init__(self, index=None, path=LOCAL_INDEX_PATH, nprobe=LOCAL_INDEX_NPROBE):
+        if index is None:
+            # Imported here so numpy is only loaded when the local backend is actually used
+            from helpers.local_index import LocalVectorIndex
+            index = LocalVectorIndex(path)
+        self.index = index
+        self.nprobe = nprobe
+
+    def search(self, vector, k, offset=0):
+        return self.search_many([vector], k, offset)[0]
+
+    def search_many(self, vectors, k, offset=0):
+        from helpers.local_index import cosine_to_score
+
+        hits = self.index.search_many(vectors, offset + k, nprobe=self.nprobe or None)
+        return [
+            [
+                dict(self.index.documents[row], **{"@search.score": cosine_to_score(similarity)})
+                for row, similarity in query_hits[offset:]
+            ]
+            for query_hits in hits
+        ]
+
+
+class HotSetSearchBackend(SearchBackend):
+    # Answers from the local index when it has k confident hits, otherwise asks the remote index.
+    # The local index is a static snapshot written by export_azure_index before deployment; searches do
+    # not add to or refresh it, so documents indexed since the export are only found by the remote index.
+    name = "hot"
+
+    def __init__(self, local, remote, min_score=HOT_SET_MIN_SCORE):
+        self.local = local
+        self.remote = remote
+        self.min_score = min_score
+        self.local_hits = 0
+        self.remote_hits = 0
+
+    def _confident(self, results, k):
+        return len(results) >= k and all(result["@search.score"] >= self.min_score for result in results)
+
+    def search(self, vector, k, offset=0):
+        results = self.local.search(vector, k, offset)
+        if self._confident(results, k):
+            self.local_hits += 1
+            return results
+        self.remote_hits += 1
+        return self.remote.search(vector, k, offset)
+
+    async def search_async(self, vector, k, offset=0):
+        results = await self.local.search_async(vector, k, offset)
+        if self._confident(results, k):
+            self.local_hits += 1
+            return results
+        self.remote_hits += 1
+        return await self.remote.search_async(vector, k, offset)
+
+    def paged(self):
+        # The local and remote rankings differ, a page from each could repeat or skip hits
+        return self.remote
+
+
+def create_backend(kind=SEARCH_BACKEND):
+    if kind == "azure":
+        return AzureSearchBackend()
+    if kind == "local":
+        return LocalSearchBackend()
+    if kind == "hot":
+        return HotSetSearchBackend(LocalSearchBackend(), AzureSearchBackend())
+    raise ValueError(f"Unknown SEARCH_BACKEND '{kind}', expected azure, local or hot")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+def export_azure_index(path, search_client=None):
+    # Snapshot the remote index (ids, metadata and vectors) into a local index directory
+    from helpers.local_index import write_index
+
+    search_client = search_client or AzureSearchBackend().search_client
+    documents = []
+    vectors = []
+    results = search_client.search(search_text="*", select=["id", "title", "imageUrl", "imageVector"], top=None)
+    for result in results.by_page():
+        for document in result:
+            vector = document.get("imageVector")
+            if not vector:
+                continue
+            documents.append({"id": document["id"], "title": document.get("title"), "imageUrl": document["imageUrl"]})
+            vectors.append(vector)
+    write_index(path, documents, vectors)
+    logging.info(f"Exported {len(documents)} documents to local index at {path}")
+    return len(documents)
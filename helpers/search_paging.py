@@ -0,0 +1,47 @@
+import base64
+import json
+
+from helpers import vector_codec
+
+
+# Cursors for paginated /search responses.
+# A cursor carries the query vector itself (base64 float32), so later pages skip the rephrase and
+# text embedding and can be served by any worker without shared state.
+
+SEARCH_MAX_RESULTS = 1000
+
+
+def encode_cursor(vector, offset, page_size, query=None):
+    payload = {
+        "vector": vector_codec.encode_base64(vector)["data"],
+        "offset": offset,
+        "pageSize": page_size,
+        "query": query,
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything that is not a cursor we issued
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        vector = vector_codec.decode({"encoding": "base64-float32le", "data": payload["vector"]})
+        offset = int(payload["offset"])
+        page_size = int(payload["pageSize"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from e
+    if offset < 0 or page_size <= 0 or offset + page_size > SEARCH_MAX_RESULTS:
+        raise ValueError("Invalid cursor: page out of range")
+    return vector, offset, page_size, payload.get("query")
+
+
+def next_cursor(vector, offset, page_size, returned, query=None):
+    # A short page means the ranking is exhausted
+    next_offset = offset + page_size
+    if returned < page_size or next_offset + page_size > SEARCH_MAX_RESULTS:
+        return None
+    return encode_cursor(vector, next_offset, page_size, query)
+
+
+def ndjson_line(obj):
+    return (json.dumps(obj) + "\n").encode("utf-8")
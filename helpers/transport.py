@@ -0,0 +1,189 @@
+import datetime
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from helpers import rate_limiter
+
+
+# Shared HTTP transport for the Vision, Blob and OpenAI REST calls.
+# One keep-alive session per endpoint, so repeated calls reuse the TCP+TLS connection,
+# plus retry with jittered exponential backoff for throttling and transient failures.
+# The OpenAI SDK clients (chat completions for the query rephrase) bring their own httpx client and
+# retry loop, which honours retry-after-ms. They are given the same timeouts, retry count and pool
+# size through openai_client_options(); their retries do not show up in stats().
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "20"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+_sessions = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+def endpoint_of(url):
+    parsed_url = urlparse(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+
+def get_session(url):
+    endpoint = endpoint_of(url)
+    session = _sessions.get(endpoint)
+    if session is not None:
+        return session
+
+    with _lock:
+        session = _sessions.get(endpoint)
+        if session is None:
+            # requests is only loaded by the first route that makes an outbound call
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            # Retries are handled in request() so Retry-After and the counters stay in one place
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+            session.mount(endpoint, adapter)
+            _sessions[endpoint] = session
+            _counters[endpoint] = {"requests": 0, "retries": 0, "throttled": 0, "failures": 0}
+            logging.info(f"Created pooled HTTP session for {endpoint}")
+    return session
+
+
+def _count(endpoint, name, amount=1):
+    with _lock:
+        _counters[endpoint][name] += amount
+
+
+def parse_retry_after(response):
+    # Azure OpenAI sends retry-after-ms, Vision and Storage send Retry-After (seconds or HTTP date)
+    retry_after_ms = response.headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt, response=None):
+    # Full jitter: uniform in [0, base * 2^attempt], capped. A server hint always wins over the jitter.
+    delay = random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+    if response is not None:
+        retry_after = parse_retry_after(response)
+        if retry_after is not None:
+            delay = min(HTTP_BACKOFF_MAX, retry_after + random.uniform(0, HTTP_BACKOFF_BASE))
+    return delay
+
+
+def request(method, url, timeout=None, max_retries=None, limiter=None, priority=rate_limiter.BULK, **kwargs):
+    # limiter: an AdaptiveRateLimiter every attempt takes a token from and reports 429s to
+    import requests
+
+    session = get_session(url)
+    endpoint = endpoint_of(url)
+    timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    max_retries = HTTP_MAX_RETRIES if max_retries is None else max_retries
+
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire(priority)
+        _count(endpoint, "requests")
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= max_retries:
+                _count(endpoint, "failures")
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning(f"{method} {endpoint} failed ({e}), retry {attempt + 1}/{max_retries} in {delay:.2f}s")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES:
+                if limiter is not None:
+                    limiter.succeeded()
+                return response
+            if response.status_code == 429:
+                _count(endpoint, "throttled")
+                if limiter is not None:
+                    limiter.throttled(parse_retry_after(response))
+            if attempt >= max_retries:
+                _count(endpoint, "failures")
+                return response
+            delay = backoff_delay(attempt, response)
+            logging.warning(f"{method} {endpoint} returned {response.status_code}, retry {attempt + 1}/{max_retries} in {delay:.2f}s")
+            response.close()
+
+        _count(endpoint, "retries")
+        attempt += 1
+        time.sleep(delay)
+
+
+def openai_client_options():
+    # Keyword arguments for AzureOpenAI: the shared timeouts, retry count and pool size
+    import httpx
+
+    return {
+        "timeout": httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        "max_retries": HTTP_MAX_RETRIES,
+        "http_client": httpx.Client(
+            limits=httpx.Limits(max_connections=HTTP_POOL_MAXSIZE, max_keepalive_connections=HTTP_POOL_MAXSIZE),
+            follow_redirects=True,
+        ),
+    }
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def stats():
+    # Per endpoint counters. Connection reuse comes from the urllib3 pools:
+    # every request that did not open a new connection went over a kept-alive one.
+    result = {}
+    with _lock:
+        sessions = dict(_sessions)
+        counters = {endpoint: dict(values) for endpoint, values in _counters.items()}
+
+    for endpoint, session in sessions.items():
+        new_connections = 0
+        pool_requests = 0
+        adapter = session.get_adapter(endpoint)
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            new_connections += pool.num_connections
+            pool_requests += pool.num_requests
+
+        endpoint_stats = counters.get(endpoint, {})
+        endpoint_stats["new_connections"] = new_connections
+        endpoint_stats["reused_connections"] = max(0, pool_requests - new_connections)
+        result[endpoint] = endpoint_stats
+    return result
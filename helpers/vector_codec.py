@@ -0,0 +1,86 @@
+import base64
+import json
+import sys
+from array import array
+
+
+# Vectors are held as contiguous float32 arrays (array('f')) instead of lists of Python floats.
+# This module turns them into the response formats of the embedding endpoints:
+#   json    - plain JSON numbers, rendered with 9 significant digits (exact for float32)
+#   base64  - little-endian float32 bytes, base64 encoded
+#   int8    - symmetric int8 quantization with a per-vector scale, base64 encoded
+
+VECTOR_FORMATS = ("json", "base64", "int8")
+
+
+def to_float32(vector):
+    if isinstance(vector, array) and vector.typecode == "f":
+        return vector
+    return array("f", vector)
+
+
+def _little_endian_bytes(vector):
+    if sys.byteorder == "little":
+        return vector.tobytes()
+    swapped = array("f", vector)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def encode_base64(vector):
+    vector = to_float32(vector)
+    return {
+        "encoding": "base64-float32le",
+        "dimensions": len(vector),
+        "data": base64.b64encode(_little_endian_bytes(vector)).decode("ascii"),
+    }
+
+
+def encode_int8(vector):
+    vector = to_float32(vector)
+    peak = max(max(vector, default=0.0), -min(vector, default=0.0))
+    scale = peak / 127 if peak else 1.0
+    # |value| <= peak keeps every rounded value inside [-127, 127]
+    inverse = 1 / scale
+    quantized = array("b", [round(value * inverse) for value in vector])
+    return {
+        "encoding": "base64-int8",
+        "dimensions": len(vector),
+        "scale": scale,
+        "data": base64.b64encode(quantized.tobytes()).decode("ascii"),
+    }
+
+
+def decode(encoded):
+    # Inverse of encode_base64 / encode_int8, plain lists are passed through
+    if not isinstance(encoded, dict):
+        return to_float32(encoded)
+    raw = base64.b64decode(encoded["data"])
+    if encoded["encoding"] == "base64-int8":
+        scale = encoded["scale"]
+        return array("f", [value * scale for value in array("b", raw)])
+    vector = array("f")
+    vector.frombytes(raw)
+    if sys.byteorder != "little":
+        vector.byteswap()
+    return vector
+
+
+def encode(vector, vector_format="json"):
+    if vector_format == "base64":
+        return encode_base64(vector)
+    if vector_format == "int8":
+        return encode_int8(vector)
+    return to_float32(vector)
+
+
+def dumps(obj):
+    # json.dumps that renders float32 arrays directly: "%.9g" round-trips float32 and is both
+    # shorter and faster than the repr of the widened Python floats json.dumps would produce.
+    if isinstance(obj, array):
+        return "[" + ",".join(["%.9g" % value for value in obj]) + "]"
+    if isinstance(obj, dict):
+        return "{" + ",".join([json.dumps(str(key)) + ":" + dumps(value) for key, value in obj.items()]) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join([dumps(value) for value in obj]) + "]"
+    return json.dumps(obj)
@@ -0,0 +1,99 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import backfill
+
+PAGES = [["a.png", "b.png"], ["notes.txt", "c.jpg"], ["d.png"]]
+
+
+class FakePages:
+    def __init__(self, continuation_token):
+        self.position = int(continuation_token or 0)
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= len(PAGES):
+            raise StopIteration
+        names = PAGES[self.position]
+        self.position += 1
+        self.continuation_token = str(self.position) if self.position < len(PAGES) else None
+        return iter(SimpleNamespace(name=name, etag=f"etag-{name}", content_settings=None) for name in names)
+
+
+class FakeContainerClient:
+    @classmethod
+    def from_container_url(cls, url, credential=None):
+        return cls()
+
+    def list_blobs(self, name_starts_with=None, results_per_page=None):
+        return SimpleNamespace(by_page=lambda continuation_token=None: FakePages(continuation_token))
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    vectorized = []
+    state = {"fail_on": None, "error_on": None}
+
+    def vectorize_images(values, max_workers=None, dedupe_ingest=False):
+        for value in values:
+            if value["recordId"] == state["fail_on"]:
+                raise RuntimeError("worker crashed")
+        vectorized.extend(value["recordId"] for value in values)
+        return [
+            {"recordId": value["recordId"], "data": None, "errors": "503 Service Unavailable"}
+            if value["recordId"] == state["error_on"] else
+            {"recordId": value["recordId"], "data": {"imageUrl": value["data"]["imageUrl"], "imageVector": [0.1] * 1024}, "errors": None}
+            for value in values
+        ]
+
+    monkeypatch.setenv("ACCOUNT_KEY", "key")
+    monkeypatch.setattr(backfill, "ContainerClient", FakeContainerClient)
+    monkeypatch.setattr(backfill, "vectorize_images", vectorize_images)
+    monkeypatch.setattr(backfill.document_writer, "index_batch", lambda documents: ([d["id"] for d in documents], []))
+    return vectorized, state
+
+
+def test_backfill_resumes_after_crash_and_skips_indexed_blobs(tmp_path, fakes):
+    vectorized, state = fakes
+    container = "https://account.blob.core.windows.net/data"
+
+    state["fail_on"] = "c.jpg"
+    with pytest.raises(RuntimeError):
+        backfill.run_backfill(container, state_dir=str(tmp_path))
+    checkpoint = json.loads((tmp_path / "checkpoint.json").read_text())
+    assert checkpoint["continuation_token"] == "1"
+    assert vectorized == ["a.png", "b.png"]
+
+    state["fail_on"] = None
+    totals = backfill.run_backfill(container, state_dir=str(tmp_path))
+    assert vectorized == ["a.png", "b.png", "c.jpg", "d.png"]
+    assert totals == {"listed": 5, "skipped": 1, "indexed": 4, "failed": 0}
+
+    # A finished run is not repeated, and a fresh run skips blobs whose ETag is already indexed
+    assert backfill.run_backfill(container, state_dir=str(tmp_path)) == totals
+    (tmp_path / "checkpoint.json").unlink()
+    assert backfill.run_backfill(container, state_dir=str(tmp_path))["indexed"] == 0
+    assert len(vectorized) == 4
+
+
+def test_failed_blobs_are_retried_after_the_listing_and_by_the_next_run(tmp_path, fakes):
+    vectorized, state = fakes
+    container = "https://account.blob.core.windows.net/data"
+
+    state["error_on"] = "b.png"
+    totals = backfill.run_backfill(container, state_dir=str(tmp_path))
+    # Tried with its page and once more at the end of the run
+    assert vectorized.count("b.png") == 2
+    assert totals == {"listed": 5, "skipped": 1, "indexed": 3, "failed": 1}
+    assert json.loads((tmp_path / "checkpoint.json").read_text())["done"]
+
+    state["error_on"] = None
+    totals = backfill.run_backfill(container, state_dir=str(tmp_path))
+    assert vectorized.count("b.png") == 3
+    assert vectorized.count("a.png") == 1
+    assert totals == {"listed": 5, "skipped": 1, "indexed": 4, "failed": 0}
@@ -0,0 +1,17 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_function_app_does_not_load_the_sdks():
+    # The SDKs are imported by the handlers that use them, not at cold start
+    code = (
+        "import json, sys, function_app; "
+        "print(json.dumps([m for m in ('openai', 'requests', 'azure.storage.blob', 'azure.identity', "
+        "'azure.search.documents', 'numpy') if m in sys.modules]))"
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert json.loads(output.stdout.strip().splitlines()[-1]) == []
@@ -0,0 +1,168 @@
+import io
+import json
+import random
+
+import azure.functions as func
+import pytest
+
+import function_app
+from benchmarks.fake_services import FakeAzureServices
+from helpers import dedupe, document_writer, embedding_cache, ingest_queue
+
+
+def random_vector(seed, dimensions=16):
+    rng = random.Random(seed)
+    return [rng.gauss(0, 1) for _ in range(dimensions)]
+
+
+def test_near_duplicate_vectors_are_matched_but_not_the_document_itself(monkeypatch):
+    monkeypatch.setattr(dedupe, "DEDUPE_SIMILARITY", 0.97)
+    index = dedupe.DedupeIndex(path=None, max_entries=10, dimensions=16)
+    original = random_vector(1)
+    index.add("a", "https://host/images/a.png", original)
+    index.add("b", "https://host/images/b.png", random_vector(2))
+
+    copy = [value + 0.01 for value in original]
+    match = index.find_vector(copy)
+
+    assert match.id == "a"
+    assert match.similarity > 0.99
+    assert index.find_vector(copy, exclude_id="a") is None
+    assert index.find_vector(random_vector(3)) is None
+
+
+def test_index_is_bounded_and_persisted(tmp_path):
+    path = str(tmp_path / "dedupe.sqlite")
+    index = dedupe.DedupeIndex(path=path, max_entries=3, dimensions=16)
+    for i in range(5):
+        index.add(f"doc{i}", f"https://host/images/{i}.png", random_vector(i), image_hash=i)
+    index.close()
+
+    reopened = dedupe.DedupeIndex(path=path, max_entries=3, dimensions=16)
+
+    assert len(reopened) == 3
+    # The two oldest documents were evicted, the others survive a restart with their hashes
+    assert reopened.find_vector(random_vector(0)) is None
+    assert reopened.find_vector(random_vector(4)).id == "doc4"
+    assert reopened.find_hash(3).id == "doc3"
+    reopened.close()
+
+
+def test_index_grows_with_its_entries(monkeypatch):
+    monkeypatch.setattr(dedupe, "DEDUPE_INITIAL_ENTRIES", 2)
+    index = dedupe.DedupeIndex(path=None, max_entries=5, dimensions=16)
+    assert len(index._vectors) == 2
+
+    for i in range(7):
+        index.add(f"doc{i}", f"https://host/images/{i}.png", random_vector(i), image_hash=i)
+
+    assert (len(index), len(index._vectors)) == (5, 5)
+    assert index.find_vector(random_vector(1)) is None
+    assert index.find_vector(random_vector(6)).id == "doc6"
+    assert index.find_hash(2).id == "doc2"
+
+
+def test_hash_matches_within_the_distance(monkeypatch):
+    monkeypatch.setattr(dedupe, "DEDUPE_PHASH_MAX_DISTANCE", 2)
+    index = dedupe.DedupeIndex(path=None, max_entries=4, dimensions=16)
+    index.add("a", "https://host/images/a.png", random_vector(1), image_hash=0xFFFF_0000_FFFF_0000)
+    index.add("b", "https://host/images/b.png", random_vector(2))
+
+    assert index.find_hash(0xFFFF_0000_FFFF_0003).distance == 2
+    assert index.find_hash(0xFFFF_0000_FFFF_0007) is None
+
+
+@pytest.fixture
+def services(monkeypatch):
+    with FakeAzureServices() as services:
+        for name, value in services.environment().items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setattr(embedding_cache, "_cache", embedding_cache.create_cache("memory"))
+        monkeypatch.setattr(document_writer, "_sender", None)
+        monkeypatch.setattr(dedupe, "DEDUPE", True)
+        monkeypatch.setattr(dedupe, "DEDUPE_PHASH", True)
+        monkeypatch.setattr(dedupe, "_index", dedupe.DedupeIndex(path=None, max_entries=100))
+        monkeypatch.setattr(dedupe, "_pending", dedupe.OrderedDict())
+        yield services
+        document_writer.close()
+
+
+def blob_created_event(url, etag):
+    return func.EventGridEvent(
+        id=etag, data={"clientRequestId": etag, "url": url, "eTag": etag}, topic="/dedupe",
+        subject=url, event_type="Microsoft.Storage.BlobCreated", event_time=None, data_version="1",
+    )
+
+
+def gradient_jpeg():
+    Image = pytest.importorskip("PIL.Image")
+    output = io.BytesIO()
+    Image.radial_gradient("L").convert("RGB").save(output, format="JPEG")
+    return output.getvalue()
+
+
+def test_reuploaded_image_is_linked_instead_of_embedded_and_indexed(services):
+    original = services.put_blob("original.jpg", gradient_jpeg())
+    copy = services.put_blob("copy of original.jpg", gradient_jpeg())
+
+    function_app.index(blob_created_event(original, "0x1"))
+    function_app.index(blob_created_event(copy, "0x2"))
+
+    assert list(services.documents) == [document_writer.document_id(original)]
+    assert services.counters["vision"]["requests"] == 1
+    assert dedupe.stats()["hash_matches"] >= 1
+
+
+def test_images_are_only_matched_once_their_document_is_indexed(services):
+    first = services.put_blob("a.jpg", gradient_jpeg())
+    second = services.put_blob("b.jpg", gradient_jpeg())
+    third = services.put_blob("c.jpg", gradient_jpeg())
+
+    # /indexraw uploads nothing, so it must not make a.jpg look indexed
+    function_app.index_raw(func.HttpRequest("GET", "/api/indexraw", body=b"", params={"url": first}))
+    # Embedded for ingestion, but its upload is not confirmed yet
+    function_app.vectorize_images([{"recordId": "2", "data": {"imageUrl": second, "eTag": "0x2"}}], dedupe_ingest=True)
+    function_app.index(blob_created_event(third, "0x3"))
+
+    assert list(services.documents) == [document_writer.document_id(third)]
+    assert dedupe.stats()["entries"] == 1
+    assert dedupe.stats()["pending"] == 1
+
+
+def test_failed_uploads_are_not_matched(services, monkeypatch):
+    original = services.put_blob("original.jpg", gradient_jpeg())
+    copy = services.put_blob("copy of original.jpg", gradient_jpeg())
+    monkeypatch.setattr(document_writer, "index_batch", lambda documents: ([], [(d["id"], "503") for d in documents]))
+
+    errors = function_app.process_ingest_batch([ingest_queue.Message(1, {"url": original, "eTag": "0x1"}, 0)])
+    response_values = function_app.vectorize_images(
+        [{"recordId": "2", "data": {"imageUrl": copy, "eTag": "0x2"}}], dedupe_ingest=True)
+
+    assert errors == {1: "503"}
+    assert response_values[0]["data"].get("duplicateOf") is None
+    assert dedupe.stats()["entries"] == 0
+
+
+def test_inline_images_are_hashed_without_a_download(services):
+    original = services.put_blob("original.jpg", gradient_jpeg())
+    function_app.index(blob_created_event(original, "0x1"))
+    services.reset_counters()
+
+    value = function_app.vectorize_images(
+        [{"recordId": "1", "data": {"imageUrl": services.blob_url("upload.jpg"), "imageData": gradient_jpeg()}}],
+        dedupe_ingest=True)[0]
+
+    assert value["data"]["duplicateOf"]["imageUrl"] == original
+    assert services.counters["blob"]["requests"] == 0
+    assert services.counters["vision"]["requests"] == 0
+
+
+def test_hashed_blob_is_sent_to_vision_instead_of_downloaded_again(services):
+    original = services.put_blob("original.jpg", gradient_jpeg())
+
+    function_app.index(blob_created_event(original, "0x1"))
+
+    # The download for the hash is the only one, Vision gets its bytes
+    assert services.counters["blob"]["requests"] == 1
+    assert services.counters["vision"]["requests"] == 1
+    assert services.counters["vision"]["bytes_fetched"] == 0
@@ -0,0 +1,70 @@
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+from helpers import document_writer
+
+
+class FakeSender:
+    def __init__(self):
+        self.batches = []
+
+    def merge_or_upload_documents(self, documents):
+        self.batches.append(documents)
+
+    def flush(self):
+        # Answers like the SDK's callbacks: documents whose id starts with "bad" fail, "lost" ones get no answer
+        for document in [document for batch in self.batches for document in batch]:
+            action = SimpleNamespace(additional_properties=document)
+            if document["id"].startswith("bad"):
+                document_writer._on_error(action)
+            elif not document["id"].startswith("lost"):
+                document_writer._on_progress(action)
+        self.batches = []
+
+
+def test_to_document_sends_a_float_array():
+    url = "https://account.blob.core.windows.net/data/my%20image.png"
+    document = document_writer.to_document(url, [0.1] * document_writer.VECTOR_DIMENSIONS)
+
+    assert isinstance(document["imageVector"], list)
+    assert all(isinstance(value, float) for value in document["imageVector"])
+    assert document["title"] == "my image.png"
+    # Padding count instead of '=' padding, like the blob indexer's base64Encode key mapping
+    assert document["id"][-1] in "012"
+    assert base64.urlsafe_b64decode(document["id"][:-1] + "=" * int(document["id"][-1])).decode("utf-8") == url
+
+
+def test_document_id_matches_the_blob_indexer_key():
+    # Keys of the blob indexer for these paths (HttpServerUtility.UrlTokenEncode)
+    assert document_writer.document_id("https://a.blob.core.windows.net/c/x.png") == \
+        "aHR0cHM6Ly9hLmJsb2IuY29yZS53aW5kb3dzLm5ldC9jL3gucG5n0"
+    assert document_writer.document_id("https://a.blob.core.windows.net/c/xy.png?sv=1") == \
+        "aHR0cHM6Ly9hLmJsb2IuY29yZS53aW5kb3dzLm5ldC9jL3h5LnBuZw2"
+
+
+def test_to_document_rejects_wrong_dimensions():
+    with pytest.raises(ValueError):
+        document_writer.to_document("https://account.blob.core.windows.net/data/a.png", [0.1, 0.2])
+
+
+def test_merge_or_upload_queues_on_the_shared_sender(monkeypatch):
+    sender = FakeSender()
+    monkeypatch.setattr(document_writer, "_sender", sender)
+    documents = [{"id": "a"}, {"id": "b"}]
+
+    document_writer.merge_or_upload(documents)
+    document_writer.merge_or_upload([])
+
+    assert sender.batches == [documents]
+
+
+def test_upload_waits_for_the_answers_on_its_documents(monkeypatch):
+    monkeypatch.setattr(document_writer, "_sender", FakeSender())
+    monkeypatch.setattr(document_writer, "_uploads", {})
+
+    assert document_writer.upload([{"id": "a"}, {"id": "b"}]) == []
+    assert document_writer.upload([{"id": "c"}, {"id": "bad"}]) == [("bad", "indexing failed")]
+    assert document_writer.upload([{"id": "lost"}], timeout=0.01) == [("lost", "no answer from the index")]
+    assert document_writer._uploads == {}
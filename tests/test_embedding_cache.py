@@ -0,0 +1,64 @@
+from helpers import embedding_cache, helper_functions
+
+
+def test_cache_key_requires_etag_or_content_hash():
+    url = "https://account.blob.core.windows.net/data/image.png"
+
+    assert embedding_cache.cache_key(url) is None
+    assert embedding_cache.cache_key(url, '"0x1"') == embedding_cache.cache_key(url + "?sig=abc", "0x1")
+    assert embedding_cache.cache_key(url, "0x1") != embedding_cache.cache_key(url, "0x2")
+
+
+def test_lru_evicts_least_recently_used():
+    cache = embedding_cache.LRUEmbeddingCache(max_entries=2)
+    cache.put("a", [1.0])
+    cache.put("b", [2.0])
+    cache.get("a")
+    cache.put("c", [3.0])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == [1.0]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_sqlite_tier_persists_and_promotes(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    disk = embedding_cache.SqliteEmbeddingCache(path, max_entries=100)
+    disk.put("key", [0.5, -0.25, 1.0])
+    disk.close()
+
+    tiered = embedding_cache.TieredEmbeddingCache(
+        [embedding_cache.LRUEmbeddingCache(), embedding_cache.SqliteEmbeddingCache(path)]
+    )
+    assert list(tiered.get("key")) == [0.5, -0.25, 1.0]
+    assert list(tiered.tiers[0].get("key")) == [0.5, -0.25, 1.0]
+    assert tiered.stats()["hits"] == 1
+
+
+def test_sqlite_tier_is_size_bounded(tmp_path):
+    disk = embedding_cache.SqliteEmbeddingCache(str(tmp_path / "cache.sqlite"), max_entries=10)
+    for i in range(25):
+        disk.put(f"key{i}", [float(i)])
+
+    assert len(disk) <= 10
+    assert list(disk.get("key24")) == [24.0]
+
+
+def test_unchanged_image_is_embedded_once(monkeypatch):
+    calls = []
+
+    def get_image_embeddings(imageUrl, sas_token, image_bytes=None):
+        calls.append(imageUrl)
+        return [0.1, 0.2]
+
+    monkeypatch.setattr(helper_functions, "get_image_embeddings", get_image_embeddings)
+    embedding_cache.set_cache(embedding_cache.LRUEmbeddingCache())
+    try:
+        url = "https://account.blob.core.windows.net/data/image.png"
+        for _ in range(3):
+            assert helper_functions.get_image_embeddings_cached(url, "sig", etag="0x1") == [0.1, 0.2]
+        helper_functions.get_image_embeddings_cached(url, "sig", etag="0x2")
+    finally:
+        embedding_cache.set_cache(None)
+
+    assert len(calls) == 2
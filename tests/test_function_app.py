@@ -1,37 +1,306 @@
+import asyncio
+import base64
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
 import azure.functions as func
-from function_app import index
-
-json_event = '''
-{
-    "id": "c854ff5d-e01e-001f-458c-c8bb35061864",
-    "data": {
-        "api": "PutBlob",
-        "clientRequestId": "06b68280-dab5-4457-b04a-b28b962be03d",
-        "requestId": "c854ff5d-e01e-001f-458c-c8bb35000000",
-        "eTag": "0x8DC96A3497C852D",
-        "contentType": "image/png",
-        "contentLength": 405326,
-        "blobType": "BlockBlob",
-        "url": "https://staiimages.blob.core.windows.net/data/test1.png",
-        "sequencer": "0000000000000000000000000001EA0B0000000000363fbf",
-        "storageDiagnostics": {"batchId": "ed52cc36-a006-003a-008c-c82386000000"},
-    },
-    "topic": "/subscriptions/977171a9-6bfd-49c4-a496-018d3312466e/resourceGroups/azure-vision/providers/Microsoft.Storage/storageAccounts/staiimages",
-    "subject": "/blobServices/default/containers/data/blobs/test1.png",
-    "event_type": "Microsoft.Storage.BlobCreated",
-}
-'''
-
-event: func.EventGridEvent = func.EventGridEvent(
-    subject = json_event["subject"], 
-    event_type = json_event["event_type"], 
-    data = json_event["data"], 
-    data_version = json_event["data"]["eTag"])
-
-
-result = index(event)
-
-# import azure.functions as func
-
-# EventGridEvent(subject: str, event_type: str, data: object, data_version: str, **kwargs: Any)
-# event = func.EventGridEvent()
+import pytest
+
+import function_app
+from benchmarks.fake_services import FakeAzureServices
+from helpers import (async_transport, document_writer, embedding_cache, helper_functions, image_input, ingest_queue,
+                     search_backends, transport)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def services(monkeypatch):
+    # Every upstream call of the handlers goes to the local fakes
+    with FakeAzureServices() as services:
+        for name, value in services.environment().items():
+            monkeypatch.setenv(name, value)
+            if hasattr(function_app, name):
+                monkeypatch.setattr(function_app, name, value)
+        monkeypatch.setattr(function_app, "chat_client", None)
+        monkeypatch.setattr(embedding_cache, "_cache", embedding_cache.create_cache("memory"))
+        monkeypatch.setattr(search_backends, "_backend", None)
+        monkeypatch.setattr(document_writer, "_sender", None)
+        monkeypatch.setattr(document_writer, "_search_client", None)
+        yield services
+        document_writer.close()
+
+
+def blob_created_event(url):
+    return func.EventGridEvent(
+        id="c854ff5d-e01e-001f-458c-c8bb35061864",
+        data={
+            "api": "PutBlob",
+            "clientRequestId": "06b68280-dab5-4457-b04a-b28b962be03d",
+            "requestId": "c854ff5d-e01e-001f-458c-c8bb35000000",
+            "eTag": "0x8DC96A3497C852D",
+            "contentType": "image/png",
+            "contentLength": 405326,
+            "blobType": "BlockBlob",
+            "url": url,
+            "sequencer": "0000000000000000000000000001EA0B0000000000363fbf",
+            "storageDiagnostics": {"batchId": "ed52cc36-a006-003a-008c-c82386000000"},
+        },
+        topic="/subscriptions/977171a9-6bfd-49c4-a496-018d3312466e/resourceGroups/azure-vision/providers/"
+              "Microsoft.Storage/storageAccounts/staiimages",
+        subject="/blobServices/default/containers/data/blobs/test1.png",
+        event_type="Microsoft.Storage.BlobCreated",
+        event_time=None,
+        data_version="1",
+    )
+
+
+def test_index_event_is_embedded_and_indexed(services):
+    url = services.blob_url("test1.png")
+
+    function_app.index(blob_created_event(url))
+
+    document = services.documents[document_writer.document_id(url)]
+    assert document["imageUrl"] == url
+    assert document["title"] == "test1.png"
+    assert len(document["imageVector"]) == 1024
+    assert services.counters["vision"]["requests"] == 1
+
+
+def test_index_event_without_client_request_id_is_indexed(services):
+    url = services.blob_url("no-request-id.png")
+    event = blob_created_event(url)
+    del event.get_json()["clientRequestId"]
+
+    function_app.index(event)
+
+    assert document_writer.document_id(url) in services.documents
+
+
+def test_index_fails_the_invocation_when_indexing_fails(services, monkeypatch):
+    # Event Grid then redelivers the event, and dead-letters it once its retries are used up
+    monkeypatch.setattr(document_writer, "upload", lambda documents: [(d["id"], "indexing failed") for d in documents])
+
+    with pytest.raises(RuntimeError):
+        function_app.index(blob_created_event(services.blob_url("test1.png")))
+
+
+def test_queued_index_events_are_indexed_by_the_drain(services, monkeypatch):
+    monkeypatch.setattr(ingest_queue, "_queue", ingest_queue.MemoryIngestQueue())
+    url = services.blob_url("queued.png")
+
+    function_app.index(blob_created_event(url))
+    function_app.index(blob_created_event(url))
+    # The trigger only enqueues
+    assert services.counters["vision"]["requests"] == 0
+    assert ingest_queue.stats()["depth"] == 1
+
+    function_app.drain_ingest_queue()
+
+    assert document_writer.document_id(url) in services.documents
+    assert services.counters["vision"]["requests"] == 1
+    assert ingest_queue.stats()["depth"] == 0
+    assert ingest_queue.stats()["acked"] == 1
+
+
+@pytest.mark.parametrize("kind, expected", [("none", set()), ("sqlite", {"ingest_drain"}), ("storage", {"ingest"})])
+def test_ingest_functions_are_only_registered_for_their_queue(kind, expected):
+    code = "import function_app; print(' '.join(f.get_function_name() for f in function_app.app.get_functions()))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True,
+                            env={**os.environ, "INGEST_QUEUE": kind})
+    functions = set(output.stdout.strip().splitlines()[-1].split())
+    assert functions & {"ingest", "ingest_drain"} == expected
+
+
+def test_index_forwards_events_to_the_storage_queue(services):
+    # With INGEST_QUEUE=storage the index trigger only writes the event to the ingest queue
+    code = textwrap.dedent("""
+        import json, sys
+        import function_app
+        from tests.test_function_app import blob_created_event
+
+        class Out:
+            def set(self, value):
+                self.value = value
+
+        out = Out()
+        function_app.index(blob_created_event(sys.argv[1]), out)
+        bindings = [b for f in function_app.app.get_functions() if f.get_function_name() == "index"
+                    for b in f.get_bindings()]
+        print(json.dumps({"message": json.loads(out.value), "bindings": [b.type for b in bindings]}))
+    """)
+    url = services.blob_url("forwarded.png")
+    output = subprocess.run([sys.executable, "-c", code, url], cwd=ROOT, capture_output=True, text=True, check=True,
+                            env={**os.environ, "INGEST_QUEUE": "storage"})
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+
+    assert sorted(result["bindings"]) == ["eventGridTrigger", "queue"]
+    assert services.counters["vision"]["requests"] == 0
+    # The ingest trigger indexes the forwarded message like one written by Event Grid
+    function_app.process_ingest_message(result["message"])
+    assert document_writer.document_id(url) in services.documents
+
+
+def test_storage_queue_messages_are_indexed_and_failures_left_to_the_host(services, monkeypatch):
+    url = services.blob_url("stored.png")
+    event = {"id": "e1", "eventType": "Microsoft.Storage.BlobCreated", "data": {"url": url, "eTag": "0x1"}}
+
+    function_app.process_ingest_message(event, dequeue_count=1, message_id="m1")
+
+    assert document_writer.document_id(url) in services.documents
+    # Raising makes the host retry the message and poison it after maxDequeueCount
+    monkeypatch.setattr(document_writer, "index_batch", lambda documents: ([], [(d["id"], "503") for d in documents]))
+    with pytest.raises(RuntimeError, match="attempt 2"):
+        function_app.process_ingest_message({"data": {"url": services.blob_url("other.png")}}, dequeue_count=2)
+    function_app.process_ingest_message({"eventType": "Microsoft.Storage.BlobDeleted", "data": {"url": url}})
+
+
+def test_inline_images_are_sent_to_vision_as_bytes(services, monkeypatch):
+    monkeypatch.setattr(helper_functions, "create_service_sas_blob",
+                        lambda url: pytest.fail("inline images are not signed"))
+    image = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+    records = {"values": [{"recordId": "1", "data": {"imageData": base64.b64encode(image).decode()}},
+                          {"recordId": "2", "data": {"imageData": {"$type": "file", "data": "!!"}}}]}
+    multipart = (b'--b\r\nContent-Disposition: form-data; name="3"; filename="a.png"\r\n'
+                 b"Content-Type: image/png\r\n\r\n" + image + b"\r\n--b--\r\n")
+
+    json_values = json.loads(function_app.vectorize(func.HttpRequest(
+        "POST", "/api/vectorize", body=json.dumps(records).encode())).get_body())["values"]
+    multipart_values = json.loads(function_app.vectorize(func.HttpRequest(
+        "POST", "/api/vectorize", body=multipart,
+        headers={"Content-Type": "multipart/form-data; boundary=b"})).get_body())["values"]
+
+    assert "base64" in json_values[1]["errors"]
+    assert multipart_values[0]["recordId"] == "3"
+    assert multipart_values[0]["data"]["imageVector"] == json_values[0]["data"]["imageVector"]
+    # Vision was sent the bytes once, the second image was an embedding cache hit
+    assert services.counters["vision"]["requests"] == 1
+    assert services.counters["vision"]["bytes_fetched"] == 0
+
+
+def test_oversized_image_bodies_are_refused(services, monkeypatch):
+    monkeypatch.setattr(image_input, "IMAGE_INPUT_MAX_BODY_BYTES", 1024)
+    req = func.HttpRequest("POST", "/api/indexraw", body=b"\xff\xd8" + b"\0" * 2048, params={"url": "https://x/y.jpg"},
+                           headers={"Content-Type": "image/jpeg"})
+
+    assert function_app.index_raw(req).status_code == 413
+    assert services.counters["vision"]["requests"] == 0
+
+
+def test_search_returns_signed_results(services):
+    req = func.HttpRequest(
+        "POST", "/api/search", body=json.dumps({"query": "woman with a laptop", "max_images": 3}).encode(),
+        headers={"Authorization": "Bearer test"},
+    )
+
+    response = function_app.search(req)
+
+    results = json.loads(response.get_body())
+    assert len(results) == 3
+    # User delegation SAS tokens carry the signing object id
+    assert all("skoid=" in result["Image"] for result in results)
+    assert response.headers["X-Search-Query-Path"] == "rephrased"
+    assert services.counters["openai"]["requests"] == 1
+    assert services.counters["blob"]["requests"] == 1
+
+
+def test_async_search_returns_signed_results(services):
+    req = func.HttpRequest(
+        "POST", "/api/search/async", body=json.dumps({"query": "lighthouse in a storm", "max_images": 3}).encode(),
+        headers={"Authorization": "Bearer test"},
+    )
+
+    async def search():
+        try:
+            return await function_app.search_async(req)
+        finally:
+            await async_transport.aclose()
+
+    response = asyncio.run(search())
+
+    results = json.loads(response.get_body())
+    assert len(results) == 3
+    assert all("skoid=" in result["Image"] for result in results)
+    assert response.headers["X-Search-Query-Path"] == "rephrased"
+    assert "openai" in response.headers["Server-Timing"]
+    # The three results are signed concurrently with one delegation key
+    assert services.counters["blob"]["requests"] == 1
+    assert services.counters["openai"]["requests"] == 1
+    assert services.counters["search"]["requests"] == 1
+
+
+def test_search_batch_groups_results_by_query(services):
+    body = {"queries": ["dog on a skateboard", {"id": "beach", "query": "beach at sunset", "max_images": 2},
+                        {"id": "empty"}, "dog on a skateboard"], "max_images": 3}
+    req = func.HttpRequest("POST", "/api/search/batch", body=json.dumps(body).encode(),
+                           headers={"Authorization": "Bearer test"})
+
+    response = function_app.search_batch(req)
+
+    groups = json.loads(response.get_body())["results"]
+    assert [group["id"] for group in groups] == [0, "beach", "empty", 3]
+    assert [len(group["results"]) for group in groups] == [3, 2, 0, 3]
+    assert groups[2]["error"] and groups[0]["error"] is None
+    assert all("skoid=" in result["Image"] for result in groups[1]["results"])
+    assert {"resolve_ms", "search_ms", "total_ms"} <= groups[0]["timings"].keys()
+    # The repeated query is rephrased once, and the whole batch shares one delegation key
+    assert services.counters["openai"]["requests"] == 2
+    assert services.counters["blob"]["requests"] == 1
+
+
+def test_search_batch_reports_signing_failures_per_query(services, monkeypatch):
+    sign = helper_functions.create_user_delegated_sas_token
+    images = {}
+
+    def create_user_delegated_sas_token(image_url, auth_header):
+        images.setdefault("first", image_url)
+        if image_url == images["first"]:
+            raise RuntimeError("AuthorizationFailure")
+        return sign(image_url, auth_header)
+
+    monkeypatch.setattr(helper_functions, "create_user_delegated_sas_token", create_user_delegated_sas_token)
+    body = {"queries": ["cat in a box", "red sports car"], "max_images": 7}
+    req = func.HttpRequest("POST", "/api/search/batch", body=json.dumps(body).encode(),
+                           headers={"Authorization": "Bearer test"})
+
+    response = function_app.search_batch(req)
+
+    # Both queries hit every image, so the one unsignable image fails both, but not the request
+    assert response.status_code == 200
+    body = json.loads(response.get_body())
+    assert all("AuthorizationFailure" in group["error"] and group["results"] == [] for group in body["results"])
+    assert body["timings"]["signed_images"] == 6
+
+
+def test_search_batch_rejects_too_many_queries(services, monkeypatch):
+    monkeypatch.setattr(function_app, "SEARCH_BATCH_MAX_QUERIES", 2)
+    req = func.HttpRequest("POST", "/api/search/batch", body=json.dumps({"queries": ["a", "b", "c"]}).encode())
+
+    assert function_app.search_batch(req).status_code == 400
+
+
+def test_search_batch_reports_invalid_max_images_per_query(services):
+    queries = ["cat in a box", {"query": "red car", "max_images": 0}, {"query": "beach", "max_images": -2}]
+    req = func.HttpRequest("POST", "/api/search/batch", body=json.dumps({"queries": queries}).encode(),
+                           headers={"Authorization": "Bearer test"})
+
+    groups = json.loads(function_app.search_batch(req).get_body())["results"]
+
+    assert groups[0]["error"] is None and len(groups[0]["results"]) == 5
+    assert all("max_images" in group["error"] and group["results"] == [] for group in groups[1:])
+
+
+def test_throttled_vision_calls_are_retried_then_reported(services, monkeypatch):
+    services.configs["vision"].throttle_rate = 1.0
+    services.configs["vision"].retry_after_ms = 10
+    monkeypatch.setattr(transport, "HTTP_MAX_RETRIES", 2)
+    monkeypatch.setattr(transport, "HTTP_BACKOFF_BASE", 0.01)
+    values = [{"recordId": "1", "data": {"imageUrl": services.blob_url("busy.png"), "eTag": "0x1"}}]
+
+    response_values = function_app.vectorize_images(values)
+
+    assert "429" in response_values[0]["errors"]
+    assert services.counters["vision"]["requests"] == 3
@@ -0,0 +1,105 @@
+import base64
+import xml.etree.ElementTree as ET
+from urllib.parse import parse_qs
+
+from azure.storage.blob import UserDelegationKey
+
+from helpers import helper_functions
+
+
+def fake_delegation_key():
+    key = UserDelegationKey()
+    key.signed_oid = "00000000-0000-0000-0000-000000000001"
+    key.signed_tid = "00000000-0000-0000-0000-000000000002"
+    key.signed_start = "2030-01-01T00:00:00Z"
+    key.signed_expiry = "2030-01-02T00:00:00Z"
+    key.signed_service = "b"
+    key.signed_version = "2024-08-04"
+    key.value = base64.b64encode(b"secret").decode("utf-8")
+    return key
+
+
+# A Get User Delegation Key response body as the Blob service returns it
+USER_DELEGATION_KEY_RESPONSE = b"""<?xml version="1.0" encoding="utf-8"?>
+<UserDelegationKey>
+    <SignedOid>00000000-0000-0000-0000-000000000001</SignedOid>
+    <SignedTid>00000000-0000-0000-0000-000000000002</SignedTid>
+    <SignedStart>2030-01-01T00:00:00Z</SignedStart>
+    <SignedExpiry>2030-01-02T00:00:00Z</SignedExpiry>
+    <SignedService>b</SignedService>
+    <SignedVersion>2024-08-04</SignedVersion>
+    <Value>c2VjcmV0LWtleS1mb3ItdGVzdHM=</Value>
+</UserDelegationKey>"""
+
+
+def test_user_delegation_key_request_and_response():
+    url, headers, body = helper_functions._user_delegation_key_request(
+        "https://account.blob.core.windows.net", "Bearer a")
+    request = ET.fromstring(body)
+
+    assert url == "https://account.blob.core.windows.net?restype=service&comp=userdelegationkey"
+    assert headers["Authorization"] == "Bearer a"
+    assert request.tag == "KeyInfo"
+    assert request.findtext("Start").endswith("Z") and request.findtext("Expiry").endswith("Z")
+
+    key = helper_functions._parse_user_delegation_key(USER_DELEGATION_KEY_RESPONSE)
+
+    assert isinstance(key, UserDelegationKey)
+    assert (key.signed_oid, key.signed_tid, key.signed_service, key.signed_version) == (
+        "00000000-0000-0000-0000-000000000001", "00000000-0000-0000-0000-000000000002", "b", "2024-08-04")
+    assert (key.signed_start, key.signed_expiry) == ("2030-01-01T00:00:00Z", "2030-01-02T00:00:00Z")
+    assert key.value == "c2VjcmV0LWtleS1mb3ItdGVzdHM="
+    # generate_blob_sas signs with it and carries the key's fields into the token
+    token = parse_qs(helper_functions.create_user_delegation_sas_token(
+        helper_functions.BlobNames("account", "data", "image.png"), key))
+    assert token["skoid"] == ["00000000-0000-0000-0000-000000000001"]
+    assert token["ske"] == ["2030-01-02T00:00:00Z"]
+    assert token["sig"]
+
+
+def test_delegation_key_fetched_once_per_account_and_caller(monkeypatch):
+    calls = []
+
+    def get_user_delegated_key(account_url, auth_header):
+        calls.append((account_url, auth_header))
+        return fake_delegation_key()
+
+    monkeypatch.setattr(helper_functions, "get_user_delegated_key", get_user_delegated_key)
+    monkeypatch.setattr(helper_functions, "_delegation_keys", helper_functions.OrderedDict())
+    monkeypatch.setattr(helper_functions, "_sas_tokens", helper_functions.OrderedDict())
+
+    account = "https://account.blob.core.windows.net"
+    tokens = [
+        helper_functions.create_user_delegated_sas_token(f"{account}/data/image{i}.png", "Bearer a")
+        for i in range(20)
+    ]
+    assert len(calls) == 1
+    assert all("sig=" in token for token in tokens)
+
+    # Same blob again is served from the SAS cache, another caller gets its own key
+    again = helper_functions.create_user_delegated_sas_token(f"{account}/data/image0.png", "Bearer a")
+    assert again == tokens[0]
+    helper_functions.create_user_delegated_sas_token(f"{account}/data/image0.png", "Bearer b")
+    assert len(calls) == 2
+
+
+def test_delegation_key_cache_is_bounded_and_drops_expired_keys(monkeypatch):
+    def get_user_delegated_key(account_url, auth_header):
+        key = fake_delegation_key()
+        if auth_header == "Bearer expired":
+            key.signed_expiry = "2000-01-02T00:00:00Z"
+        return key
+
+    monkeypatch.setattr(helper_functions, "get_user_delegated_key", get_user_delegated_key)
+    monkeypatch.setattr(helper_functions, "_delegation_keys", helper_functions.OrderedDict())
+    monkeypatch.setattr(helper_functions, "DELEGATION_KEY_CACHE_MAX_ENTRIES", 3)
+    account = "https://account.blob.core.windows.net"
+
+    helper_functions.get_cached_user_delegated_key(account, "Bearer expired")
+    for caller in range(5):
+        helper_functions.get_cached_user_delegated_key(account, f"Bearer {caller}")
+
+    assert len(helper_functions._delegation_keys) == 3
+    assert (account, helper_functions._caller_identity("Bearer 4")) in helper_functions._delegation_keys
+    assert (account, helper_functions._caller_identity("Bearer expired")) not in helper_functions._delegation_keys
+    assert helper_functions._delegation_key_locks == {}
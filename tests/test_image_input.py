@@ -0,0 +1,61 @@
+import base64
+
+import azure.functions as func
+import pytest
+
+from helpers import image_input
+
+
+def multipart(parts, boundary="b0undary"):
+    body = b""
+    for name, filename, content in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+        body += f"--{boundary}\r\nContent-Disposition: {disposition}\r\n\r\n".encode() + content + b"\r\n"
+    return body + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+def request(body, content_type):
+    return func.HttpRequest("POST", "/api/vectorize", body=body, headers={"Content-Type": content_type})
+
+
+def test_multipart_parts_become_records_named_by_part():
+    body, content_type = multipart([("a", "a.png", b"\x89PNG\r\n--b0undar"), ("note", None, b"text field"),
+                                    ("b", "b.jpg", b"\xff\xd8jpeg")])
+
+    values = image_input.binary_values(request(body, content_type), image_url="https://x/y.png")
+
+    assert [value["recordId"] for value in values] == ["a", "b"]
+    assert values[0]["data"] == {"imageData": b"\x89PNG\r\n--b0undar", "imageUrl": "https://x/y.png"}
+    assert image_input.image_bytes(values[1]["data"]) == b"\xff\xd8jpeg"
+
+
+def test_binary_body_is_one_record_and_json_is_left_alone():
+    values = image_input.binary_values(request(b"\xff\xd8jpeg", "image/jpeg"), record_id="7")
+
+    assert values == [{"recordId": "7", "data": {"imageData": b"\xff\xd8jpeg"}}]
+    assert image_input.binary_values(request(b"{}", "application/json")) is None
+
+
+def test_base64_and_file_reference_records_are_decoded():
+    encoded = base64.b64encode(b"image").decode()
+
+    assert image_input.image_bytes({"imageData": encoded}) == b"image"
+    assert image_input.image_bytes({"imageData": f"data:image/png;base64,{encoded}"}) == b"image"
+    assert image_input.image_bytes({"imageData": {"$type": "file", "data": encoded}}) == b"image"
+    assert image_input.image_bytes({"imageUrl": "https://x/y.png"}) is None
+    with pytest.raises(ValueError):
+        image_input.image_bytes({"imageData": "not base64!"})
+
+
+def test_oversized_payloads_are_refused(monkeypatch):
+    monkeypatch.setattr(image_input, "IMAGE_INPUT_MAX_BODY_BYTES", 100)
+    monkeypatch.setattr(image_input, "IMAGE_INPUT_MAX_IMAGE_BYTES", 10)
+    declared = func.HttpRequest("POST", "/api/vectorize", body=b"x",
+                                headers={"Content-Type": "image/png", "Content-Length": "101"})
+
+    with pytest.raises(image_input.PayloadTooLarge):
+        image_input.binary_values(declared)
+    with pytest.raises(image_input.PayloadTooLarge):
+        image_input.binary_values(request(b"x" * 11, "image/png"))
+    with pytest.raises(image_input.PayloadTooLarge):
+        image_input.image_bytes({"imageData": base64.b64encode(b"x" * 11).decode()})
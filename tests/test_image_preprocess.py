@@ -0,0 +1,78 @@
+import io
+
+import pytest
+
+from benchmarks.fake_services import FakeAzureServices
+from helpers import helper_functions, image_preprocess
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def encode(size, format="JPEG", mode="RGB"):
+    output = io.BytesIO()
+    Image.new(mode, size, (200, 30, 30, 128) if mode == "RGBA" else (200, 30, 30)).save(output, format=format)
+    return output.getvalue()
+
+
+@pytest.fixture
+def services(monkeypatch):
+    with FakeAzureServices() as services:
+        for name, value in services.environment().items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setattr(image_preprocess, "IMAGE_PREPROCESS", True)
+        yield services
+
+
+def test_large_images_are_downscaled_to_max_side():
+    body, resized = image_preprocess.downscale(encode((4000, 3000)), max_side=1024)
+
+    image = Image.open(io.BytesIO(body))
+    assert resized
+    assert image.format == "JPEG"
+    assert max(image.size) == 1024
+    assert image.size[0] / image.size[1] == pytest.approx(4 / 3, rel=0.01)
+
+
+def test_transparent_png_is_flattened_to_jpeg():
+    body, resized = image_preprocess.downscale(encode((2048, 2048), "PNG", "RGBA"), max_side=512)
+
+    assert resized
+    assert Image.open(io.BytesIO(body)).size == (512, 512)
+
+
+def test_small_images_pass_through_unchanged():
+    data = encode((640, 480), "PNG")
+
+    assert image_preprocess.downscale(data, max_side=1024) == (data, False)
+
+
+def test_undecodable_and_oversized_images_are_rejected(monkeypatch):
+    with pytest.raises(image_preprocess.PreprocessError):
+        image_preprocess.downscale(b"not an image")
+
+    monkeypatch.setattr(image_preprocess, "IMAGE_MAX_DECODE_PIXELS", 1000)
+    with pytest.raises(image_preprocess.PreprocessError):
+        image_preprocess.downscale(encode((2000, 2000), "PNG"), max_side=512)
+
+
+def test_preprocessed_image_is_sent_as_bytes(services):
+    url = services.put_blob("large.jpg", encode((4000, 3000)))
+
+    vector = helper_functions.get_image_embeddings(url, "sv=fake&sig=fake")
+
+    assert len(vector) == 1024
+    # Vision got the downscaled bytes and never fetched the original
+    assert services.counters["vision"]["bytes_fetched"] == 0
+    assert 0 < services.counters["vision"]["bytes_received"] < services.counters["blob"]["bytes_sent"]
+
+
+def test_download_failure_falls_back_to_url_mode(services, monkeypatch):
+    url = services.put_blob("huge.jpg", encode((4000, 3000)))
+    monkeypatch.setattr(image_preprocess, "IMAGE_MAX_DOWNLOAD_BYTES", 1024)
+    fallbacks = image_preprocess.stats()["fallbacks"]
+
+    vector = helper_functions.get_image_embeddings(url, "sv=fake&sig=fake")
+
+    assert len(vector) == 1024
+    assert image_preprocess.stats()["fallbacks"] == fallbacks + 1
+    assert services.counters["vision"]["bytes_fetched"] > 0
@@ -0,0 +1,74 @@
+import pytest
+
+from helpers import ingest_queue
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def queue(request, tmp_path):
+    if request.param == "memory":
+        yield ingest_queue.MemoryIngestQueue(max_depth=10)
+    else:
+        queue = ingest_queue.SqliteIngestQueue(str(tmp_path / "queue.sqlite"), max_depth=10)
+        yield queue
+        queue.close()
+
+
+def item(name, sequencer="01"):
+    return {"url": f"https://account.blob.core.windows.net/images/{name}", "eTag": f"0x{sequencer}",
+            "sequencer": sequencer, "recordId": name}
+
+
+def test_events_of_a_waiting_blob_are_coalesced(queue):
+    queue.put([item("a.png", "01"), item("b.png"), item("a.png", "03"), item("a.png", "02")])
+
+    messages = queue.lease(10)
+
+    assert [message.item["url"].rsplit("/", 1)[1] for message in messages] == ["a.png", "b.png"]
+    # The newest event wins, whatever order the events arrived in
+    assert messages[0].item["eTag"] == "0x03"
+    assert queue.stats()["coalesced"] == 2
+    assert queue.lease(10) == []
+
+
+def test_retry_poison_and_requeue(queue):
+    queue.put([item("a.png")])
+    message = queue.lease(1)[0]
+
+    queue.retry(message, "429", delay=60)
+    assert queue.lease(1) == []
+    assert queue.depth() == 1
+
+    queue.dead_letter(message._replace(attempts=1), "429")
+    assert queue.depth() == 0
+    assert queue.poison()[0]["error"] == "429"
+    assert queue.poison()[0]["attempts"] == 2
+
+    assert queue.requeue_poison() == 1
+    assert queue.lease(1)[0].attempts == 0
+
+
+def test_full_queue_rejects_the_whole_put(queue):
+    queue.put([item(f"{i}.png") for i in range(8)])
+
+    with pytest.raises(ingest_queue.QueueFull):
+        queue.put([item(f"new{i}.png") for i in range(3)])
+    assert queue.depth() == 8
+
+
+def test_drain_retries_then_poisons_failing_items(queue, monkeypatch):
+    monkeypatch.setattr(ingest_queue, "INGEST_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(ingest_queue, "retry_delay", lambda attempts: 0)
+    queue.put([item(f"{i}.png") for i in range(5)])
+    batches = []
+
+    def process(messages):
+        batches.append(len(messages))
+        return {message.id: "corrupt image" if message.item["recordId"] == "3.png" else None for message in messages}
+
+    result = ingest_queue.drain(process, queue=queue, batch_size=2)
+
+    assert (result["succeeded"], result["retried"], result["poisoned"]) == (4, 2, 1)
+    # Five first attempts and two retries, never more than a batch at a time
+    assert sum(batches) == 7 and max(batches) == 2
+    assert queue.depth() == 0
+    assert [message["item"]["recordId"] for message in queue.poison()] == ["3.png"]
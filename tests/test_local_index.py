@@ -0,0 +1,64 @@
+import numpy as np
+
+from helpers import search_backends
+from helpers.local_index import LocalVectorIndex, write_index
+
+
+def build_index(path, count=500, dimensions=32, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(count, dimensions)).astype(np.float32)
+    documents = [{"id": str(i), "title": f"image{i}.png", "imageUrl": f"https://a/data/image{i}.png"} for i in range(count)]
+    write_index(str(path), documents, vectors)
+    return vectors
+
+
+def brute_force(vectors, query, k):
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return list(np.argsort(-(normalized @ (query / np.linalg.norm(query))))[:k])
+
+
+def test_exact_search_matches_brute_force(tmp_path, monkeypatch):
+    vectors = build_index(tmp_path)
+    monkeypatch.setattr("helpers.local_index.LOCAL_INDEX_CHUNK_ROWS", 64)
+    index = LocalVectorIndex(str(tmp_path))
+    queries = np.random.default_rng(1).normal(size=(3, 32)).astype(np.float32)
+
+    for query, hits in zip(queries, index.search_many(queries, k=10)):
+        assert [row for row, _ in hits] == brute_force(vectors, query, 10)
+        assert all(a[1] >= b[1] for a, b in zip(hits, hits[1:]))
+
+
+def test_ivf_with_all_lists_probed_is_exact(tmp_path):
+    vectors = build_index(tmp_path)
+    index = LocalVectorIndex(str(tmp_path))
+    index.build_ivf(nlist=8)
+    query = vectors[42]
+
+    reloaded = LocalVectorIndex(str(tmp_path))
+    assert [row for row, _ in reloaded.search(query, k=5, nprobe=8)] == brute_force(vectors, query, 5)
+    assert reloaded.search(query, k=1, nprobe=1)[0][0] == 42
+
+
+def test_local_backend_returns_search_shaped_hits(tmp_path):
+    vectors = build_index(tmp_path)
+    backend = search_backends.LocalSearchBackend(path=str(tmp_path))
+
+    hits = backend.search(vectors[7], 3)
+    assert hits[0]["id"] == "7"
+    assert abs(hits[0]["@search.score"] - 1.0) < 1e-5
+    assert set(hits[0]) == {"id", "title", "imageUrl", "@search.score"}
+
+
+def test_hot_set_falls_back_to_remote_for_weak_matches(tmp_path):
+    vectors = build_index(tmp_path)
+
+    class Remote:
+        def search(self, vector, k, offset=0):
+            return [{"id": "remote", "@search.score": 0.5}]
+
+    backend = search_backends.HotSetSearchBackend(
+        search_backends.LocalSearchBackend(path=str(tmp_path)), Remote(), min_score=0.8
+    )
+    assert backend.search(vectors[3], 1)[0]["id"] == "3"
+    assert backend.search(np.ones(32, dtype=np.float32), 5)[0]["id"] == "remote"
+    assert (backend.local_hits, backend.remote_hits) == (1, 1)
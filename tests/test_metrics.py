@@ -0,0 +1,76 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.functions as func
+import pytest
+
+import function_app
+from helpers import metrics
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_histogram_percentiles_are_within_bucket_error():
+    histogram = metrics.Histogram()
+    for value in range(1, 1001):
+        histogram.record(float(value))
+
+    summary = histogram.summary()
+    assert summary["count"] == 1000
+    assert summary["p50_ms"] == pytest.approx(500, rel=0.1)
+    assert summary["p95_ms"] == pytest.approx(950, rel=0.1)
+    assert summary["p99_ms"] == pytest.approx(990, rel=0.1)
+    assert summary["max_ms"] == 1000
+
+
+def test_stage_records_errors_and_reraises():
+    with pytest.raises(RuntimeError):
+        with metrics.stage("openai"):
+            raise RuntimeError("boom")
+    with metrics.stage("openai"):
+        pass
+
+    summary = metrics.snapshot()["openai"]
+    assert summary["count"] == 2
+    assert summary["errors"] == 1
+    assert summary["error_rate"] == 0.5
+
+
+def test_request_collects_stages_from_pool_threads():
+    @metrics.timed("sas")
+    def sign(value):
+        return value
+
+    with metrics.track_request("search") as timings:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert list(executor.map(metrics.bind(sign), range(8))) == list(range(8))
+
+    assert timings.stages["sas"]["count"] == 8
+    header = timings.server_timing()
+    assert header.startswith('sas;dur=')
+    assert 'desc="8 calls"' in header
+    assert header.split(", ")[-1].startswith("total;dur=")
+    assert metrics.snapshot()["request.search"]["count"] == 1
+
+
+def test_search_response_carries_server_timing(monkeypatch):
+    class Backend:
+        def search(self, vector, k, offset=0):
+            return []
+
+    monkeypatch.setattr(function_app, "resolve_query_vector", lambda query, **kwargs: (query, [0.0], "raw"))
+    monkeypatch.setattr(function_app.search_backends, "get_backend", lambda: Backend())
+    req = func.HttpRequest("POST", "/api/search", body=json.dumps({"query": "sky"}).encode(), headers={})
+
+    response = function_app.search(req)
+
+    assert json.loads(response.get_body()) == []
+    assert "search_backend;dur=" in response.headers["Server-Timing"]
+    stages = json.loads(function_app.stage_metrics(func.HttpRequest("GET", "/api/metrics", body=b"")).get_body())
+    assert stages["search_backend"]["count"] == 1
+    assert stages["request.search"]["p99_ms"] is not None
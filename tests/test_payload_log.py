@@ -0,0 +1,48 @@
+import logging
+from array import array
+
+from helpers import payload_log, vector_codec
+
+
+def test_vectors_are_summarized_not_printed():
+    vector = array("f", [0.25] * 1024)
+
+    summary = payload_log.summarize({"recordId": "1", "data": {"imageVector": vector, "list": list(vector)}})
+
+    assert summary["data"]["imageVector"].startswith("<vector dims=1024 crc32=")
+    assert summary["data"]["list"] == summary["data"]["imageVector"]
+    assert payload_log.summarize(vector_codec.encode(vector, "int8")).startswith("<base64-int8 dims=1024")
+
+
+def test_secrets_are_redacted():
+    summary = payload_log.summarize({
+        "Image": "https://account.blob.core.windows.net/data/a.png?sv=2023&sig=abc%2Fdef&se=2024",
+        "headers": {"Authorization": "Bearer eyJ0", "Ocp-Apim-Subscription-Key": "123"},
+        "error": "401 for url https://func.azurewebsites.net/api/search?code=s3cret",
+    })
+
+    assert "abc" not in summary["Image"] and "sig=***" in summary["Image"] and "se=2024" in summary["Image"]
+    assert summary["headers"] == {"Authorization": "***", "Ocp-Apim-Subscription-Key": "***"}
+    assert "s3cret" not in summary["error"]
+    assert payload_log.redact("Authorization: Bearer abc.def") == "Authorization: Bearer ***"
+
+
+def test_long_values_are_truncated():
+    summary = payload_log.summarize({"text": "x" * 1000, "items": list(range(100))})
+
+    assert summary["text"].endswith(f"...(+{1000 - payload_log.PAYLOAD_LOG_MAX_CHARS} chars)")
+    assert len(summary["items"]) == payload_log.PAYLOAD_LOG_MAX_ITEMS + 1
+
+
+def test_disabled_or_unsampled_payloads_are_never_built(caplog):
+    def build():
+        raise AssertionError("payload built for a dropped record")
+
+    with caplog.at_level(logging.INFO):
+        payload_log.log_payload("Request body", build)
+    with caplog.at_level(logging.DEBUG):
+        payload_log.log_payload("Request body", build, sample_rate=0.0)
+        payload_log.log_payload("Response body", lambda: {"vector": [0.5] * 64})
+
+    assert len(caplog.records) == 1
+    assert caplog.records[0].getMessage().startswith('Response body: {"vector": "<vector dims=64 crc32=')
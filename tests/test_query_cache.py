@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from helpers import query_cache
+
+
+def test_normalize_query_folds_case_and_whitespace():
+    assert query_cache.normalize_query("  Blue   SKY\t") == query_cache.normalize_query("blue sky")
+
+
+def test_concurrent_identical_queries_share_one_call():
+    cache = query_cache.SingleFlightCache("test")
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return "rephrased"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("q", compute))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["rephrased"] * 8
+    assert len(calls) == 1
+    assert cache.get_or_compute("q", compute) == "rephrased"
+    assert cache.stats()["hits"] == 1
+
+
+def test_concurrent_async_queries_share_one_call_with_the_sync_path():
+    cache = query_cache.SingleFlightCache("test")
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "rephrased"
+
+    async def lookups():
+        return await asyncio.gather(*(cache.get_or_compute_async("q", compute) for _ in range(8)))
+
+    assert asyncio.run(lookups()) == ["rephrased"] * 8
+    assert len(calls) == 1
+    # Entries are shared with the sync lookups
+    assert cache.get_or_compute("q", lambda: "other") == "rephrased"
+
+
+def test_async_waiters_hold_no_threads_and_survive_a_cancelled_leader():
+    cache = query_cache.SingleFlightCache("test")
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: cache.get_or_compute("sync", lambda: release.wait() and "value"))
+    leader.start()
+    while not cache._inflight:
+        time.sleep(0.01)
+
+    async def compute():
+        await asyncio.sleep(0.1)
+        return "rephrased"
+
+    async def lookups():
+        threads = threading.active_count()
+        waiters = [asyncio.ensure_future(cache.get_or_compute_async("sync", compute)) for _ in range(50)]
+        await asyncio.sleep(0.05)
+        threads = threading.active_count() - threads
+        release.set()
+        # The first async lookup leads its flight; cancelling it leaves the call to the other waiter
+        first = asyncio.ensure_future(cache.get_or_compute_async("async", compute))
+        second = asyncio.ensure_future(cache.get_or_compute_async("async", compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        return threads, await asyncio.gather(*waiters), await second
+
+    threads, values, value = asyncio.run(lookups())
+    leader.join()
+
+    assert threads <= 0
+    assert values == ["value"] * 50
+    assert value == "rephrased" and cache.get_or_compute("async", lambda: "other") == "rephrased"
+
+
+def test_entries_expire_and_failures_are_not_cached():
+    cache = query_cache.SingleFlightCache("test", ttl=0.05)
+    cache.get_or_compute("q", lambda: 1)
+    time.sleep(0.06)
+    assert cache.get_or_compute("q", lambda: 2) == 2
+    assert cache.stats()["expired"] == 1
+
+    def fail():
+        raise RuntimeError("throttled")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute("other", fail)
+    assert cache.get_or_compute("other", lambda: 3) == 3
+
+
+def test_lru_bound():
+    cache = query_cache.SingleFlightCache("test", max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.get_or_compute(key, lambda: key)
+
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["evictions"] == 1
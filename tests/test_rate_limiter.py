@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from helpers import rate_limiter
+
+
+def drained(rate=20.0, **kwargs):
+    limiter = rate_limiter.AdaptiveRateLimiter("test", rate, **kwargs)
+    limiter._tokens = 0.0
+    return limiter
+
+
+def test_interactive_calls_go_ahead_of_queued_bulk_calls():
+    limiter = drained(rate=20.0)
+    order = []
+
+    def call(name, priority):
+        limiter.acquire(priority)
+        order.append(name)
+
+    threads = [threading.Thread(target=call, args=(f"bulk{i}", rate_limiter.BULK)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    while limiter.stats()["queue_depth"] < 3:
+        time.sleep(0.001)
+    interactive = threading.Thread(target=call, args=("interactive", rate_limiter.INTERACTIVE))
+    interactive.start()
+    for thread in threads + [interactive]:
+        thread.join()
+
+    # The first bulk call may already hold the next token, the interactive call overtakes the rest
+    assert order.index("interactive") <= 1
+    assert limiter.stats()["max_queue_depth"] == 4
+
+
+def test_async_calls_wait_without_threads_and_keep_the_priority_order():
+    limiter = drained(rate=20.0)
+    order = []
+
+    async def call(name, priority):
+        await limiter.acquire_async(priority)
+        order.append(name)
+
+    async def calls():
+        threads = threading.active_count()
+        bulk = [asyncio.ensure_future(call(f"bulk{i}", rate_limiter.BULK)) for i in range(5)]
+        while limiter.stats()["queue_depth"] < 5:
+            await asyncio.sleep(0.001)
+        threads = threading.active_count() - threads
+        # A thread and a coroutine share the bucket
+        sync = threading.Thread(target=limiter.acquire, args=(rate_limiter.BULK,))
+        sync.start()
+        await call("interactive", rate_limiter.INTERACTIVE)
+        await asyncio.gather(*bulk)
+        await asyncio.to_thread(sync.join)
+        return threads
+
+    assert asyncio.run(calls()) <= 0
+    assert order.index("interactive") <= 1
+    assert limiter.stats()["acquired"] == 7
+
+
+def test_throttling_decreases_multiplicatively_once_per_second_and_success_increases():
+    limiter = rate_limiter.AdaptiveRateLimiter("test", 10.0, min_rate=1.0, max_rate=12.0, decrease=0.5)
+
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == 5.0
+    assert limiter.stats()["decreases"] == 1
+
+    for _ in range(100):
+        limiter.succeeded()
+    assert 5.0 < limiter.rate <= 12.0
+
+
+def test_retry_after_pauses_the_bucket():
+    limiter = rate_limiter.AdaptiveRateLimiter("test", 100.0)
+
+    limiter.throttled(retry_after=0.2)
+
+    assert limiter.acquire() >= 0.18
+
+
+def test_waiting_longer_than_the_timeout_fails():
+    limiter = drained(rate=1.0)
+
+    with pytest.raises(rate_limiter.RateLimitTimeout):
+        limiter.acquire(timeout=0.05)
+    assert limiter.stats()["queue_depth"] == 0
@@ -0,0 +1,176 @@
+import asyncio
+import gc
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.functions as func
+import pytest
+
+import function_app
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    state = {"rephrase_delay": 0.0, "rephrase_error": None, "embedded": []}
+
+    def rephrase_query(user_query):
+        time.sleep(state["rephrase_delay"])
+        if state["rephrase_error"]:
+            raise state["rephrase_error"]
+        return f"rephrased {user_query}"
+
+    def embed_query(query):
+        state["embedded"].append(query)
+        return [float(len(query))]
+
+    monkeypatch.setattr(function_app, "rephrase_query", rephrase_query)
+    monkeypatch.setattr(function_app, "embed_query", embed_query)
+    return state
+
+
+def test_rephrase_can_be_disabled(stages):
+    query, vector, path = function_app.resolve_query_vector("sky", rephrase=False)
+
+    assert (query, path) == ("sky", "raw")
+    assert stages["embedded"] == ["sky"]
+
+
+def test_fast_mode_uses_rephrase_within_budget(stages):
+    query, _, path = function_app.resolve_query_vector("sky", fast=True, budget_ms=1000)
+
+    assert (query, path) == ("rephrased sky", "rephrased")
+    assert sorted(stages["embedded"]) == ["rephrased sky", "sky"]
+
+
+def test_fast_mode_falls_back_when_budget_is_missed(stages):
+    stages["rephrase_delay"] = 0.5
+    started = time.monotonic()
+    query, vector, path = function_app.resolve_query_vector("sky", fast=True, budget_ms=50)
+
+    assert time.monotonic() - started < 0.4
+    assert (query, vector, path) == ("sky", [3.0], "raw_fallback")
+
+
+def test_fast_mode_falls_back_when_rephrase_fails(stages):
+    stages["rephrase_error"] = RuntimeError("throttled")
+
+    assert function_app.resolve_query_vector("sky", fast=True, budget_ms=1000)[2] == "raw_fallback"
+
+
+def test_late_rephrases_never_delay_other_searches(stages, monkeypatch):
+    # Four rephrase workers, all of them busy with rephrases far beyond the budget
+    monkeypatch.setattr(function_app, "rephrase_executor", ThreadPoolExecutor(max_workers=4))
+    monkeypatch.setattr(function_app, "rephrase_slots", threading.BoundedSemaphore(4))
+    stages["rephrase_delay"] = 1.0
+
+    def search(i):
+        started = time.monotonic()
+        path = function_app.resolve_query_vector(f"sky {i}", fast=True, budget_ms=50)[2]
+        return path, time.monotonic() - started
+
+    with ThreadPoolExecutor(max_workers=8) as clients:
+        results = list(clients.map(search, range(8)))
+
+    assert all(path == "raw_fallback" for path, _ in results)
+    assert max(elapsed for _, elapsed in results) < 0.5
+    function_app.rephrase_executor.shutdown(wait=True)
+    # The late rephrases were not embedded, and their slots are free again
+    assert not any(query.startswith("rephrased") for query in stages["embedded"])
+    assert all(function_app.rephrase_slots.acquire(blocking=False) for _ in range(4))
+
+
+@pytest.fixture
+def async_stages(monkeypatch):
+    state = {"rephrase_delay": 0.0, "raw_delay": 0.0, "rephrase_error": None, "rephrased": [], "cancelled": []}
+
+    async def rephrase_query_async(user_query):
+        state["rephrased"].append(user_query)
+        await asyncio.sleep(state["rephrase_delay"])
+        if state["rephrase_error"]:
+            raise state["rephrase_error"]
+        return f"rephrased {user_query}"
+
+    async def embed_query_async(query):
+        try:
+            if not query.startswith("rephrased"):
+                await asyncio.sleep(state["raw_delay"])
+            return [float(len(query))]
+        except asyncio.CancelledError:
+            state["cancelled"].append(query)
+            raise
+
+    monkeypatch.setattr(function_app, "rephrase_query_async", rephrase_query_async)
+    monkeypatch.setattr(function_app, "embed_query_async", embed_query_async)
+    return state
+
+
+def run_with_exception_handler(coroutine):
+    # Runs coroutine, then lets pending tasks finish; returns its result and what asyncio reported
+    reported = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: reported.append(context))
+        result = await coroutine
+        await asyncio.sleep(0.2)
+        gc.collect()
+        return result
+
+    return asyncio.run(main()), reported
+
+
+def test_async_fast_mode_cancels_the_raw_embedding_when_the_rephrase_wins(async_stages):
+    async_stages["raw_delay"] = 1.0
+
+    async def search():
+        result = await function_app.resolve_query_vector_async("sky", fast=True, budget_ms=500)
+        await asyncio.sleep(0)
+        return result, list(async_stages["cancelled"])
+
+    ((query, _, path), cancelled), reported = run_with_exception_handler(search())
+
+    assert (query, path) == ("rephrased sky", "rephrased")
+    assert cancelled == ["sky"]
+    assert reported == []
+
+
+def test_async_late_rephrase_failures_are_retrieved(async_stages):
+    async_stages["rephrase_delay"] = 0.1
+    async_stages["rephrase_error"] = RuntimeError("throttled")
+
+    (query, _, path), reported = run_with_exception_handler(
+        function_app.resolve_query_vector_async("sky", fast=True, budget_ms=10))
+
+    assert (query, path) == ("sky", "raw_fallback")
+    assert reported == []
+
+
+def test_async_late_rephrases_are_bounded(async_stages, monkeypatch):
+    monkeypatch.setattr(function_app, "SEARCH_REPHRASE_WORKERS", 2)
+    async_stages["rephrase_delay"] = 0.3
+
+    async def searches():
+        paths = [(await function_app.resolve_query_vector_async(f"sky {i}", fast=True, budget_ms=10))[2]
+                 for i in range(4)]
+        await asyncio.sleep(0.4)
+        # The late rephrases finished and gave their slots back
+        paths.append((await function_app.resolve_query_vector_async("sky 5", fast=True, budget_ms=10))[2])
+        return paths
+
+    assert asyncio.run(searches()) == ["raw_fallback"] * 5
+    assert async_stages["rephrased"] == ["sky 0", "sky 1", "sky 5"]
+
+
+@pytest.mark.parametrize("options", [{"mode": "fast", "latency_budget_ms": "abc"}, {"latency_budget_ms": -1},
+                                     {"rephrase": "false"}, {"rephrase": 0}])
+def test_invalid_resolve_options_are_rejected(stages, options):
+    body = json.dumps(dict(options, query="sky")).encode()
+
+    response = function_app.search(func.HttpRequest("POST", "/api/search", body=body))
+    batch = json.loads(function_app.search_batch(func.HttpRequest(
+        "POST", "/api/search/batch", body=json.dumps({"queries": [dict(options, query="sky")]}).encode())).get_body())
+
+    assert response.status_code == 400
+    assert batch["results"][0]["error"] and batch["results"][0]["results"] == []
+    assert stages["embedded"] == []
@@ -0,0 +1,106 @@
+import json
+
+import azure.functions as func
+import pytest
+
+import function_app
+from helpers import search_backends, search_paging, vector_codec
+
+
+class RankedBackend(search_backends.SearchBackend):
+    def __init__(self, count):
+        self.ranking = [
+            {"id": str(i), "title": f"image{i}.png", "imageUrl": f"https://a/data/image{i}.png", "@search.score": 1 - i / 100}
+            for i in range(count)
+        ]
+        self.calls = []
+
+    def search(self, vector, k, offset=0):
+        self.calls.append((offset, k))
+        return self.ranking[offset:offset + k]
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = RankedBackend(7)
+    calls = {"rephrase": 0, "embed": 0}
+
+    def rephrase_query(user_query):
+        calls["rephrase"] += 1
+        return user_query
+
+    def embed_query(query):
+        calls["embed"] += 1
+        return vector_codec.to_float32([0.25] * 8)
+
+    monkeypatch.setattr(search_backends, "_backend", backend)
+    monkeypatch.setattr(function_app, "rephrase_query", rephrase_query)
+    monkeypatch.setattr(function_app, "embed_query", embed_query)
+    monkeypatch.setattr(function_app.helper_functions, "create_user_delegated_sas_token", lambda url, auth: "sig=x")
+    backend.upstream_calls = calls
+    yield backend
+    search_backends.set_backend(None)
+
+
+def post(body, headers=None):
+    return func.HttpRequest("POST", "/search", headers=headers or {}, body=json.dumps(body).encode("utf-8"))
+
+
+def test_cursor_round_trip():
+    vector = vector_codec.to_float32([0.1, -0.2, 0.3])
+    decoded, offset, page_size, query = search_paging.decode_cursor(search_paging.encode_cursor(vector, 10, 5, "sky"))
+
+    assert (decoded, offset, page_size, query) == (vector, 10, 5, "sky")
+    with pytest.raises(ValueError):
+        search_paging.decode_cursor("not-a-cursor")
+
+
+def test_pages_reuse_the_query_vector(backend):
+    response = function_app.search(post({"query": "blue sky", "page_size": 3}))
+    page = json.loads(response.get_body())
+    titles = [result["Title"] for result in page["results"]]
+
+    while page["nextCursor"]:
+        page = json.loads(function_app.search(post({"cursor": page["nextCursor"]})).get_body())
+        titles += [result["Title"] for result in page["results"]]
+
+    assert titles == [f"image{i}.png" for i in range(7)]
+    assert backend.calls == [(0, 3), (3, 3), (6, 3)]
+    assert backend.upstream_calls == {"rephrase": 1, "embed": 1}
+
+
+def test_ndjson_lines(backend):
+    response = function_app.search(post({"query": "blue sky", "page_size": 2}, {"Accept": "application/x-ndjson"}))
+    lines = [json.loads(line) for line in response.get_body().decode("utf-8").splitlines()]
+
+    assert response.mimetype == "application/x-ndjson"
+    assert [line["Image"] for line in lines[:-1]] == ["https://a/data/image0.png?sig=x", "https://a/data/image1.png?sig=x"]
+    assert lines[-1]["nextCursor"]
+
+
+@pytest.mark.parametrize("page_size", [0, -1, "many", None])
+def test_page_size_below_one_is_rejected(backend, page_size):
+    response = function_app.search(post({"query": "blue sky", "page_size": page_size}))
+
+    assert response.status_code == 400
+    assert backend.calls == []
+
+
+def test_unpaginated_search_keeps_the_list_response(backend):
+    output = json.loads(function_app.search(post({"query": "blue sky", "max_images": 2})).get_body())
+
+    assert [result["Title"] for result in output] == ["image0.png", "image1.png"]
+
+
+def test_hot_set_pages_all_come_from_the_remote_index(backend, monkeypatch):
+    local = RankedBackend(7)
+    monkeypatch.setattr(search_backends, "_backend", search_backends.HotSetSearchBackend(local, backend, min_score=0.5))
+
+    page = json.loads(function_app.search(post({"query": "blue sky", "page_size": 3})).get_body())
+    while page["nextCursor"]:
+        page = json.loads(function_app.search(post({"cursor": page["nextCursor"]})).get_body())
+    function_app.search(post({"query": "blue sky", "max_images": 3}))
+
+    assert backend.calls == [(0, 3), (3, 3), (6, 3)]
+    # Only the unpaginated search is answered by the local index
+    assert local.calls == [(0, 3)]
@@ -0,0 +1,91 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from helpers import transport
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    throttle_first = 0
+    calls = 0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        FlakyHandler.calls += 1
+        if FlakyHandler.calls <= FlakyHandler.throttle_first:
+            body = b"throttled"
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+        else:
+            body = b'{"vector": [0.1, 0.2]}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    FlakyHandler.calls = 0
+    FlakyHandler.throttle_first = 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retries_throttled_requests(server):
+    FlakyHandler.throttle_first = 2
+    response = transport.post(f"{server}/retrieval:vectorizeImage", json={"url": "x"})
+
+    assert response.status_code == 200
+    assert response.json()["vector"] == [0.1, 0.2]
+    counters = transport.stats()[server]
+    assert counters["throttled"] >= 2
+    assert counters["retries"] >= 2
+
+
+def test_returns_last_response_when_retries_exhausted(server):
+    FlakyHandler.throttle_first = 10
+    response = transport.post(f"{server}/retrieval:vectorizeImage", json={}, max_retries=1)
+
+    assert response.status_code == 429
+    assert FlakyHandler.calls == 2
+
+
+def test_reuses_pooled_connections(server):
+    for _ in range(5):
+        assert transport.post(f"{server}/retrieval:vectorizeText", json={}).status_code == 200
+
+    counters = transport.stats()[server]
+    assert counters["reused_connections"] >= 4
+
+
+def test_retry_after_header_is_respected():
+    class Response:
+        headers = {"Retry-After": "3"}
+
+    assert transport.parse_retry_after(Response()) == 3.0
+    assert 3.0 <= transport.backoff_delay(0, Response()) <= 3.0 + transport.HTTP_BACKOFF_BASE
+
+
+def test_openai_client_uses_the_shared_retry_policy(monkeypatch):
+    openai = pytest.importorskip("openai")
+    monkeypatch.setattr(transport, "HTTP_MAX_RETRIES", 2)
+    monkeypatch.setattr(transport, "HTTP_READ_TIMEOUT", 7.0)
+
+    client = openai.AzureOpenAI(azure_endpoint="https://example.openai.azure.com", api_key="fake",
+                                api_version="2024-02-01", **transport.openai_client_options())
+
+    assert client.max_retries == 2
+    assert client.timeout.read == 7.0
+    client.close()
@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+
+from benchmarks import tune_vector_index
+from benchmarks.hnsw import HNSWIndex
+
+
+def corpus_and_queries():
+    vectors = tune_vector_index.synthetic_vectors(420, 32, clusters=8, spread=0.5)
+    return tune_vector_index.split_queries(vectors, 20)
+
+
+def test_hnsw_recall_grows_with_ef_search():
+    corpus, queries = corpus_and_queries()
+    truth = tune_vector_index.exact_neighbors(corpus, queries, 10)
+    index = HNSWIndex(corpus, m=4, ef_construction=100)
+
+    def recall(ef_search):
+        found = [index.search(query, 10, ef_search) for query in queries]
+        return np.mean([len(set(f) & set(t.tolist())) / 10 for f, t in zip(found, truth)])
+
+    assert recall(10) <= recall(400)
+    assert recall(400) >= 0.99
+
+
+def test_compression_shrinks_vectors_and_keeps_recall_after_rerank():
+    corpus, queries = corpus_and_queries()
+    truth = tune_vector_index.exact_neighbors(corpus, queries, 10)
+
+    results = {}
+    for compression in ("none", "scalar", "binary"):
+        results[compression] = tune_vector_index.evaluate(
+            corpus, queries, truth, 4, 100, [400], compression, 10,
+            tune_vector_index.DEFAULT_OVERSAMPLING[compression], tune_vector_index.BuiltinBackend,
+        )[0]
+
+    bytes_per_vector = {name: tune_vector_index.quantize(corpus, name)[1] for name in results}
+    assert bytes_per_vector == {"none": 128, "scalar": 32, "binary": 4}
+    assert results["none"]["index_mb"] > results["scalar"]["index_mb"] > results["binary"]["index_mb"]
+    assert results["scalar"]["recall@10"] >= 0.95
+
+
+def test_tuned_index_definition_sets_hnsw_parameters_and_compression():
+    with open(tune_vector_index.INDEX_DEFINITION, encoding="utf-8") as f:
+        definition = json.load(f)
+    result = {"m": 8, "efConstruction": 200, "efSearch": 400, "compression": "binary", "oversampling": 10}
+
+    tuned = tune_vector_index.tuned_index_definition(definition, result)
+
+    vector_search = tuned["vectorSearch"]
+    assert vector_search["algorithms"][0]["hnswParameters"] == {
+        "metric": "cosine", "m": 8, "efConstruction": 200, "efSearch": 400,
+    }
+    assert vector_search["profiles"][0]["compression"] == "myBinaryQuantization"
+    assert vector_search["compressions"] == [{
+        "name": "myBinaryQuantization", "kind": "binaryQuantization",
+        "rerankWithOriginalVectors": True, "defaultOversampling": 10,
+    }]
+    assert "@odata.etag" not in tuned
+    # The original definition is left alone
+    assert definition["vectorSearch"]["algorithms"][0]["hnswParameters"]["m"] == 4
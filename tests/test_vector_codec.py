@@ -0,0 +1,35 @@
+import json
+import random
+
+from helpers import vector_codec
+
+
+def sample_vector(dimensions=1024):
+    random.seed(1)
+    return vector_codec.to_float32([random.gauss(0, 0.05) for _ in range(dimensions)])
+
+
+def test_json_rendering_round_trips_float32():
+    vector = sample_vector()
+    body = vector_codec.dumps({"values": [{"recordId": "1", "data": {"imageVector": vector}, "errors": None}]})
+
+    parsed = json.loads(body)
+    assert vector_codec.to_float32(parsed["values"][0]["data"]["imageVector"]) == vector
+    assert parsed["values"][0]["errors"] is None
+
+
+def test_base64_round_trips_exactly():
+    vector = sample_vector()
+    encoded = vector_codec.encode(vector, "base64")
+
+    assert encoded["dimensions"] == 1024
+    assert vector_codec.decode(encoded) == vector
+
+
+def test_int8_quantization_error_is_bounded():
+    vector = sample_vector()
+    encoded = vector_codec.encode(vector, "int8")
+    decoded = vector_codec.decode(encoded)
+
+    assert len(decoded) == len(vector)
+    assert max(abs(a - b) for a, b in zip(vector, decoded)) <= encoded["scale"] / 2 + 1e-6
@@ -0,0 +1,38 @@
+import threading
+import time
+
+import function_app
+from helpers import helper_functions
+
+
+def test_vectorize_images_keeps_order_and_bounds_concurrency(monkeypatch):
+    monkeypatch.setattr(function_app, "VECTORIZE_MAX_WORKERS", 3)
+    monkeypatch.setattr(helper_functions, "create_service_sas_blob", lambda image_url: "sig=x")
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def get_image_embeddings(image_url, *args, **kwargs):
+        with lock:
+            running.append(image_url)
+            peak.append(len(running))
+        try:
+            # Later records finish first
+            time.sleep(0.05 if image_url.endswith("0.png") else 0.01)
+            return [0.5] * 1024
+        finally:
+            with lock:
+                running.remove(image_url)
+
+    monkeypatch.setattr(helper_functions, "get_image_embeddings", get_image_embeddings)
+    urls = [f"https://account.blob.core.windows.net/vectorize/{i}.png" for i in range(9)]
+    values = [{"recordId": str(i), "data": {"imageUrl": url, "eTag": "0x1"}} for i, url in enumerate(urls)]
+    values[4] = {"recordId": "4", "data": {}}
+
+    response_values = function_app.vectorize_images(values)
+
+    assert [value["recordId"] for value in response_values] == [str(i) for i in range(9)]
+    assert "imageUrl" in response_values[4]["errors"]
+    assert all(value["errors"] is None for i, value in enumerate(response_values) if i != 4)
+    assert [value["data"]["imageUrl"] for value in response_values if value["data"]] == urls[:4] + urls[5:]
+    assert max(peak) == 3